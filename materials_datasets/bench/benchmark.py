@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from pathlib import Path  ## for os-agnostic paths
+
+HERE = Path(__file__).parent
+PARENT = Path(__file__).parent.parent
+
+sys.path.append(str(HERE))
+sys.path.append(str(PARENT))
+from fake_servers import Fake_OQMD, Fake_ICSD, Fake_MP
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux (bytes on macos)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def oqmd_session(url, n_materials):
+    from oqmd.download import OQMD_multi_session
+    return OQMD_multi_session(start_at=0, stop_at=n_materials, host=url)
+
+
+def run_oqmd_threads(url, args):
+    from oqmd.download import OQMD_page_ledger, download_part
+    with tempfile.TemporaryDirectory() as directory:
+        df = download_part(oqmd_session(url, args.n_materials), OQMD_page_ledger(directory))
+    return len(df)
+
+
+def run_oqmd_async(url, args):
+    from oqmd.download import OQMD_page_ledger, OQMD_async_engine, download_part
+    with tempfile.TemporaryDirectory() as directory:
+        with OQMD_async_engine() as engine:
+            df = download_part(
+                oqmd_session(url, args.n_materials), OQMD_page_ledger(directory), engine
+            )
+    return len(df)
+
+
+def run_icsd_session(url, args):
+    from icsd.download import ICSD_Session
+    with ICSD_Session("bench", "bench", address=url+"/ws") as icsd:
+        ids = list(range(1, args.n_cifs+1))
+        return len(icsd.safe_query_cifs(ids))
+
+
+def run_icsd_pool(url, args):
+    from icsd.download import ICSD_session_pool, ICSD_cif_store
+    with tempfile.TemporaryDirectory() as directory:
+        with ICSD_cif_store(os.path.join(directory, "cifs.sqlite")) as store:
+            with ICSD_session_pool("bench", "bench", args.n_sessions, address=url+"/ws") as icsd:
+                icsd.store_cifs(list(range(1, args.n_cifs+1)), store)
+            return len(store)
+
+
+def run_mp(url, args):
+    from mp.download import download_all_materials_project
+    materials = download_all_materials_project(
+        "fakefakefakefake",  # 16 characters, as the keys of the legacy api
+        chunk_size=args.mp_chunk_size,
+        properties=["material_id", "pretty_formula", "nelements", "nsites", "band_gap"],
+        endpoint=url+"/rest/v2",
+    )
+    return len(materials)
+
+
+# name: (client, fake server class, server arguments from the command line)
+BENCHMARKS = {
+    "oqmd_threads": (run_oqmd_threads, Fake_OQMD, lambda a: {"n_materials": a.n_materials, "n_sites": a.n_sites}),
+    "oqmd_async": (run_oqmd_async, Fake_OQMD, lambda a: {"n_materials": a.n_materials, "n_sites": a.n_sites}),
+    "icsd_session": (run_icsd_session, Fake_ICSD, lambda a: {"n_cifs": a.n_cifs, "cif_size": a.cif_size}),
+    "icsd_pool": (run_icsd_pool, Fake_ICSD, lambda a: {"n_cifs": a.n_cifs, "cif_size": a.cif_size}),
+    "mp": (run_mp, Fake_MP, lambda a: {"n_materials": a.n_materials}),
+}
+
+
+def client_process(name, url, args, results):
+    """ runs in its own process, so that its peak RSS is the client's only """
+    client = BENCHMARKS[name][0]
+    sys.stdout = open(os.devnull, "w")  # progress lines of the downloaders
+    try:
+        rows = client(url, args)
+        results.put((rows, peak_rss_mb(), None))
+    except Exception as exc:
+        results.put((0, peak_rss_mb(), repr(exc)))
+
+
+def run_benchmark(name, args):
+    _, server_class, server_args = BENCHMARKS[name]
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    with server_class(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        seed=args.seed, **server_args(args)
+    ) as server:
+        process = context.Process(target=client_process, args=(name, server.url, args, results))
+        timer_start = time.time()
+        process.start()
+        rows, peak_rss, error = results.get()
+        process.join()
+        elapsed = time.time() - timer_start
+    return {
+        "benchmark": name,
+        "seconds": elapsed,
+        "requests": server.n_requests,
+        "errors": server.n_errors,
+        "rows": rows,
+        "pages/s": (server.n_requests - server.n_errors) / elapsed,
+        "MB/s": server.bytes_sent / 2**20 / elapsed,
+        "rows/s": rows / elapsed,
+        "peak RSS MB": peak_rss,
+        "failure": error,
+    }
+
+
+def print_report(report):
+    line = (
+        f"{report['benchmark']:<14} {report['seconds']:8.2f} s"
+        f" {report['requests']:6d} req ({report['errors']} failed)"
+        f" {report['pages/s']:8.1f} pages/s {report['MB/s']:8.2f} MB/s"
+        f" {report['rows/s']:10.0f} rows/s {report['peak RSS MB']:8.1f} MB peak RSS"
+    )
+    if report["failure"] is not None:
+        line += f"  FAILED: {report['failure']}"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="throughput of the downloaders against local fake servers"
+    )
+    parser.add_argument("benchmarks", nargs="*", help=f"any of {', '.join(BENCHMARKS)} (default all)")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per response")
+    parser.add_argument("--jitter", type=float, default=0.02, help="random extra latency, seconds")
+    parser.add_argument("--error-rate", type=float, default=0., help="fraction of 503 responses")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--n-materials", type=int, default=20000, help="oqmd and mp")
+    parser.add_argument("--n-sites", type=int, default=8, help="sites per oqmd entry")
+    parser.add_argument("--n-cifs", type=int, default=5000)
+    parser.add_argument("--cif-size", type=int, default=4000, help="bytes per cif")
+    parser.add_argument("--n-sessions", type=int, default=4, help="icsd pool")
+    parser.add_argument("--mp-chunk-size", type=int, default=5000)
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks {', '.join(sorted(unknown))}")
+
+    for name in args.benchmarks or BENCHMARKS:
+        print_report(run_benchmark(name, args))
+
+
+if __name__ == "__main__":
+    main()
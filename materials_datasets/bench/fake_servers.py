@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# a few formulas to draw the fake materials from
+FORMULAS = [
+    ({"Na": 1, "Cl": 1}, 225),
+    ({"Mg": 1, "O": 1}, 225),
+    ({"Si": 1, "O": 2}, 154),
+    ({"Li": 1, "Fe": 1, "P": 1, "O": 4}, 62),
+    ({"Ba": 1, "Ti": 1, "O": 3}, 221),
+    ({"Ga": 1, "As": 1}, 216),
+    ({"Fe": 2, "O": 3}, 167),
+    ({"Cu": 1}, 225),
+]
+
+
+class Fake_handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, as the real servers
+
+    def handle_request(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        status, headers, content = self.server.app.handle(
+            method, url.path, url.query, self.headers, body
+        )
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Fake_server:
+    """ Local HTTP stand-in for a remote API, served from a background thread.
+
+    Every response is delayed by `latency` seconds (plus a uniform random
+    `jitter`), and a fraction `error_rate` of the requests fail with a 503,
+    so the downloaders can be tested and benchmarked without network access
+    or credentials. With `etags`, 200 responses carry an ETag and conditional
+    requests matching it get a 304. Subclasses implement `respond`. The
+    number of requests and of bytes sent are counted. Use as a context
+    manager; `url` is the address to give to the clients.
+    """
+    def __init__(self, latency=0., jitter=0., error_rate=0., seed=0, port=0, etags=False):
+        self.latency = latency
+        self.etags = etags
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.n_errors = 0
+        self.bytes_sent = 0
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), Fake_handler)
+        self.httpd.daemon_threads = True
+        self.httpd.app = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_counters(self):
+        with self.lock:
+            self.n_requests = 0
+            self.n_errors = 0
+            self.bytes_sent = 0
+
+    def handle(self, method, path, query, headers, body):
+        with self.lock:
+            delay = self.latency + self.jitter*self.random.random()
+            failed = self.random.random() < self.error_rate
+        time.sleep(delay)
+        if failed:
+            status, response_headers, content = 503, {}, b"Service Unavailable"
+        else:
+            status, response_headers, content = self.respond(
+                method, path, urllib.parse.parse_qs(query), headers, body
+            )
+            if isinstance(content, str):
+                content = content.encode()
+            if self.etags and status == 200:
+                etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+                response_headers = {**response_headers, "ETag": etag}
+                if headers.get("If-None-Match") == etag:
+                    status, content = 304, b""
+        with self.lock:
+            self.n_requests += 1
+            self.n_errors += failed or status >= 400
+            self.bytes_sent += len(content)
+        return status, response_headers, content
+
+    def respond(self, method, path, params, headers, body):
+        raise NotImplementedError
+
+
+def fake_formula(i):
+    return FORMULAS[i % len(FORMULAS)]
+
+
+class Fake_OQMD(Fake_server):
+    """ OPTIMADE `structures` endpoint of OQMD, with `n_materials` entries of
+    `n_sites` sites each (the size of the pages grows with `n_sites`) """
+    def __init__(self, n_materials=10000, n_sites=8, **kwargs):
+        self.n_materials = n_materials
+        self.n_sites = n_sites
+        super().__init__(**kwargs)
+
+    def entry(self, i):
+        formula, _ = fake_formula(i)
+        elements = sorted(formula)
+        species = [e for e in elements for _ in range(formula[e])]
+        species = (species * self.n_sites)[:self.n_sites]
+        return {
+            "id": str(i+1),
+            "type": "structures",
+            "attributes": {
+                "chemical_formula_reduced": "".join(f"{e}{formula[e]}" for e in elements),
+                "elements": elements,
+                "nelements": len(elements),
+                "nsites": self.n_sites,
+                "species_at_sites": species,
+                "cartesian_site_positions": [
+                    [0.1*j, 0.2*j, 0.3*j] for j in range(self.n_sites)
+                ],
+                "lattice_vectors": [[4., 0., 0.], [0., 4., 0.], [0., 0., 4.]],
+                "_oqmd_entry_id": i+1,
+                "_oqmd_delta_e": -0.001*(i % 1000),
+                "_oqmd_band_gap": 0.01*(i % 500),
+                "_oqmd_stability": 0.001*(i % 300),
+            },
+        }
+
+    def respond(self, method, path, params, headers, body):
+        if not path.endswith("/optimade/structures"):
+            return 404, {}, "Not Found"
+        limit = int(params.get("limit", ["10"])[0])
+        offset = int(params.get("offset", ["0"])[0])
+        stop = min(offset+limit, self.n_materials)
+        page = {
+            "data": [self.entry(i) for i in range(offset, stop)],
+            "meta": {"data_returned": self.n_materials, "more_data_available": stop < self.n_materials},
+        }
+        return 200, {"Content-Type": "application/json"}, json.dumps(page)
+
+
+class Fake_ICSD(Fake_server):
+    """ `/auth/login`, `/auth/logout`, `/search/expert` and `/cif/multiple`
+    endpoints of the ICSD web service (under /ws), with `n_cifs` entries
+    whose cifs are padded to about `cif_size` bytes. Any login succeeds; the
+    tokens are checked, and expire after `token_cif_limit` cifs. """
+    def __init__(self, n_cifs=5000, cif_size=4000, token_cif_limit=10000, **kwargs):
+        self.n_cifs = n_cifs
+        self.cif_size = cif_size
+        self.token_cif_limit = token_cif_limit
+        self.tokens = {}  # token: number of cifs served
+        self.n_logins = 0
+        super().__init__(**kwargs)
+
+    def nelements(self, icsd_id):
+        formula, _ = fake_formula(icsd_id)
+        return len(formula)
+
+    def cif(self, icsd_id):
+        formula, spacegroup = fake_formula(icsd_id)
+        lines = [
+            f"data_{icsd_id}-ICSD",
+            f"_database_code_ICSD {icsd_id}",
+            f"_chemical_formula_sum '{' '.join(f'{e}{n}' for e, n in formula.items())}'",
+            f"_space_group_IT_number {spacegroup}",
+            "_cell_length_a 4.",
+            "_cell_length_b 4.",
+            "_cell_length_c 4.",
+            "loop_",
+            "_atom_site_label",
+            "_atom_site_type_symbol",
+            "_atom_site_fract_x",
+            "_atom_site_fract_y",
+            "_atom_site_fract_z",
+            "_atom_site_occupancy",
+        ]
+        for j, element in enumerate(formula):
+            lines.append(f"{element}{j+1} {element}0+ 0 0 {0.25*j:.4f} 1.")
+        size = sum(len(line)+1 for line in lines)
+        while size < self.cif_size:
+            lines.append(f"#End of TTdata_{icsd_id}-ICSD")
+            size += len(lines[-1])+1
+        return "\n".join(lines)
+
+    def respond(self, method, path, params, headers, body):
+        if path == "/ws/auth/login":
+            token = f"fake-{len(self.tokens)}"
+            with self.lock:
+                self.tokens[token] = 0
+                self.n_logins += 1
+            return 200, {"ICSD-Auth-Token": token}, "Authentication successful"
+
+        token = headers.get("ICSD-Auth-Token")
+        if token not in self.tokens:
+            return 401, {}, "Unauthorized"
+        if path == "/ws/auth/logout":
+            return 200, {}, "Logout successful"
+
+        if path == "/ws/search/expert":
+            match = re.search(r"NUMBEROFELEMENTS:\s*(\d+)", params.get("query", [""])[0])
+            ids = []
+            if match is not None:
+                n = int(match.group(1))
+                ids = [i for i in range(1, self.n_cifs+1) if self.nelements(i) == n]
+            xml = f"<searchResult><idnums>{' '.join(map(str, ids))}</idnums></searchResult>"
+            return 200, {"Content-Type": "application/xml"}, xml
+
+        if path == "/ws/cif/multiple":
+            ids = [int(i) for i in params.get("idnum", [])]
+            with self.lock:
+                self.tokens[token] += len(ids)
+                expired = self.tokens[token] > self.token_cif_limit
+            if expired:
+                return 403, {}, "Token limit exceeded"
+            cifs = [
+                f"#(C) 2024 by FIZ Karlsruhe - Leibniz Institute for Information Infrastructure\n"
+                f"{self.cif(i)}\n"
+                for i in ids if 1 <= i <= self.n_cifs
+            ]
+            return 200, {"Content-Type": "application/cif; charset=utf-8"}, "".join(cifs)
+
+        return 404, {}, "Not Found"
+
+
+def match_criterion(value, criterion):
+    if isinstance(criterion, dict):
+        return all(
+            (op == "$gte" and value >= bound)
+            or (op == "$lte" and value <= bound)
+            or (op == "$in" and value in bound)
+            for op, bound in criterion.items()
+        )
+    return value == criterion
+
+
+class Fake_MP(Fake_server):
+    """ `/query` endpoint of the (legacy) materials project REST API, used by
+    `MPRester.query`, with `n_materials` materials of 1 to `max_nsites` sites.
+    Criteria on nelements, nsites and material_id, projections and
+    count_only are supported. Serve with `endpoint=server.url + "/rest/v2"`.
+    """
+    def __init__(self, n_materials=10000, max_nsites=40, **kwargs):
+        self.n_materials = n_materials
+        self.max_nsites = max_nsites
+        super().__init__(**kwargs)
+        self.materials = [self.material(i) for i in range(n_materials)]
+
+    def material(self, i):
+        formula, spacegroup = fake_formula(i)
+        nsites = 1 + (i*7919) % self.max_nsites
+        return {
+            "material_id": f"mp-{i+1}",
+            "pretty_formula": "".join(f"{e}{n if n > 1 else ''}" for e, n in formula.items()),
+            "elements": sorted(formula),
+            "nelements": len(formula),
+            "nsites": nsites,
+            "unit_cell_formula": formula,
+            "volume": 20.*nsites,
+            "density": 2. + 0.001*(i % 1000),
+            "band_gap": 0.01*(i % 500),
+            "formation_energy_per_atom": -0.001*(i % 1000),
+            "e_above_hull": 0.001*(i % 300),
+            "spacegroup": {"number": spacegroup, "crystal_system": "cubic"},
+            "magnetism": {"total_magnetization": 0., "num_magnetic_sites": "0"},
+            "icsd_ids": [i+1],
+        }
+
+    def respond(self, method, path, params, headers, body):
+        if path.endswith("/api_check"):
+            response = {"version": {"db": "fake", "pymatgen": "fake", "rest": "fake"}}
+            return 200, {}, json.dumps({"valid_response": True, "response": response})
+        if not path.endswith("/query"):
+            return 404, {}, "Not Found"
+
+        form = urllib.parse.parse_qs(body.decode())
+        form.update(params)
+        criteria = json.loads(form.get("criteria", ["{}"])[0])
+        properties = json.loads(form.get("properties", ["null"])[0])
+        options = json.loads(form.get("options", ["{}"])[0])
+        found = [
+            material for material in self.materials
+            if all(match_criterion(material.get(key), value) for key, value in criteria.items())
+        ]
+        if options.get("count_only"):
+            response = len(found)
+        elif properties:
+            response = [{p: material.get(p) for p in properties} for material in found]
+        else:
+            response = found
+        return 200, {"Content-Type": "application/json"}, json.dumps(
+            {"valid_response": True, "response": response}
+        )
+
+
+if __name__ == "__main__":
+    # serve the three stand-ins until interrupted, for manual runs of the
+    # download scripts (pass the printed addresses to them)
+    servers = {
+        "oqmd": Fake_OQMD(port=8001, latency=0.05),
+        "icsd": Fake_ICSD(port=8002, latency=0.05),
+        "mp": Fake_MP(port=8003, latency=0.05),
+    }
+    for name, server in servers.items():
+        print(f"fake {name} at {server.url}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for server in servers.values():
+            server.close()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import urllib.parse
+from pathlib import Path  ## for os-agnostic paths
+
+import requests
+
+HERE = Path(__file__).parent
+FIXTURES_DIR = str(HERE/"fixtures")
+
+sys.path.append(str(HERE))
+from fake_servers import Fake_server
+
+# headers not worth recording (or replaying) as they are recomputed
+HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length", "content-encoding"}
+# request headers forwarded upstream
+FORWARDED_HEADERS = {"accept", "content-type", "icsd-auth-token", "x-api-key"}
+
+
+def fixture_key(method, path, query, body=b""):
+    """ name of the fixture of a request. The query parameters are sorted,
+    and POST bodies count only for the MP query endpoint (the ICSD login
+    body holds the credentials, and tokens are sent as headers) """
+    params = sorted(urllib.parse.parse_qsl(query, keep_blank_values=True))
+    key = f"{method} {path}?{urllib.parse.urlencode(params)}"
+    if method == "POST" and path.endswith("/query"):
+        key += " " + "&".join(sorted(body.decode().split("&")))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class Recording_server(Fake_server):
+    """ Proxy to the real `upstream` API which saves every response it
+    forwards as a fixture (status and headers in `<key>.json`, body in
+    `<key>.body`) in `directory`, for `Replay_server`. Point a downloader at
+    `url` and run it once to record. """
+    def __init__(self, upstream, directory=FIXTURES_DIR, **kwargs):
+        self.upstream = upstream.rstrip("/")
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.session = requests.Session()
+        super().__init__(**kwargs)
+
+    def respond(self, method, path, params, headers, body):
+        query = urllib.parse.urlencode(params, doseq=True)
+        forwarded = {k: v for k, v in headers.items() if k.lower() in FORWARDED_HEADERS}
+        response = self.session.request(
+            method, f"{self.upstream}{path}?{query}", headers=forwarded, data=body or None
+        )
+        response_headers = {
+            k: v for k, v in response.headers.items() if k.lower() not in HOP_HEADERS
+        }
+        key = fixture_key(method, path, query, body)
+        with open(os.path.join(self.directory, key + ".body"), "wb") as f:
+            f.write(response.content)
+        with open(os.path.join(self.directory, key + ".json"), "w") as f:
+            json.dump({
+                "request": f"{method} {path}?{query}",
+                "status": response.status_code,
+                "headers": response_headers,
+            }, f, indent=1)
+        return response.status_code, response_headers, response.content
+
+
+class Replay_server(Fake_server):
+    """ Serves the fixtures saved by a `Recording_server`, with the latency
+    and error injection of `Fake_server`. Unrecorded requests get a 404. """
+    def __init__(self, directory=FIXTURES_DIR, **kwargs):
+        self.directory = directory
+        self.n_missing = 0
+        super().__init__(**kwargs)
+
+    def respond(self, method, path, params, headers, body):
+        query = urllib.parse.urlencode(params, doseq=True)
+        key = fixture_key(method, path, query, body)
+        try:
+            with open(os.path.join(self.directory, key + ".json"), "r") as f:
+                fixture = json.load(f)
+            with open(os.path.join(self.directory, key + ".body"), "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            with self.lock:
+                self.n_missing += 1
+            return 404, {}, f"no fixture for {method} {path}?{query}"
+        return fixture["status"], fixture["headers"], content
+
+
+def main():
+    parser = argparse.ArgumentParser(description="record or replay API responses")
+    parser.add_argument("mode", choices=["record", "replay"])
+    parser.add_argument("--upstream", help="address of the real API, to record")
+    parser.add_argument("--directory", default=FIXTURES_DIR)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.)
+    parser.add_argument("--error-rate", type=float, default=0.)
+    args = parser.parse_args()
+
+    if args.mode == "record":
+        if args.upstream is None:
+            parser.error("record needs --upstream, like http://oqmd.org")
+        server = Recording_server(args.upstream, args.directory, port=args.port)
+    else:
+        server = Replay_server(
+            args.directory, port=args.port, latency=args.latency, error_rate=args.error_rate
+        )
+    print(f"{args.mode}ing at {server.url}, interrupt to stop")
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
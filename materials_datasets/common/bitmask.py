@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import re
+
+import numpy as np
+
+from common.elements import ATOMIC_NUMBERS
+
+# bit Z-1 of the 128 bit mask of a material is set if it contains the element
+# Z; bits 0 to 63 are in the first column, bits 64 to 127 in the second
+MASK_COLUMNS = ("elements_mask_lo", "elements_mask_hi")
+SYMBOL = re.compile(r"[A-Z][a-z]?")
+
+
+def element_masks(matrix):
+    """ (lo, hi) uint64 arrays of the element masks of the rows of a
+    composition matrix (see `common.formula.composition_matrix`); invalid or
+    missing formulas have an empty mask """
+    matrix = matrix.tocsr()
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    indices = matrix.indices.astype(np.uint64)
+    nonzero = matrix.data != 0
+    masks = []
+    for low, high in [(0, 64), (64, 128)]:
+        mask = np.zeros(matrix.shape[0], dtype=np.uint64)
+        selected = nonzero & (indices >= low) & (indices < high)
+        bits = np.left_shift(np.uint64(1), indices[selected] - np.uint64(low))
+        np.bitwise_or.at(mask, rows[selected], bits)
+        masks.append(mask)
+    return tuple(masks)
+
+
+def add_mask_columns(df, matrix):
+    """ add the element masks of `matrix` (one row per row of `df`) to `df`
+    as the two uint64 columns MASK_COLUMNS """
+    lo, hi = element_masks(matrix)
+    df[MASK_COLUMNS[0]] = lo
+    df[MASK_COLUMNS[1]] = hi
+    return df
+
+
+def set_mask(elements):
+    """ (lo, hi) mask of a set of elements, given as symbols or as a string
+    like "Li-Fe-P-O", "LiFePO" or "Li Fe P O" """
+    if isinstance(elements, str):
+        elements = SYMBOL.findall(elements)
+    lo, hi = 0, 0
+    for symbol in elements:
+        if symbol not in ATOMIC_NUMBERS:
+            raise ValueError(f"unknown element {symbol}")
+        index = ATOMIC_NUMBERS[symbol] - 1
+        if index < 64:
+            lo |= 1 << index
+        else:
+            hi |= 1 << (index - 64)
+    return np.uint64(lo), np.uint64(hi)
+
+
+def select(df, exact=None, subset=None, superset=None, include=None, exclude=None):
+    """ boolean array of the rows of `df` (with the MASK_COLUMNS) whose set
+    of elements is
+    - `exact`: exactly these elements
+    - `subset`: made of these elements only, like the chemical system
+    "Li-Fe-P-O" and its subsystems
+    - `superset`: contains all these elements, and maybe others
+    - `include`: contains at least one of these elements
+    - `exclude`: contains none of these elements
+    where each set is given as in `set_mask`. Conditions combine with and.
+    Rows with an empty mask (invalid formulas) are never selected.
+
+        lifepo = select(mpdf, subset="Li-Fe-P-O", include="Li")
+    """
+    lo = df[MASK_COLUMNS[0]].to_numpy(dtype=np.uint64)
+    hi = df[MASK_COLUMNS[1]].to_numpy(dtype=np.uint64)
+    selected = (lo | hi) != 0
+    if exact is not None:
+        m_lo, m_hi = set_mask(exact)
+        selected &= (lo == m_lo) & (hi == m_hi)
+    if subset is not None:
+        m_lo, m_hi = set_mask(subset)
+        selected &= ((lo & ~m_lo) | (hi & ~m_hi)) == 0
+    if superset is not None:
+        m_lo, m_hi = set_mask(superset)
+        selected &= ((lo & m_lo) == m_lo) & ((hi & m_hi) == m_hi)
+    if include is not None:
+        m_lo, m_hi = set_mask(include)
+        selected &= ((lo & m_lo) | (hi & m_hi)) != 0
+    if exclude is not None:
+        m_lo, m_hi = set_mask(exclude)
+        selected &= ((lo & m_lo) | (hi & m_hi)) == 0
+    return selected
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import os
+import zlib
+import mmap
+
+import numpy as np
+
+
+class Blob_writer:
+    """ Writes compressed blobs one after another in a single file.
+
+    Each blob is compressed on its own, so any one of them can be read back
+    without the others. The keys and the offsets of the blobs in the file are
+    saved in an index next to it when the writer is closed. Files are
+    `path + ".bin"` and `path + ".idx.npz"`.
+    """
+    def __init__(self, path, level=6):
+        self.path = str(path)
+        self.level = level
+        self.file = open(self.path + ".bin.tmp", "wb")
+        self.keys = []
+        self.offsets = [0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, key, data):
+        if isinstance(data, str):
+            data = data.encode()
+        compressed = zlib.compress(data, self.level)
+        self.file.write(compressed)
+        self.keys.append(key)
+        self.offsets.append(self.offsets[-1] + len(compressed))
+
+    def close(self):
+        self.file.close()
+        os.replace(self.path + ".bin.tmp", self.path + ".bin")
+        with open(self.path + ".idx.npz.tmp", "wb") as f:
+            np.savez(
+                f,
+                keys=np.array(self.keys, dtype=str),
+                offsets=np.array(self.offsets, dtype=np.int64),
+            )
+        os.replace(self.path + ".idx.npz.tmp", self.path + ".idx.npz")
+
+
+class Blob_reader:
+    """ Random access, by key, to the blobs written by a `Blob_writer`.
+
+    The blob file is memory-mapped, so only the blobs that are read are
+    loaded (and kept in the page cache by the operating system).
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        with np.load(self.path + ".idx.npz") as index:
+            self.keys = index["keys"]
+            self.offsets = index["offsets"]
+        self.positions = {key: i for i, key in enumerate(self.keys.tolist())}
+        self.file = open(self.path + ".bin", "rb")
+        if self.offsets[-1] > 0:
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.buffer = b""  # empty files cannot be mapped
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.file.close()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def get_at(self, position):
+        start, stop = self.offsets[position], self.offsets[position+1]
+        return zlib.decompress(self.buffer[start:stop])
+
+    def get(self, key):
+        return self.get_at(self.positions[key])
+
+
+def train_dictionary(samples, size=2**15, min_count=2):
+    """ zlib preset dictionary (at most `size` bytes, zlib's window) made of
+    the lines most frequent in `samples` (strings or bytes), weighted by
+    their length. The most useful lines are put last, closest to the data. """
+    counts = {}
+    for sample in samples:
+        if isinstance(sample, str):
+            sample = sample.encode()
+        for line in set(sample.split(b"\n")):
+            counts[line] = counts.get(line, 0) + 1
+    ranked = sorted(
+        (line for line, count in counts.items() if count >= min_count and line),
+        key=lambda line: counts[line]*(len(line)+1),
+        reverse=True,
+    )
+    chosen = []
+    total = 0
+    for line in ranked:
+        if total + len(line) + 1 > size:
+            continue
+        chosen.append(line)
+        total += len(line) + 1
+    return b"".join(line + b"\n" for line in reversed(chosen))
+
+
+class Dict_blob_writer(Blob_writer):
+    """ `Blob_writer` for many small, similar blobs (like cifs).
+
+    Blobs are compressed with a preset dictionary shared by all of them (see
+    `train_dictionary`), so the boilerplate they have in common is not paid
+    for in each blob. The dictionary is saved in the index.
+    """
+    def __init__(self, path, dictionary, level=9):
+        super().__init__(path, level)
+        self.dictionary = dictionary
+
+    def add(self, key, data):
+        if isinstance(data, str):
+            data = data.encode()
+        compressor = zlib.compressobj(self.level, zdict=self.dictionary)
+        compressed = compressor.compress(data) + compressor.flush()
+        self.file.write(compressed)
+        self.keys.append(key)
+        self.offsets.append(self.offsets[-1] + len(compressed))
+
+    def close(self):
+        self.file.close()
+        os.replace(self.path + ".bin.tmp", self.path + ".bin")
+        with open(self.path + ".idx.npz.tmp", "wb") as f:
+            np.savez(
+                f,
+                keys=np.array(self.keys, dtype=str),
+                offsets=np.array(self.offsets, dtype=np.int64),
+                dictionary=np.frombuffer(self.dictionary, dtype=np.uint8),
+            )
+        os.replace(self.path + ".idx.npz.tmp", self.path + ".idx.npz")
+
+
+class Dict_blob_reader(Blob_reader):
+    """ Random access, by key or by position (in the order the keys were
+    added), to the blobs written by a `Dict_blob_writer` """
+    def __init__(self, path):
+        super().__init__(path)
+        with np.load(self.path + ".idx.npz") as index:
+            self.dictionary = index["dictionary"].tobytes()
+
+    def get_at(self, position):
+        start, stop = self.offsets[position], self.offsets[position+1]
+        decompressor = zlib.decompressobj(zdict=self.dictionary)
+        return decompressor.decompress(self.buffer[start:stop]) + decompressor.flush()
+
+    def get_range(self, start, stop):
+        """ the blobs at positions start to stop, decoded as strings """
+        return [self.get_at(position).decode() for position in range(start, stop)]
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self.get_at(position).decode()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+
+
+class Column:
+    """ One preallocated, array-backed column of a `Column_buffers`.
+
+    The kind of the column is set by its first non-null value: `int` (int64
+    with a validity mask), `float` (float64, NaN for null), `bool` (int8, -1
+    for null), `str` (int32 codes into a dictionary of unique strings, -1 for
+    null, given back as objects) or `object` (anything else, like lists). An int column receiving a
+    float becomes a float column, and a column receiving values of
+    incompatible kinds falls back to `object`.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.kind = None
+        self.values = None
+        self.valid = None
+        self.vocabulary = {}
+
+    @staticmethod
+    def kind_of(value):
+        if isinstance(value, bool):
+            return "bool"
+        if isinstance(value, int):
+            return "int"
+        if isinstance(value, float):
+            return "float"
+        if isinstance(value, str):
+            return "str"
+        return "object"
+
+    def allocate(self, kind, capacity):
+        if kind == "int":
+            self.values = np.zeros(capacity, dtype=np.int64)
+            self.valid = np.zeros(capacity, dtype=bool)
+        elif kind == "float":
+            self.values = np.full(capacity, np.nan, dtype=np.float64)
+        elif kind == "bool":
+            self.values = np.full(capacity, -1, dtype=np.int8)
+        elif kind == "str":
+            self.values = np.full(capacity, -1, dtype=np.int32)
+        else:
+            self.values = [None] * capacity
+        self.kind = kind
+
+    def grow(self, capacity):
+        old_values, old_valid, n = self.values, self.valid, self.capacity
+        self.allocate(self.kind, capacity)
+        self.values[:n] = old_values
+        if old_valid is not None:
+            self.valid[:n] = old_valid
+        self.capacity = capacity
+
+    def reserve(self, n_rows):
+        if self.kind is not None and n_rows > self.capacity:
+            self.grow(n_rows)
+
+    def convert(self, kind, n_rows):
+        """ change the kind of the column, keeping its first `n_rows` values """
+        old_values = self.to_list(n_rows)
+        self.vocabulary = {}
+        self.allocate(kind, self.capacity)
+        for row, value in enumerate(old_values):
+            if value is not None:
+                self.set(row, value, n_rows)
+
+    def set(self, row, value, n_rows):
+        kind = self.kind_of(value)
+        if self.kind is None:
+            self.allocate(kind, self.capacity)
+        elif kind != self.kind:
+            if self.kind == "int" and kind == "float":
+                self.convert("float", n_rows)
+            elif not (self.kind == "float" and kind == "int"):
+                if self.kind != "object":
+                    self.convert("object", n_rows)
+        if row >= self.capacity:
+            self.grow(max(2*self.capacity, row+1))
+
+        if self.kind == "int":
+            self.values[row] = value
+            self.valid[row] = True
+        elif self.kind == "str":
+            self.values[row] = self.code(value)
+        else:
+            self.values[row] = value
+
+    def code(self, string):
+        code = self.vocabulary.get(string)
+        if code is None:
+            code = self.vocabulary[string] = len(self.vocabulary)
+        return code
+
+    def extend(self, other, n_rows, n_other):
+        """ copy the first `n_other` values of `other` after row `n_rows` """
+        if other.kind is None:
+            return
+        other.reserve(n_other)
+        if self.kind is None:
+            self.allocate(other.kind, self.capacity)
+        if n_rows + n_other > self.capacity:
+            self.grow(max(2*self.capacity, n_rows+n_other))
+
+        new_rows = slice(n_rows, n_rows+n_other)
+        if self.kind == other.kind and self.kind != "object":
+            if self.kind == "str":
+                codes = other.values[:n_other]
+                mapping = np.array([self.code(s) for s in other.vocabulary] + [-1], dtype=np.int32)
+                self.values[new_rows] = mapping[codes]  # code -1 maps to the last entry, -1
+            else:
+                self.values[new_rows] = other.values[:n_other]
+                if self.kind == "int":
+                    self.valid[new_rows] = other.valid[:n_other]
+        else:
+            for row, value in enumerate(other.to_list(n_other)):
+                if value is not None:
+                    self.set(n_rows+row, value, n_rows+row)
+
+    def to_list(self, n_rows):
+        if self.kind is None:
+            return [None] * n_rows
+        self.reserve(n_rows)
+        if self.kind == "object":
+            return self.values[:n_rows]
+        if self.kind == "str":
+            strings = list(self.vocabulary)
+            return [strings[c] if c >= 0 else None for c in self.values[:n_rows]]
+        if self.kind == "int":
+            return [
+                int(v) if ok else None
+                for v, ok in zip(self.values[:n_rows], self.valid[:n_rows])
+            ]
+        if self.kind == "bool":
+            return [bool(v) if v >= 0 else None for v in self.values[:n_rows]]
+        return [None if np.isnan(v) else float(v) for v in self.values[:n_rows]]
+
+    def to_array(self, n_rows):
+        """ the first `n_rows` values as a numpy or pandas array """
+        if self.kind is None or self.kind == "object":
+            array = np.empty(n_rows, dtype=object)
+            array[:] = self.to_list(n_rows)
+            return array
+        self.reserve(n_rows)
+        values = self.values[:n_rows]
+        if self.kind == "float":
+            return values
+        if self.kind == "int":
+            valid = self.valid[:n_rows]
+            if valid.all():
+                return values
+            return pd.arrays.IntegerArray(values, ~valid)
+        if self.kind == "bool":
+            if (values >= 0).all():
+                return values.astype(bool)
+            return pd.arrays.BooleanArray(values > 0, values < 0)
+        strings = np.empty(len(self.vocabulary)+1, dtype=object)
+        strings[:-1] = list(self.vocabulary)
+        strings[-1] = None  # code -1
+        return strings[values]
+
+
+class Column_buffers:
+    """ Column-oriented accumulator of records.
+
+    Records are scattered into preallocated typed `Column` arrays as they are
+    appended, instead of being kept as a list of dictionaries, and are
+    assembled into a DataFrame only once with `to_dataframe`. Missing keys are
+    null, and the capacity doubles when exceeded.
+    """
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.n_rows = 0
+        self.columns = {}
+
+    def __len__(self):
+        return self.n_rows
+
+    def append(self, record):
+        row = self.n_rows
+        if row >= self.capacity:
+            self.capacity *= 2
+        for name, value in record.items():
+            column = self.columns.get(name)
+            if column is None:
+                column = self.columns[name] = Column(self.capacity)
+            if value is not None:
+                column.set(row, value, row)
+        self.n_rows += 1
+
+    def extend(self, other):
+        """ append all the rows of another `Column_buffers`, column by column """
+        while self.n_rows + other.n_rows > self.capacity:
+            self.capacity *= 2
+        for name, other_column in other.columns.items():
+            column = self.columns.get(name)
+            if column is None:
+                column = self.columns[name] = Column(self.capacity)
+            column.extend(other_column, self.n_rows, other.n_rows)
+        self.n_rows += other.n_rows
+
+    def to_dataframe(self):
+        # strings stay object columns, as in the .pkl files, whatever the
+        # string dtype the version of pandas would infer
+        return pd.DataFrame({
+            name: object_series(column.to_array(self.n_rows))
+            for name, column in self.columns.items()
+        })
+
+
+def object_series(array):
+    if array.dtype == object:
+        return pd.Series(array, dtype=object)
+    return array
@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+
+# chemical symbols ordered by atomic number, ELEMENTS[Z-1] is the element Z
+ELEMENTS = (
+    'H','He','Li','Be','B','C','N','O','F','Ne','Na','Mg','Al','Si','P','S',
+    'Cl','Ar','K','Ca','Sc','Ti','V','Cr','Mn','Fe','Co','Ni','Cu','Zn','Ga',
+    'Ge','As','Se','Br','Kr','Rb','Sr','Y','Zr','Nb','Mo','Tc','Ru','Rh','Pd',
+    'Ag','Cd','In','Sn','Sb','Te','I','Xe','Cs','Ba','La','Ce','Pr','Nd','Pm',
+    'Sm','Eu','Gd','Tb','Dy','Ho','Er','Tm','Yb','Lu','Hf','Ta','W','Re','Os',
+    'Ir','Pt','Au','Hg','Tl','Pb','Bi','Po','At','Rn','Fr','Ra','Ac','Th','Pa',
+    'U','Np','Pu','Am','Cm','Bk','Cf','Es','Fm','Md','No','Lr','Rf','Db','Sg',
+    'Bh','Hs','Mt','Ds','Rg','Cn','Nh','Fl','Mc','Lv','Ts','Og',
+)
+N_ELEMENTS = len(ELEMENTS)
+
+ATOMIC_NUMBERS = {symbol: Z for Z, symbol in enumerate(ELEMENTS, start=1)}
+ATOMIC_NUMBERS['D'] = 1  # deuterium and tritium, found in ICSD
+ATOMIC_NUMBERS['T'] = 1
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+import re
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from common.elements import ELEMENTS, N_ELEMENTS, ATOMIC_NUMBERS
+
+
+# an element, an amount, or an opening or closing bracket
+FORMULA_TOKEN = re.compile(
+    r"\s*(?:([A-Z][a-z]?)|(\d+(?:\.\d*)?|\.\d+)|([(\[{])|([)\]}]))\s*"
+)
+
+
+def read_amount(formula, pos):
+    match = FORMULA_TOKEN.match(formula, pos)
+    if match is not None and match.group(2) is not None:
+        return float(match.group(2)), match.end()
+    return 1., pos
+
+
+@lru_cache(maxsize=None)
+def parse_formula_indices(formula):
+    """ parse a formula like "Cl1Na1", "NaCl", "Ca(CO3)" or "(Mg0.5Fe0.5)2SiO4"
+    into a sorted tuple of column indices (atomic number - 1) and a tuple of
+    their amounts. Cached by formula string. Raises ValueError if invalid.
+    """
+    stack = [{}]
+    pos = 0
+    while pos < len(formula):
+        match = FORMULA_TOKEN.match(formula, pos)
+        if match is None or match.end() == pos:
+            raise ValueError(f"{formula} is an invalid formula")
+        element, number, opening, closing = match.groups()
+        pos = match.end()
+        if element is not None:
+            if element not in ATOMIC_NUMBERS:
+                raise ValueError(f"{formula} contains an unknown element {element}")
+            amount, pos = read_amount(formula, pos)
+            index = ATOMIC_NUMBERS[element] - 1
+            stack[-1][index] = stack[-1].get(index, 0.) + amount
+        elif opening is not None:
+            stack.append({})
+        elif closing is not None:
+            if len(stack) == 1:
+                raise ValueError(f"{formula} has unbalanced brackets")
+            group = stack.pop()
+            amount, pos = read_amount(formula, pos)
+            for index, group_amount in group.items():
+                stack[-1][index] = stack[-1].get(index, 0.) + group_amount*amount
+        else:
+            raise ValueError(f"{formula} has an amount {number} without element")
+    if len(stack) != 1:
+        raise ValueError(f"{formula} has unbalanced brackets")
+    indices = tuple(sorted(stack[0]))
+    return indices, tuple(stack[0][i] for i in indices)
+
+
+def parse_formula(formula):
+    """ {symbol: amount} of a formula string """
+    indices, amounts = parse_formula_indices(formula)
+    return {ELEMENTS[i]: amount for i, amount in zip(indices, amounts)}
+
+
+def formula_string(formula):
+    """ formulas given as dictionaries (like MP's `unit_cell_formula`) are
+    turned into strings so they can share the cache """
+    if isinstance(formula, dict):
+        return "".join(f"{symbol}{amount}" for symbol, amount in formula.items())
+    return formula
+
+
+def composition_matrix(formulas):
+    """ sparse matrix (CSR) of the amount of each element (columns, atomic
+    number - 1) in each formula (rows). Formulas may be strings or
+    dictionaries. Each distinct formula is parsed once; rows of invalid or
+    missing formulas are empty.
+    """
+    formulas = pd.Series(formulas).map(formula_string, na_action="ignore")
+    codes, uniques = pd.factorize(formulas)
+
+    indptr = [0]
+    indices = []
+    data = []
+    for formula in uniques:
+        try:
+            formula_indices, amounts = parse_formula_indices(formula)
+        except (ValueError, TypeError):
+            formula_indices, amounts = (), ()
+        indices.extend(formula_indices)
+        data.extend(amounts)
+        indptr.append(len(indices))
+    indptr.append(len(indices))
+    unique_matrix = sparse.csr_matrix(
+        (np.array(data, dtype=np.float64), np.array(indices, dtype=np.int32), indptr),
+        shape=(len(uniques)+1, N_ELEMENTS),  # last row is empty, for missing formulas
+    )
+    codes = np.where(codes < 0, len(uniques), codes)
+    return unique_matrix[codes]
+
+
+def n_elements(matrix):
+    return matrix.getnnz(axis=1)
+
+
+def is_valid(matrix):
+    """ rows with at least one element """
+    return n_elements(matrix) > 0
+
+
+def is_stoichiometric(matrix, tol=1e-6):
+    """ rows whose amounts are all integers """
+    fractional = matrix.copy()
+    fractional.data = (np.abs(fractional.data - np.round(fractional.data)) > tol).astype(np.float64)
+    fractional.eliminate_zeros()
+    return is_valid(matrix) & (n_elements(fractional) == 0)
+
+
+def normalize(matrix):
+    """ rows scaled to sum to one (atomic fractions) """
+    totals = np.asarray(matrix.sum(axis=1)).ravel()
+    scale = np.divide(1., totals, out=np.zeros_like(totals), where=totals != 0)
+    return sparse.diags(scale) @ matrix
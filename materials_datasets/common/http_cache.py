@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+import urllib.parse
+
+# query parameters which do not change the response (credentials)
+IGNORED_PARAMS = {"token", "auth_token", "api_key"}
+# response headers kept with the body
+KEPT_HEADERS = {"content-type", "etag", "last-modified"}
+
+
+def normalize_url(url, ignored_params=IGNORED_PARAMS):
+    """ url with a lower case scheme and host, the query parameters sorted
+    and the `ignored_params` removed, so equivalent urls share an entry """
+    parts = urllib.parse.urlsplit(url)
+    params = sorted(
+        (name, value)
+        for name, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        if name not in ignored_params
+    )
+    return urllib.parse.urlunsplit((
+        parts.scheme.lower(),
+        parts.netloc.lower(),
+        parts.path,
+        urllib.parse.urlencode(params),
+        "",
+    ))
+
+
+def cache_key(url):
+    return hashlib.sha256(normalize_url(url).encode()).hexdigest()
+
+
+def response_encoding(headers):
+    content_type = {k.lower(): v for k, v in headers.items()}.get("content-type", "")
+    if "charset=" in content_type:
+        return content_type.split("charset=")[-1].split(";")[0].strip()
+    return None
+
+
+class Cached_response:
+    """ The part of `requests.Response` used by the downloaders, for a body
+    served from an `HTTP_cache` (fresh entry or 304). The body is kept
+    compressed, and decompressed as it is iterated. """
+    def __init__(self, url, status_code, headers, compressed):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.compressed = compressed
+        self.from_cache = True
+        self.encoding = response_encoding(headers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    def commit(self):
+        """ already in the cache """
+
+    @property
+    def content(self):
+        return zlib.decompress(self.compressed)
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+    def iter_content(self, chunk_size=2**16):
+        decompressor = zlib.decompressobj()
+        for start in range(0, len(self.compressed), chunk_size):
+            chunk = decompressor.decompress(self.compressed[start:start+chunk_size])
+            if chunk:
+                yield chunk
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+
+class Caching_response:
+    """ A streamed `requests.Response` from the server, compressed as it is
+    read, and stored in the cache only when the caller, having checked the
+    body, calls `commit` (and only if it was a 200 read to the end), so an
+    incomplete or invalid body is never served again. """
+    def __init__(self, cache, url, response):
+        self.cache = cache
+        self.url = url
+        self.response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.encoding = response.encoding
+        self.from_cache = False
+        self.compressor = zlib.compressobj(cache.level)
+        self.compressed = []
+        self.complete = False
+        self.body = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.response.close()
+
+    def iter_content(self, chunk_size=2**16):
+        for chunk in self.response.iter_content(chunk_size):
+            self.compressed.append(self.compressor.compress(chunk))
+            yield chunk
+        self.compressed.append(self.compressor.flush())
+        self.complete = True
+
+    @property
+    def content(self):
+        if self.body is None:
+            self.body = b"".join(self.iter_content())
+        return self.body
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+    def commit(self):
+        if self.status_code == 200 and self.complete:
+            self.cache.store_compressed(self.url, self.headers, b"".join(self.compressed))
+
+
+class HTTP_cache:
+    """ On-disk cache of GET responses, shared by the downloaders.
+
+    Entries are keyed by normalized url (see `normalize_url`; tokens sent as
+    headers, like ICSD's, are never part of the key) and hold the zlib
+    compressed body, with its ETag and Last-Modified. An entry younger than
+    `fresh_for` seconds is served without any request; an older one is
+    revalidated with a conditional request when the server gave a validator
+    (a 304 serves the stored body), and downloaded again otherwise. Bodies
+    from the server are only stored once the caller `commit`s them (see
+    `get`), and only 200 responses. The least recently used entries are evicted when
+    the compressed bodies exceed `max_bytes`. Thread-safe, and with `wal`
+    fast for the processes of one machine; WAL does not work across machines
+    on a network filesystem, so workers on several machines each use their
+    own cache with `wal` False.
+    """
+    def __init__(self, path, max_bytes=2**33, fresh_for=30*24*3600, level=6, wal=True):
+        self.max_bytes = max_bytes
+        self.fresh_for = fresh_for
+        self.level = level
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        self.connection.execute(f"PRAGMA journal_mode={'WAL' if wal else 'DELETE'}")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, url TEXT, headers TEXT, etag TEXT,"
+            " last_modified TEXT, body BLOB, size INTEGER, stored REAL, accessed REAL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+        )
+        self.connection.commit()
+        self.total_bytes = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def lookup(self, url):
+        """ (entry, fresh) where entry is None or a dictionary with the
+        `headers`, `etag`, `last_modified` and `stored` time of the cached
+        response of `url` (without its body, see `body`) """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT headers, etag, last_modified, stored FROM responses WHERE key = ?",
+                (cache_key(url),),
+            ).fetchone()
+        if row is None:
+            return None, False
+        entry = {
+            "headers": json.loads(row[0]),
+            "etag": row[1],
+            "last_modified": row[2],
+            "stored": row[3],
+        }
+        return entry, time.time() - entry["stored"] < self.fresh_for
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry is not None:
+            if entry["etag"] is not None:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"] is not None:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def compressed_body(self, url, revalidated=False):
+        """ the compressed body of `url`, marked as used (and, if
+        `revalidated`, as fresh again). None if it was evicted meanwhile. """
+        key = cache_key(url)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT body FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if revalidated:
+                self.connection.execute(
+                    "UPDATE responses SET accessed = ?, stored = ? WHERE key = ?", (now, now, key)
+                )
+                self.revalidated += 1
+            else:
+                self.connection.execute(
+                    "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+                )
+                self.hits += 1
+            self.connection.commit()
+        return row[0]
+
+    def body(self, url, revalidated=False):
+        compressed = self.compressed_body(url, revalidated)
+        return None if compressed is None else zlib.decompress(compressed)
+
+    def store(self, url, headers, content):
+        """ store the body of a 200 response to `url` """
+        self.store_compressed(url, headers, zlib.compress(content, self.level))
+
+    def store_compressed(self, url, headers, compressed):
+        """ store the zlib compressed body of a 200 response to `url`, and
+        evict the least recently used entries if the cache is over `max_bytes` """
+        headers = {k: v for k, v in headers.items() if k.lower() in KEPT_HEADERS}
+        lower = {k.lower(): v for k, v in headers.items()}
+        key = cache_key(url)
+        now = time.time()
+        with self.lock:
+            old = self.connection.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key, normalize_url(url), json.dumps(headers),
+                    lower.get("etag"), lower.get("last-modified"),
+                    compressed, len(compressed), now, now,
+                ),
+            )
+            self.total_bytes += len(compressed) - (old[0] if old else 0)
+            self.misses += 1
+            self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes:
+            rows = self.connection.execute(
+                "SELECT key, size FROM responses ORDER BY accessed LIMIT 100"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+    def get(self, session, url, headers=None, **kwargs):
+        """ GET `url` with `session` (a `requests.Session`, or the `requests`
+        module) through the cache. Returns a `Cached_response`, or a
+        `Caching_response` streamed from the server: read it (`iter_content`
+        keeps only the compressed body in memory), check it, and `commit` it
+        to store it. Responses other than 200 and 304 are never stored. """
+        entry, fresh = self.lookup(url)
+        if fresh:
+            compressed = self.compressed_body(url)
+            if compressed is not None:
+                return Cached_response(url, 200, entry["headers"], compressed)
+
+        kwargs["stream"] = True
+        response = session.get(
+            url, headers={**(headers or {}), **self.conditional_headers(entry)}, **kwargs
+        )
+        if response.status_code == 304:
+            response.close()
+            compressed = self.compressed_body(url, revalidated=True)
+            if compressed is not None:
+                return Cached_response(url, 200, entry["headers"], compressed)
+            response = session.get(url, headers=headers, **kwargs)  # evicted meanwhile
+        return Caching_response(self, url, response)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 120., 300., float("inf")]
+PROMETHEUS_PREFIX = "materials_datasets"
+
+
+class Endpoint_metrics:
+    """ counters of one endpoint, as in a Prometheus histogram: cumulative
+    counts are only computed when exported """
+    def __init__(self):
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.
+        self.statuses = {}
+        self.bytes = 0
+        self.retries = 0
+        self.relogins = 0
+        self.rows = 0
+
+    @property
+    def n_requests(self):
+        return sum(self.bucket_counts)
+
+    @property
+    def n_errors(self):
+        return sum(
+            n for status, n in self.statuses.items()
+            if not (status.startswith("2") or status in ("ok", "cache"))
+        )
+
+    def quantile(self, q):
+        """ upper bound of the bucket holding the quantile `q` of latency """
+        target = q * self.n_requests
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.bucket_counts):
+            cumulative += count
+            if cumulative >= target and cumulative > 0:
+                return bound
+        return float("nan")
+
+
+class Metrics:
+    """ Per-endpoint request metrics shared by the downloaders.
+
+    The downloaders report every request (latency, status code, bytes), the
+    retries, re-logins and rows received to the module-level `METRICS`.
+    Once `open` is called, each event is also appended as a json line to
+    `log_path`, and the totals are written in the Prometheus text format to
+    `prometheus_path` (for node_exporter's textfile collector) at most every
+    `interval` seconds and on `close`. `summary` gives a table for the end of
+    a run. Thread-safe.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.start = time.time()
+        self.log = None
+        self.prometheus_path = None
+        self.interval = 30.
+        self.last_export = 0.
+
+    def open(self, log_path=None, prometheus_path=None, interval=30.):
+        self.close()
+        with self.lock:
+            self.endpoints = {}
+            self.start = time.time()
+            if log_path is not None:
+                self.log = open(log_path, "a", buffering=1)  # line buffered
+            self.prometheus_path = prometheus_path
+            self.interval = interval
+        return self
+
+    def close(self):
+        if self.prometheus_path is not None:
+            self.write_prometheus()
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+
+    def endpoint(self, name):
+        metrics = self.endpoints.get(name)
+        if metrics is None:
+            metrics = self.endpoints[name] = Endpoint_metrics()
+        return metrics
+
+    def record(self, event, endpoint, **fields):
+        if self.log is not None:
+            self.log.write(json.dumps(
+                {"time": round(time.time(), 3), "event": event, "endpoint": endpoint, **fields}
+            ) + "\n")
+        if self.prometheus_path is not None and time.time() - self.last_export > self.interval:
+            self.last_export = time.time()
+            self.write_prometheus(locked=True)
+
+    def request(self, endpoint, seconds, status, n_bytes=0):
+        """ one request to `endpoint`; `status` is the http status code,
+        "cache" if served from the http cache, or the name of the exception
+        if there was no response """
+        status = str(status)
+        with self.lock:
+            metrics = self.endpoint(endpoint)
+            bucket = next(i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound)
+            metrics.bucket_counts[bucket] += 1
+            metrics.latency_sum += seconds
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+            metrics.bytes += n_bytes
+            self.record("request", endpoint, status=status, seconds=round(seconds, 4), bytes=n_bytes)
+
+    @contextmanager
+    def timed(self, endpoint):
+        """ records a request timed by the `with` block. Set `status` (and
+        `bytes`) in the yielded dictionary as soon as the response arrives;
+        an exception raised before is recorded with the name of its type as
+        status. """
+        info = {"status": None, "bytes": 0}
+        timer_start = time.time()
+        try:
+            yield info
+        except BaseException as exc:
+            if info["status"] is None:
+                info["status"] = type(exc).__name__
+            raise
+        finally:
+            status = "ok" if info["status"] is None else info["status"]
+            self.request(endpoint, time.time()-timer_start, status, info["bytes"])
+
+    def retry(self, endpoint, n=1):
+        with self.lock:
+            self.endpoint(endpoint).retries += n
+            self.record("retry", endpoint, n=n)
+
+    def relogin(self, endpoint):
+        with self.lock:
+            self.endpoint(endpoint).relogins += 1
+            self.record("relogin", endpoint)
+
+    def rows(self, endpoint, n):
+        with self.lock:
+            self.endpoint(endpoint).rows += n
+            self.record("rows", endpoint, n=n)
+
+    def prometheus_text(self):
+        elapsed = max(time.time() - self.start, 1e-9)
+        p = PROMETHEUS_PREFIX
+        lines = [
+            f"# HELP {p}_request_seconds Latency of the requests, until the response is read.",
+            f"# TYPE {p}_request_seconds histogram",
+        ]
+        for name, metrics in sorted(self.endpoints.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, metrics.bucket_counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{p}_request_seconds_bucket{{endpoint="{name}",le="{le}"}} {cumulative}')
+            lines.append(f'{p}_request_seconds_sum{{endpoint="{name}"}} {metrics.latency_sum}')
+            lines.append(f'{p}_request_seconds_count{{endpoint="{name}"}} {cumulative}')
+
+        lines += [f"# TYPE {p}_responses_total counter"]
+        for name, metrics in sorted(self.endpoints.items()):
+            for status, count in sorted(metrics.statuses.items()):
+                lines.append(f'{p}_responses_total{{endpoint="{name}",status="{status}"}} {count}')
+
+        for metric, kind, attribute in [
+            ("response_bytes_total", "counter", "bytes"),
+            ("retries_total", "counter", "retries"),
+            ("relogins_total", "counter", "relogins"),
+            ("rows_total", "counter", "rows"),
+        ]:
+            lines.append(f"# TYPE {p}_{metric} {kind}")
+            for name, metrics in sorted(self.endpoints.items()):
+                lines.append(f'{p}_{metric}{{endpoint="{name}"}} {getattr(metrics, attribute)}')
+
+        lines.append(f"# TYPE {p}_rows_per_second gauge")
+        for name, metrics in sorted(self.endpoints.items()):
+            lines.append(f'{p}_rows_per_second{{endpoint="{name}"}} {metrics.rows/elapsed}')
+        lines.append(f"# TYPE {p}_last_update_seconds gauge")
+        lines.append(f"{p}_last_update_seconds {time.time()}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path=None, locked=False):
+        """ write atomically, so the collector never reads half a file """
+        path = path or self.prometheus_path
+        if locked:
+            text = self.prometheus_text()
+        else:
+            with self.lock:
+                text = self.prometheus_text()
+        with open(path + ".tmp", "w") as f:
+            f.write(text)
+        os.replace(path + ".tmp", path)
+
+    def summary(self):
+        elapsed = time.time() - self.start
+        lines = [
+            f"{'endpoint':<22} {'requests':>9} {'errors':>7} {'p50 s':>6} {'p95 s':>6}"
+            f" {'MB':>9} {'retries':>8} {'relogins':>8} {'rows':>9} {'rows/s':>8}"
+        ]
+        with self.lock:
+            for name, metrics in sorted(self.endpoints.items()):
+                lines.append(
+                    f"{name:<22} {metrics.n_requests:>9} {metrics.n_errors:>7}"
+                    f" {metrics.quantile(0.5):>6} {metrics.quantile(0.95):>6}"
+                    f" {metrics.bytes/2**20:>9.1f} {metrics.retries:>8} {metrics.relogins:>8}"
+                    f" {metrics.rows:>9} {metrics.rows/elapsed:>8.1f}"
+                )
+        lines.append(f"in {elapsed:.1f} s")
+        return "\n".join(lines)
+
+
+METRICS = Metrics()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import json
+import codecs
+
+
+WHITESPACE = " \t\n\r"
+
+
+class JSON_array_decoder:
+    """ Incremental decoder for the items of one array in a json document.
+
+    Bytes are given to `feed` as they arrive, and each item of the array found
+    under `key` (or of the top-level array if `key` is None) is yielded as soon
+    as it is complete, so only one item is ever held in memory besides the
+    unparsed tail of the input. The other top-level values of the document
+    (small ones, like `meta` or `links`) are kept in `self.other`.
+    """
+    def __init__(self, key="data"):
+        self.key = key
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.other = {}
+        self.current_key = None
+        # states: start, key, colon, value, item, item_sep, key_sep, done
+        self.state = "start"
+
+    def skip_whitespace(self):
+        while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+            self.pos += 1
+        return self.pos < len(self.buffer)
+
+    def raw_decode(self):
+        """ decode one complete value at self.pos, or return (False, None) if
+        the buffer ends before the value does """
+        try:
+            value, end = self.json_decoder.raw_decode(self.buffer, self.pos)
+        except json.JSONDecodeError:
+            return False, None
+        if end == len(self.buffer) and not isinstance(value, (dict, list, str)):
+            return False, None  # a number or literal may continue in the next chunk
+        self.pos = end
+        return True, value
+
+    def expect(self, char):
+        if self.buffer[self.pos] != char:
+            raise ValueError(
+                f"expected '{char}' at '{self.buffer[self.pos:self.pos+40]}'"
+            )
+        self.pos += 1
+
+    def feed(self, chunk):
+        """ generator of the array items completed by `chunk` (bytes or str) """
+        if isinstance(chunk, bytes):
+            chunk = self.text_decoder.decode(chunk)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        while self.state != "done" and self.skip_whitespace():
+            char = self.buffer[self.pos]
+            if self.state == "start":
+                if self.key is None:
+                    self.expect("[")
+                    self.state = "item"
+                else:
+                    self.expect("{")
+                    self.state = "key"
+            elif self.state == "key":
+                if char == "}":
+                    self.pos += 1
+                    self.state = "done"
+                    continue
+                complete, self.current_key = self.raw_decode()
+                if not complete:
+                    break
+                self.state = "colon"
+            elif self.state == "colon":
+                self.expect(":")
+                self.state = "value"
+            elif self.state == "value":
+                if self.current_key == self.key:
+                    self.expect("[")
+                    self.state = "item"
+                    continue
+                complete, value = self.raw_decode()
+                if not complete:
+                    break
+                self.other[self.current_key] = value
+                self.state = "key_sep"
+            elif self.state == "item":
+                if char == "]":
+                    self.pos += 1
+                    self.state = "key_sep" if self.key is not None else "done"
+                    continue
+                complete, item = self.raw_decode()
+                if not complete:
+                    break
+                yield item
+                self.state = "item_sep"
+            elif self.state == "item_sep":
+                if char == ",":
+                    self.pos += 1
+                    self.state = "item"
+                else:
+                    self.expect("]")
+                    self.state = "key_sep" if self.key is not None else "done"
+            elif self.state == "key_sep":
+                if char == ",":
+                    self.pos += 1
+                    self.state = "key"
+                else:
+                    self.expect("}")
+                    self.state = "done"
+
+    def close(self):
+        """ decode what remains and check that the document was complete """
+        yield from self.feed(self.text_decoder.decode(b"", final=True))
+        if self.state != "done":
+            raise ValueError(f"incomplete json document (state {self.state})")
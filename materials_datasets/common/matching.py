@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import hashlib
+import warnings
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+PARENT = Path(__file__).parent.parent
+MATCHES_DIR = PARENT/"datasets"/"matches"
+STRUCTURES_NPZ = {
+    "icsd": str(PARENT/"icsd"/"all_icsd_cifs_augmented_structures.npz"),
+    "mp": str(PARENT/"mp"/"structures.npz"),
+    "oqmd": str(PARENT/"oqmd"/"structures.npz"),
+}
+# (id column, space group column) in the parquet datasets, None to compute it
+SPACEGROUP_COLUMNS = {
+    "icsd": ("id", "_space_group_IT_number"),
+    "mp": ("material_id", "spacegroup_number"),
+    "oqmd": None,
+}
+
+sys.path.append(str(PARENT))
+from common.elements import N_ELEMENTS
+from common.formula import normalize
+from common.structures import Structure_arrays
+from common import storage
+
+VOLUME_TOLERANCE = 0.2  # relative difference of volume per atom, also the bin width
+FRACTION_DECIMALS = 3  # atomic fractions are rounded before hashing
+SYMPREC = 0.1  # for spglib, loose enough for experimental structures
+
+
+def structure_compositions(structures):
+    """ sparse matrix (CSR) of the amount of each element (columns, atomic
+    number - 1) in each structure (rows), partial occupancies included """
+    site_structure = np.repeat(np.arange(len(structures)), np.diff(structures.site_offsets))
+    rows = np.repeat(site_structure, np.diff(structures.species_offsets))
+    known = structures.species_Z > 0
+    matrix = sparse.csr_matrix(
+        (
+            structures.occupancy[known].astype(np.float64),
+            (rows[known], structures.species_Z[known].astype(np.int64) - 1),
+        ),
+        shape=(len(structures), N_ELEMENTS),
+    )
+    matrix.sum_duplicates()  # also sorts the indices
+    return matrix
+
+
+def composition_hashes(matrix):
+    """ int64 hash of the reduced composition (rounded atomic fractions) of
+    each row, equal for NaCl, Na2Cl2 and Na4Cl4 """
+    fractions = normalize(matrix).tocsr().sorted_indices()
+    fractions.data = np.round(fractions.data, FRACTION_DECIMALS)
+    indices = fractions.indices.astype(np.int16)
+    keys = np.zeros(matrix.shape[0], dtype=np.int64)
+    for i in range(matrix.shape[0]):
+        lo, hi = fractions.indptr[i], fractions.indptr[i+1]
+        digest = hashlib.blake2b(
+            indices[lo:hi].tobytes() + fractions.data[lo:hi].tobytes(), digest_size=8
+        ).digest()
+        keys[i] = int.from_bytes(digest, "little", signed=True)
+    return keys
+
+
+def spacegroup_chunk(structures, symprec=SYMPREC):
+    """ space group numbers found by spglib, 0 where it fails """
+    from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+
+    numbers = np.zeros(len(structures), dtype=np.int16)
+    for i, (structure_id, error) in enumerate(zip(structures.ids, structures.errors)):
+        if error:
+            continue
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                analyzer = SpacegroupAnalyzer(structures.structure(structure_id), symprec)
+                numbers[i] = analyzer.get_space_group_number()
+        except Exception:
+            pass
+    return numbers
+
+
+def spacegroup_numbers(structures, n_workers=None, chunk_size=500):
+    chunks = [
+        np.arange(i, min(i+chunk_size, len(structures)))
+        for i in range(0, len(structures), chunk_size)
+    ]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        parts = list(executor.map(spacegroup_chunk, [structures.take(c) for c in chunks]))
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int16)
+
+
+def match_keys(structures, spacegroups=None, tolerance=VOLUME_TOLERANCE, n_workers=None):
+    """ blocking keys of the structures which could be parsed: reduced
+    composition hash, space group number (computed if not given, 0 when
+    unknown), volume per atom and its bin, on a log scale of width
+    `tolerance`. One row per structure, `position` in `structures`. """
+    compositions = structure_compositions(structures)
+    n_atoms = np.asarray(compositions.sum(axis=1)).ravel()
+    valid = (structures.errors == "") & (n_atoms > 0)
+    if spacegroups is None:
+        spacegroups = spacegroup_numbers(structures, n_workers)
+    volumes = np.abs(np.linalg.det(structures.lattice))
+    volume_per_atom = np.divide(volumes, n_atoms, out=np.zeros_like(volumes), where=n_atoms > 0)
+    valid &= volume_per_atom > 0
+
+    keys = pd.DataFrame({
+        "position": np.flatnonzero(valid),
+        "composition": composition_hashes(compositions[valid]),
+        "spacegroup": np.asarray(spacegroups, dtype=np.int16)[valid],
+        "volume_per_atom": volume_per_atom[valid],
+    })
+    keys["volume_bin"] = np.floor(
+        np.log(keys["volume_per_atom"]) / np.log1p(tolerance)
+    ).astype(np.int64)
+    return keys
+
+
+def candidate_pairs(keys_a, keys_b, tolerance=VOLUME_TOLERANCE, same=False):
+    """ (position_a, position_b) of the structures with the same reduced
+    composition, the same space group (or an unknown one) and volumes per
+    atom within `tolerance`. Bins have the width of the tolerance, so
+    such pairs are in the same or adjacent bins. With `same`, the keys are
+    those of one set of structures, and each pair is given once. """
+    pairs = pd.concat([
+        keys_a.merge(
+            keys_b.assign(volume_bin=keys_b["volume_bin"] + shift),
+            on=["composition", "volume_bin"], suffixes=("_a", "_b"),
+        )
+        for shift in (-1, 0, 1)
+    ], ignore_index=True)
+    sg_a, sg_b = pairs["spacegroup_a"], pairs["spacegroup_b"]
+    keep = (sg_a == sg_b) | (sg_a == 0) | (sg_b == 0)
+    keep &= np.abs(np.log(pairs["volume_per_atom_a"] / pairs["volume_per_atom_b"])) <= np.log1p(tolerance)
+    if same:
+        keep &= pairs["position_a"] < pairs["position_b"]
+    pairs = pairs.loc[keep, ["composition", "position_a", "position_b"]]
+    return pairs.sort_values(["composition", "position_a"], ignore_index=True)
+
+
+def compare_chunk(structures_a, structures_b, pairs):
+    """ rms distance (see `StructureMatcher.get_rms_dist`) of each pair of
+    positions in the two chunks of structures, NaN if they do not match """
+    from pymatgen.analysis.structure_matcher import StructureMatcher
+
+    matcher = StructureMatcher()  # ltol=0.2, stol=0.3, angle_tol=5, volumes scaled
+    built_a, built_b = {}, {}
+    rms = np.full(len(pairs), np.nan)
+    for k, (i, j) in enumerate(pairs):
+        if i not in built_a:
+            built_a[i] = structures_a.structure(structures_a.ids[i])
+        if j not in built_b:
+            built_b[j] = structures_b.structure(structures_b.ids[j])
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                result = matcher.get_rms_dist(built_a[i], built_b[j])
+        except Exception:  # some disordered structures cannot be matched
+            result = None
+        if result is not None:
+            rms[k] = result[0]
+    return rms
+
+
+def compare_pairs(structures_a, structures_b, positions_a, positions_b, n_workers=None, chunk_size=200):
+    """ `compare_chunk` over all the pairs, in chunks of `chunk_size` pairs
+    spread over `n_workers` processes. Only the structures of its pairs are
+    sent to each process. """
+    rms = np.full(len(positions_a), np.nan)
+    starts = range(0, len(positions_a), chunk_size)
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = []
+        for start in starts:
+            chunk_a, local_a = np.unique(positions_a[start:start+chunk_size], return_inverse=True)
+            chunk_b, local_b = np.unique(positions_b[start:start+chunk_size], return_inverse=True)
+            futures.append(executor.submit(
+                compare_chunk, structures_a.take(chunk_a), structures_b.take(chunk_b),
+                list(zip(local_a.tolist(), local_b.tolist())),
+            ))
+        for i, (start, future) in enumerate(zip(starts, futures)):
+            rms[start:start+chunk_size] = future.result()
+            print(f"  chunk {i+1}/{len(futures)}", end="\r")
+    return rms
+
+
+def match_structures(
+    structures_a, structures_b=None, spacegroups_a=None, spacegroups_b=None,
+    table_path=None, tolerance=VOLUME_TOLERANCE, n_workers=None,
+):
+    """ match the structures of two `Structure_arrays` (or of one with
+    itself, to find duplicates, if `structures_b` is None) with pymatgen's
+    `StructureMatcher`, only comparing the candidates of `candidate_pairs`.
+
+    Returns a DataFrame of the compared pairs (`id_a`, `hash_a`, `id_b`,
+    `hash_b`, and `rms`, NaN when they do not match). If `table_path` is
+    given, the pairs already compared there with the same structure hashes
+    are not compared again, and the table is saved there as parquet.
+    """
+    same = structures_b is None
+    if same:
+        structures_b, spacegroups_b = structures_a, spacegroups_a
+    keys_a = match_keys(structures_a, spacegroups_a, tolerance, n_workers)
+    keys_b = keys_a if same else match_keys(structures_b, spacegroups_b, tolerance, n_workers)
+    pairs = candidate_pairs(keys_a, keys_b, tolerance, same)
+    positions_a = pairs["position_a"].to_numpy()
+    positions_b = pairs["position_b"].to_numpy()
+    table = pd.DataFrame({
+        "id_a": structures_a.ids[positions_a],
+        "hash_a": structures_a.hashes[positions_a],
+        "id_b": structures_b.ids[positions_b],
+        "hash_b": structures_b.hashes[positions_b],
+        "rms": np.nan,
+    })
+
+    key = ["id_a", "hash_a", "id_b", "hash_b"]
+    compared = np.zeros(len(table), dtype=bool)
+    if table_path is not None and os.path.exists(table_path):
+        previous = storage.read_parquet(table_path).set_index(key)["rms"]
+        index = pd.MultiIndex.from_frame(table[key])
+        compared = index.isin(previous.index)
+        table.loc[compared, "rms"] = previous.reindex(index[compared]).to_numpy()
+    print(f"{len(table)} candidate pairs, {np.count_nonzero(~compared)} to compare")
+
+    to_compare = np.flatnonzero(~compared)
+    table.loc[to_compare, "rms"] = compare_pairs(
+        structures_a, structures_b, positions_a[to_compare], positions_b[to_compare], n_workers
+    )
+    print(f"{table['rms'].notna().sum()} matching pairs")
+    if table_path is not None:
+        Path(table_path).parent.mkdir(parents=True, exist_ok=True)
+        table.to_parquet(str(table_path) + ".tmp", index=False)
+        os.replace(str(table_path) + ".tmp", table_path)
+    return table
+
+
+def dataset_spacegroups(name, structures):
+    """ space group numbers of the `structures` of dataset `name`, as given
+    by the database (see SPACEGROUP_COLUMNS), or None to compute them """
+    if SPACEGROUP_COLUMNS[name] is None:
+        return None
+    id_column, spacegroup_column = SPACEGROUP_COLUMNS[name]
+    df = storage.load(name, columns=[id_column, spacegroup_column])
+    spacegroups = df.set_index(df[id_column].astype(str))[spacegroup_column]
+    spacegroups = spacegroups[~spacegroups.index.duplicated()]
+    return spacegroups.reindex(structures.ids).fillna(0).astype(np.int16).to_numpy()
+
+
+def match_table_path(name_a, name_b, directory=MATCHES_DIR):
+    return Path(directory)/f"{name_a}_{name_b}.parquet"
+
+
+def match_datasets(name_a, name_b, directory=MATCHES_DIR, n_workers=None):
+    """ match the structures of two datasets ("icsd", "mp" or "oqmd"),
+    updating their table in `directory` """
+    structures_a = Structure_arrays.load(STRUCTURES_NPZ[name_a])
+    structures_b = Structure_arrays.load(STRUCTURES_NPZ[name_b])
+    print(f"matching {len(structures_a)} {name_a} and {len(structures_b)} {name_b} structures")
+    return match_structures(
+        structures_a, structures_b,
+        dataset_spacegroups(name_a, structures_a), dataset_spacegroups(name_b, structures_b),
+        match_table_path(name_a, name_b, directory), n_workers=n_workers,
+    )
+
+
+def load_matches(name_a, name_b, directory=MATCHES_DIR):
+    """ the matching pairs of two datasets, as columns `<name_a>_id`,
+    `<name_b>_id` and `rms`, to join the datasets on """
+    table = storage.read_parquet(match_table_path(name_a, name_b, directory))
+    table = table.loc[table["rms"].notna(), ["id_a", "id_b", "rms"]]
+    return table.rename(columns={"id_a": f"{name_a}_id", "id_b": f"{name_b}_id"}).reset_index(drop=True)
+
+
+def id_mapping(directory=MATCHES_DIR):
+    """ all the matching pairs of the datasets matched so far, one row per
+    pair: `database_a`, `id_a`, `database_b`, `id_b`, `rms` """
+    tables = []
+    for name_a, name_b in [("icsd", "mp"), ("icsd", "oqmd"), ("mp", "oqmd")]:
+        if match_table_path(name_a, name_b, directory).exists():
+            table = load_matches(name_a, name_b, directory)
+            table.columns = ["id_a", "id_b", "rms"]
+            tables.append(table.assign(database_a=name_a, database_b=name_b))
+    columns = ["database_a", "id_a", "database_b", "id_b", "rms"]
+    if not tables:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(tables, ignore_index=True)[columns]
+
+
+if __name__ == "__main__":
+    available = [name for name, path in STRUCTURES_NPZ.items() if os.path.exists(path)]
+    for name_a, name_b in [("icsd", "mp"), ("icsd", "oqmd"), ("mp", "oqmd")]:
+        if name_a in available and name_b in available:
+            match_datasets(name_a, name_b)
+    mapping = id_mapping()
+    MATCHES_DIR.mkdir(parents=True, exist_ok=True)
+    mapping.to_parquet(MATCHES_DIR/"id_mapping.parquet", index=False)
+    print(f"{len(mapping)} matching pairs saved in {MATCHES_DIR/'id_mapping.parquet'}")
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import shutil
+from pathlib import Path  ## for os-agnostic paths
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+PARENT = Path(__file__).parent.parent
+DATASETS_DIR = PARENT/"datasets"
+METADATA_JSON = "_dataset.json"
+
+
+def object_strings(df):
+    """ string columns of `df` as object columns of str (None for null), as
+    in the .pkl files, instead of the string dtype newer pandas read """
+    string_columns = [c for c in df.columns if isinstance(df[c].dtype, pd.StringDtype)]
+    return df.astype({c: object for c in string_columns}) if string_columns else df
+
+
+def read_parquet(path, columns=None, filters=None):
+    return object_strings(pd.read_parquet(path, columns=columns, filters=filters))
+
+
+def dataset_path(name, root=DATASETS_DIR):
+    return Path(root)/name
+
+
+def to_arrow_table(df):
+    """ arrow table of a DataFrame. Object columns that arrow cannot type
+    (values of mixed types, heterogeneous nested dictionaries, pymatgen
+    objects) are stored as json strings, and their names returned. """
+    df = df.reset_index(drop=True)
+    json_columns = []
+    for column in df.columns[df.dtypes == object]:
+        try:
+            pa.array(df[column], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            df[column] = [
+                None if value is None else json.dumps(value, default=str)
+                for value in df[column]
+            ]
+            json_columns.append(column)
+    return pa.Table.from_pandas(df, preserve_index=False), json_columns
+
+
+def save(name, df, partition_on="nelements", root=DATASETS_DIR):
+    """ write `df` as the partitioned parquet dataset `name`, one directory
+    per value of the column `partition_on` (if it is in `df`), replacing the
+    previous version of the dataset """
+    path = dataset_path(name, root)
+    tmp_path = path.with_name(path.name + ".tmp")
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+
+    table, json_columns = to_arrow_table(df)
+    partition_cols = [partition_on] if partition_on in df.columns else None
+    pq.write_to_dataset(table, tmp_path, partition_cols=partition_cols)
+    with open(tmp_path/METADATA_JSON, "w") as f:
+        json.dump({
+            "partition_on": partition_cols[0] if partition_cols else None,
+            "partition_dtype": str(df[partition_on].dtype) if partition_cols else None,
+            "json_columns": json_columns,
+            "rows": len(df),
+        }, f, indent=1)
+
+    if path.exists():
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+def save_parts(name, chunks, root=DATASETS_DIR):
+    """ write the DataFrames of the iterable `chunks` as the parquet files
+    of the dataset `name`, each one as soon as it comes, so that a table
+    larger than memory can be saved. Chunks may have different columns.
+    Replaces the previous version of the dataset. """
+    path = dataset_path(name, root)
+    tmp_path = path.with_name(path.name + ".tmp")
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir(parents=True)
+
+    parts = []
+    for i, chunk in enumerate(chunks):
+        table, json_columns = to_arrow_table(chunk)
+        part = f"part_{i:05d}.parquet"
+        pq.write_table(table, tmp_path/part)
+        parts.append({"file": part, "rows": len(chunk), "json_columns": json_columns})
+    with open(tmp_path/METADATA_JSON, "w") as f:
+        json.dump({
+            "partition_on": None,
+            "partition_dtype": None,
+            "json_columns": sorted({c for p in parts for c in p["json_columns"]}),
+            "rows": sum(p["rows"] for p in parts),
+            "parts": parts,
+        }, f, indent=1)
+
+    if path.exists():
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+def load_parts(path, info, columns=None, filters=None):
+    """ read the parts written by `save_parts` one by one, and align their
+    columns """
+    dfs = []
+    for part in info["parts"]:
+        part_path = path/part["file"]
+        names = pq.read_schema(part_path).names
+        df = read_parquet(
+            part_path, columns=None if columns is None else [c for c in columns if c in names],
+            filters=filters,
+        )
+        for column in part["json_columns"]:
+            if column in df.columns:
+                df[column] = [
+                    json.loads(value) if isinstance(value, str) else None
+                    for value in df[column]
+                ]
+        dfs.append(df)
+    df = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+    return df if columns is None else df.reindex(columns=columns)
+
+
+def metadata(name, root=DATASETS_DIR):
+    with open(dataset_path(name, root)/METADATA_JSON, "r") as f:
+        return json.load(f)
+
+
+def load(name, columns=None, filters=None, root=DATASETS_DIR):
+    """ read the dataset `name`, only the `columns` listed (all if None) and
+    only the rows matching `filters`. Filters are given as in pyarrow, for
+    example [("nelements", "==", 3), ("band_gap", ">", 1.)]; conditions on
+    the partition column skip whole directories, the others are checked on
+    parquet row-group statistics before rows are read.
+
+        mp_ternaries = load("mp", columns=["material_id", "band_gap"], filters=[("nelements", "==", 3)])
+    """
+    path = dataset_path(name, root)
+    info = metadata(name, root)
+    if "parts" in info:
+        return load_parts(path, info, columns, filters)
+    df = read_parquet(path, columns=columns, filters=filters)
+
+    partition_on = info["partition_on"]
+    if partition_on in df.columns:  # partition values come back as categories
+        df[partition_on] = df[partition_on].astype(info["partition_dtype"])
+    for column in info["json_columns"]:
+        if column in df.columns:
+            df[column] = [
+                json.loads(value) if isinstance(value, str) else None
+                for value in df[column]
+            ]
+    return df
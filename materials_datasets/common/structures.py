@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import hashlib
+import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from common.elements import ATOMIC_NUMBERS
+
+# leading chemical symbol of an OPTIMADE species name, like "Fe" or "Fe2"
+SPECIES_SYMBOL = re.compile(r"^([A-Z][a-z]?)")
+
+
+def cif_hash(cif_str):
+    return hashlib.sha1(cif_str.encode()).hexdigest()
+
+
+def range_index(offsets, positions):
+    """ indices of the items of the entries at `positions`, where the items of
+    entry i are offsets[i]:offsets[i+1], and the offsets of the selection """
+    starts = offsets[positions]
+    counts = offsets[positions+1] - starts
+    new_offsets = np.zeros(len(positions)+1, dtype=np.int64)
+    np.cumsum(counts, out=new_offsets[1:])
+    index = np.repeat(starts - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+    return index, new_offsets
+
+
+class Structure_arrays:
+    """ Many crystal structures in a few flat numpy arrays.
+
+    Structure i has the lattice `lattice[i]` (3x3, rows are the vectors) and
+    the sites `site_offsets[i]:site_offsets[i+1]` of `frac_coords`. Site j is
+    occupied by the species `species_offsets[j]:species_offsets[j+1]` of
+    `species_Z` (atomic numbers) and `occupancy` (more than one for
+    disordered sites). Structures are identified by `ids`, with the `hashes`
+    of the cifs they come from; `errors` is "" or why the cif could not be
+    parsed (the structure is then empty).
+    """
+    FIELDS = [
+        "ids", "hashes", "errors", "lattice", "site_offsets", "frac_coords",
+        "species_offsets", "species_Z", "occupancy",
+    ]
+
+    def __init__(
+        self, ids, hashes, errors, lattice, site_offsets, frac_coords,
+        species_offsets, species_Z, occupancy,
+    ):
+        self.ids = np.asarray(ids, dtype=str)
+        self.hashes = np.asarray(hashes, dtype=str)
+        self.errors = np.asarray(errors, dtype=str)
+        self.lattice = np.asarray(lattice, dtype=np.float64).reshape(-1, 3, 3)
+        self.site_offsets = np.asarray(site_offsets, dtype=np.int64)
+        self.frac_coords = np.asarray(frac_coords, dtype=np.float64).reshape(-1, 3)
+        self.species_offsets = np.asarray(species_offsets, dtype=np.int64)
+        self.species_Z = np.asarray(species_Z, dtype=np.uint8)
+        self.occupancy = np.asarray(occupancy, dtype=np.float32)
+        self.positions = None
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], [], np.zeros((0, 3, 3)), [0], np.zeros((0, 3)), [0], [], [])
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(*[arrays[field] for field in cls.FIELDS])
+
+    def save(self, path):
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, **{field: getattr(self, field) for field in self.FIELDS})
+        os.replace(path + ".tmp", path)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def position(self, structure_id):
+        if self.positions is None:
+            self.positions = {i: p for p, i in enumerate(self.ids.tolist())}
+        return self.positions[str(structure_id)]
+
+    def take(self, positions):
+        """ the structures at `positions`, in that order """
+        positions = np.asarray(positions, dtype=np.int64)
+        sites, site_offsets = range_index(self.site_offsets, positions)
+        species, species_offsets = range_index(self.species_offsets, sites)
+        return Structure_arrays(
+            self.ids[positions], self.hashes[positions], self.errors[positions],
+            self.lattice[positions], site_offsets, self.frac_coords[sites],
+            species_offsets, self.species_Z[species], self.occupancy[species],
+        )
+
+    @classmethod
+    def concatenate(cls, parts):
+        parts = [part for part in parts if len(part)] or [cls.empty()]
+        site_shift = np.cumsum([0] + [len(p.frac_coords) for p in parts[:-1]])
+        species_shift = np.cumsum([0] + [len(p.species_Z) for p in parts[:-1]])
+        return cls(
+            np.concatenate([p.ids for p in parts]),
+            np.concatenate([p.hashes for p in parts]),
+            np.concatenate([p.errors for p in parts]),
+            np.concatenate([p.lattice for p in parts]),
+            np.concatenate([[0]] + [p.site_offsets[1:] + s for p, s in zip(parts, site_shift)]),
+            np.concatenate([p.frac_coords for p in parts]),
+            np.concatenate([[0]] + [p.species_offsets[1:] + s for p, s in zip(parts, species_shift)]),
+            np.concatenate([p.species_Z for p in parts]),
+            np.concatenate([p.occupancy for p in parts]),
+        )
+
+    def structure(self, structure_id):
+        """ the pymatgen `Structure` of `structure_id`, None if its cif
+        could not be parsed """
+        from pymatgen.core import Structure, Element
+
+        i = self.position(structure_id)
+        if self.errors[i]:
+            return None
+        start, stop = self.site_offsets[i], self.site_offsets[i+1]
+        species = []
+        for site in range(start, stop):
+            lo, hi = self.species_offsets[site], self.species_offsets[site+1]
+            species.append({
+                Element.from_Z(int(z)): float(occupancy)
+                for z, occupancy in zip(self.species_Z[lo:hi], self.occupancy[lo:hi])
+            })
+        return Structure(self.lattice[i], species, self.frac_coords[start:stop])
+
+
+def parse_structure(cif_str):
+    """ lattice, fractional coordinates, and species (atomic number and
+    occupancy) of each site of the first structure of a cif """
+    from pymatgen.core import Structure
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # pymatgen warns about most ICSD cifs
+        structure = Structure.from_str(cif_str, fmt="cif")
+    site_species = [
+        [(element.Z, occupancy) for element, occupancy in site.species.items()]
+        for site in structure
+    ]
+    return structure.lattice.matrix, structure.frac_coords, site_species
+
+
+def convert_chunk(ids, cifs):
+    """ `Structure_arrays` of a chunk of cifs; a cif that fails to parse
+    gets an empty structure and its error, and does not stop the chunk """
+    errors = []
+    lattices = []
+    site_counts = []
+    frac_coords = []
+    species_counts = []
+    species_Z = []
+    occupancy = []
+    for cif_str in cifs:
+        try:
+            lattice, coords, site_species = parse_structure(cif_str)
+            error = ""
+        except Exception as exc:
+            lattice, coords, site_species = np.zeros((3, 3)), np.zeros((0, 3)), []
+            error = f"{type(exc).__name__}: {exc}"[:500] or "error"
+        errors.append(error)
+        lattices.append(lattice)
+        site_counts.append(len(site_species))
+        frac_coords.append(coords)
+        for species in site_species:
+            species_counts.append(len(species))
+            species_Z.extend(z for z, _ in species)
+            occupancy.extend(o for _, o in species)
+    return Structure_arrays(
+        ids, [cif_hash(cif_str) for cif_str in cifs], errors,
+        np.array(lattices).reshape(-1, 3, 3),
+        np.concatenate([[0], np.cumsum(site_counts, dtype=np.int64)]),
+        np.concatenate(frac_coords) if frac_coords else np.zeros((0, 3)),
+        np.concatenate([[0], np.cumsum(species_counts, dtype=np.int64)]),
+        species_Z, occupancy,
+    )
+
+
+def convert_structures(ids, cifs, cache_path=None, n_workers=None, chunk_size=500):
+    """ `Structure_arrays` of the cifs (any iterable of strings, read once),
+    in the order of `ids`.
+
+    The cifs are parsed by pymatgen in chunks of `chunk_size` spread over
+    `n_workers` processes, chunks being made as the cifs are read with at
+    most two per process in flight, so that only these cifs are in memory.
+    If `cache_path` is given, the structures already converted there from
+    the same (id, cif hash) are reused, only the new or changed cifs are
+    parsed, and the cache is updated with the result.
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    cached = Structure_arrays.empty()
+    if cache_path is not None and os.path.exists(cache_path):
+        cached = Structure_arrays.load(cache_path)
+    cached_positions = {
+        (i, h): p for p, (i, h) in enumerate(zip(cached.ids.tolist(), cached.hashes.tolist()))
+    }
+
+    hits = []  # (row, position in the cache)
+    parts, order = [], []  # converted chunks, and their rows
+    in_flight = deque()  # (future, rows)
+    chunk_rows, chunk_ids, chunk_cifs = [], [], []
+
+    def collect():
+        future, rows = in_flight.popleft()
+        parts.append(future.result())
+        order.extend(rows)
+        print(f"  {len(order)} converted", end="\r")
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for k, (i, cif_str) in enumerate(zip(ids, cifs)):
+            i = str(i)
+            position = cached_positions.get((i, cif_hash(cif_str)))
+            if position is not None:
+                hits.append((k, position))
+                continue
+            chunk_rows.append(k)
+            chunk_ids.append(i)
+            chunk_cifs.append(cif_str)
+            if len(chunk_rows) == chunk_size:
+                in_flight.append((executor.submit(convert_chunk, chunk_ids, chunk_cifs), chunk_rows))
+                chunk_rows, chunk_ids, chunk_cifs = [], [], []
+                if len(in_flight) >= 2*n_workers:
+                    collect()
+        if chunk_rows:
+            in_flight.append((executor.submit(convert_chunk, chunk_ids, chunk_cifs), chunk_rows))
+        while in_flight:
+            collect()
+    print(f"{len(hits)} structures cached, {len(order)} converted")
+
+    parts.insert(0, cached.take([position for _, position in hits]))
+    order = [k for k, _ in hits] + order
+    structures = Structure_arrays.concatenate(parts).take(np.argsort(order, kind="stable"))
+    n_failed = int(np.count_nonzero(structures.errors != ""))
+    print(f"{len(structures)} structures, {n_failed} cifs could not be parsed")
+    if cache_path is not None:
+        structures.save(cache_path)
+    return structures
+
+
+def vectors_array(vectors):
+    """ (n, 3) array of a list of vectors, also when read back from parquet
+    as an array of arrays """
+    return np.array([np.asarray(v, dtype=np.float64) for v in vectors]).reshape(-1, 3)
+
+
+def optimade_structures(ids, lattice_vectors, cartesian_site_positions, species_at_sites):
+    """ `Structure_arrays` of OPTIMADE entries (like OQMD's), which come
+    with their lattice and cartesian positions, so no cif is parsed. Species
+    names are read as the chemical symbol they start with. The hashes are
+    those of the three fields as json, to spot changed entries. """
+    errors = []
+    lattices = []
+    site_counts = []
+    frac_coords = []
+    species_Z = []
+    hashes = []
+    for lattice, positions, species in zip(lattice_vectors, cartesian_site_positions, species_at_sites):
+        lattice = vectors_array(lattice)
+        positions = vectors_array(positions)
+        hashes.append(cif_hash(json.dumps([lattice.tolist(), positions.tolist(), list(species)])))
+        try:
+            if len(species) != len(positions):
+                raise ValueError(f"{len(species)} species for {len(positions)} sites")
+            Z = [ATOMIC_NUMBERS[SPECIES_SYMBOL.match(name).group(1)] for name in species]
+            coords = np.linalg.solve(lattice.T, positions.T).T  # cartesian = frac @ lattice
+            error = ""
+        except (ValueError, KeyError, AttributeError, np.linalg.LinAlgError) as exc:
+            Z, coords = [], np.zeros((0, 3))
+            error = f"{type(exc).__name__}: {exc}"[:500] or "error"
+        errors.append(error)
+        lattices.append(lattice)
+        site_counts.append(len(Z))
+        frac_coords.append(coords)
+        species_Z.extend(Z)
+    n_sites = int(np.sum(site_counts))
+    return Structure_arrays(
+        [str(i) for i in ids], hashes, errors,
+        np.array(lattices).reshape(-1, 3, 3),
+        np.concatenate([[0], np.cumsum(site_counts, dtype=np.int64)]),
+        np.concatenate(frac_coords) if frac_coords else np.zeros((0, 3)),
+        np.arange(n_sites+1, dtype=np.int64),  # one fully occupied species per site
+        species_Z, np.ones(n_sites),
+    )
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class Shard_queue:
+    """ Queue of shards of work shared by processes on one or several
+    machines, in a sqlite file (on a filesystem where file locking works).
+
+    A coordinator `add`s the shards (a name and a json payload each). Workers
+    `claim` one pending shard at a time with a lease of `lease_seconds`,
+    `renew` the lease while working on it, and mark it `done` (with a json
+    result) or `fail`ed. A shard whose lease expired, because its worker died
+    or lost the connection, is pending again at the next claim. A shard
+    failing `max_attempts` times is left `failed`, and so is a shard whose
+    lease expired after `max_attempts` claims: it may be the shard that kills
+    its workers (out of memory, crash), which never get to `fail` it. The queue remembers what
+    it was filled with, so a queue left over from another download is not
+    silently mixed with a new one (see `add`).
+    """
+    def __init__(self, path, lease_seconds=600., max_attempts=5):
+        self.path = str(path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()  # the connection is shared with the heartbeat thread
+        self.connection = sqlite3.connect(
+            self.path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS shards ("
+            " name TEXT PRIMARY KEY, payload TEXT, status TEXT, worker TEXT,"
+            " lease_until REAL, attempts INTEGER, result TEXT, error TEXT, updated REAL)"
+        )
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def transaction(self, statements):
+        """ run (sql, parameters) pairs in one write transaction, and return
+        the rows of the last one """
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")  # locks the file for writing now
+            try:
+                for sql, parameters in statements:
+                    cursor.execute(sql, parameters)
+                rows = cursor.fetchall()
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+        return rows
+
+    def add(self, shards, parameters=None, reset=False):
+        """ add (name, payload) shards of a download made with `parameters`
+        (anything json). Names already in the queue (whatever their status)
+        are kept as they are, so adding again is harmless. If the queue holds
+        shards made with other parameters, raises ValueError, or with
+        `reset`, deletes them first. """
+        parameters = json.dumps(parameters, sort_keys=True)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'parameters'"
+            ).fetchone()
+            n_shards = self.connection.execute("SELECT COUNT(*) FROM shards").fetchone()[0]
+        if n_shards and (row is None or row[0] != parameters) and not reset:
+            raise ValueError(
+                f"{self.path} holds {n_shards} shards {self.counts()} made with"
+                f" {row[0] if row else 'unknown parameters'}, not {parameters};"
+                " merge them and reset the queue"
+            )
+        now = time.time()
+        statements = [("DELETE FROM shards", ())] if reset else []
+        statements.append(("INSERT OR REPLACE INTO meta VALUES ('parameters', ?)", (parameters,)))
+        statements += [
+            (
+                "INSERT OR IGNORE INTO shards VALUES (?, ?, 'pending', NULL, NULL, 0, NULL, NULL, ?)",
+                (name, json.dumps(payload), now),
+            )
+            for name, payload in shards
+        ]
+        self.transaction(statements)
+
+    def claim(self, worker):
+        """ lease the next pending shard to `worker`, and return its
+        (name, payload), or None if no shard is pending. Expired leases are
+        released first, as `failed` once the shard was claimed `max_attempts`
+        times. """
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                cursor.execute(
+                    "UPDATE shards SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,"
+                    " worker = NULL, error = COALESCE(error, 'lease expired'), updated = ?"
+                    " WHERE status = 'leased' AND lease_until < ?",
+                    (self.max_attempts, now, now),
+                )
+                row = cursor.execute(
+                    "SELECT name, payload FROM shards WHERE status = 'pending'"
+                    " ORDER BY rowid LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    cursor.execute(
+                        "UPDATE shards SET status = 'leased', worker = ?, lease_until = ?,"
+                        " attempts = attempts + 1, updated = ? WHERE name = ?",
+                        (worker, now + self.lease_seconds, now, row[0]),
+                    )
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def renew(self, name, worker):
+        """ extend the lease of `worker` on `name`; False if it lost it """
+        now = time.time()
+        rows = self.transaction([
+            (
+                "UPDATE shards SET lease_until = ?, updated = ?"
+                " WHERE name = ? AND worker = ? AND status = 'leased'",
+                (now + self.lease_seconds, now, name, worker),
+            ),
+            ("SELECT changes()", ()),
+        ])
+        return rows[0][0] > 0
+
+    def done(self, name, worker, result=None):
+        # the outputs of a shard are the same whoever computes them, so a
+        # worker whose lease expired can still complete it
+        self.transaction([(
+            "UPDATE shards SET status = 'done', worker = ?, result = ?, error = NULL,"
+            " updated = ? WHERE name = ? AND status != 'done'",
+            (worker, json.dumps(result), time.time(), name),
+        )])
+
+    def fail(self, name, worker, error):
+        self.transaction([(
+            "UPDATE shards SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,"
+            " worker = NULL, error = ?, updated = ? WHERE name = ? AND worker = ? AND status = 'leased'",
+            (self.max_attempts, str(error)[:1000], time.time(), name, worker),
+        )])
+
+    def counts(self):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT status, COUNT(*) FROM shards GROUP BY status"
+            ).fetchall()
+        return {status: n for status, n in rows}
+
+    def is_finished(self):
+        counts = self.counts()
+        return counts.get("pending", 0) + counts.get("leased", 0) == 0
+
+    def results(self):
+        """ (name, payload, result) of the done shards, in the order they were added """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT name, payload, result FROM shards WHERE status = 'done' ORDER BY rowid"
+            ).fetchall()
+        return [(name, json.loads(payload), json.loads(result)) for name, payload, result in rows]
+
+    def failures(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT name, attempts, error FROM shards WHERE status = 'failed' ORDER BY rowid"
+            ).fetchall()
+
+
+def run_worker(queue, process, worker=None, poll=30.):
+    """ claim shards of `queue` and run `process(name, payload)` on them until
+    none is left, renewing the lease from a background thread meanwhile. The
+    return value of `process` is recorded as the result of the shard, an
+    exception as its error. While other workers still hold leases, waits
+    (`poll` seconds at a time) in case they expire. Returns the number of
+    shards done by this worker. """
+    worker = worker or default_worker_id()
+    n_done = 0
+    while True:
+        claimed = queue.claim(worker)
+        if claimed is None:
+            if queue.is_finished():
+                return n_done
+            time.sleep(poll)
+            continue
+        name, payload = claimed
+
+        finished = threading.Event()
+
+        def heartbeat():
+            while not finished.wait(queue.lease_seconds/3):
+                if not queue.renew(name, worker):
+                    return
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            result = process(name, payload)
+        except Exception as exc:
+            print(f"\n{worker}: shard {name} failed: {exc}")
+            queue.fail(name, worker, f"{type(exc).__name__}: {exc}")
+        else:
+            queue.done(name, worker, result)
+            n_done += 1
+        finally:
+            finished.set()
+            thread.join()
+        print(f"\n{worker}: {queue.counts()}")
@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 
+import os
+import sys
+import argparse
 from pathlib import Path
 import re  #regular expressions
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
+from scipy import sparse
 
 HERE = Path(__file__).parent
 PARENT = Path(__file__).parent.parent
@@ -12,6 +18,47 @@ AUGMENTED_PKL = str(HERE/"all_icsd_cifs_augmented.pkl")
 FORMULA_CSV = str(HERE/"icsd_all_formulas.csv")
 INT_FORMULA_SUM_CSV = str(HERE/"icsd_formula_sum_integer.csv")
 INT_FORMULA_STRUCT_CSV = str(HERE/"icsd_formula_structural_integer.csv")
+ATOM_SITES_NPZ = str(HERE/"all_icsd_cifs_augmented_sites.npz")
+COMPOSITION_NPZ = str(HERE/"all_icsd_cifs_augmented_composition.npz")
+ICSD_CIFS_BLOBS = str(HERE/"icsd_cifs")  # written by download.py
+STRUCTURES_NPZ = str(HERE/"all_icsd_cifs_augmented_structures.npz")
+
+sys.path.append(str(PARENT))
+from common.elements import ATOMIC_NUMBERS
+from common.blobs import Dict_blob_reader
+from common.structures import convert_structures
+from common.formula import composition_matrix, is_stoichiometric, n_elements
+from common.bitmask import add_mask_columns
+from common import storage
+
+# data-names extracted by `extract_cif_columns`, and the type of their value
+CIF_FIELDS = {
+    "_database_code_ICSD": "int",
+    "_chemical_formula_structural": "formula",
+    "_chemical_formula_sum": "formula",
+    "_cell_length_a": "float",
+    "_cell_length_b": "float",
+    "_cell_length_c": "float",
+    "_cell_angle_alpha": "float",
+    "_cell_angle_beta": "float",
+    "_cell_angle_gamma": "float",
+    "_cell_volume": "float",
+    "_space_group_IT_number": "int",
+}
+UNCERTAINTY = re.compile(r"\(\d+\)$")
+
+# one row per atom site of the `_atom_site_` loop, for all structures
+SITE_DTYPE = np.dtype([
+    ("Z", np.uint8),  # atomic number, 0 if unknown
+    ("oxidation", np.float32),  # NaN if unknown
+    ("wyckoff", "S1"),
+    ("multiplicity", np.uint16),
+    ("x", np.float32),  # fractional coordinates
+    ("y", np.float32),
+    ("z", np.float32),
+    ("occupancy", np.float32),
+])
+TYPE_SYMBOL = re.compile(r"^([A-Z][a-z]?)(?:(\d+(?:\.\d+)?)([+-]))?")
 
 
 def robust_str_split(s):
@@ -55,53 +102,279 @@ def get_cif_float_field(field_name, cif_str):
     return float(get_cif_field(field_name, cif_str))
 
 
-def extract_cif_columns(df):
-    field_list = [
-        "_database_code_ICSD",
+def scan_cif_fields(cif_str, fields):
+    """ single pass over the lines of a cif, returning the raw text of each
+    data-name in `fields` (everything up to the next line starting with "_",
+    like `get_cif_field`). Stops as soon as all the fields are found.
+    """
+    values = {}
+    current = None
+    for line in cif_str.split("\n"):
+        if line.startswith("_"):
+            if current is not None:
+                values[current] = "".join(parts)
+                current = None
+                if len(values) == len(fields):
+                    break
+            name, *rest = line.split(None, 1)
+            if name in fields and name not in values:
+                current = name
+                parts = rest
+        elif current is not None:
+            parts.append(line)
+    if current is not None:
+        values[current] = "".join(parts)
+    return values
+
+
+def convert_cif_value(value, kind):
+    if value is None:
+        return None if kind in ("str", "formula") else np.nan
+    value = value.replace(" ","").replace("\t","").replace("loop_","")
+    if kind == "formula":
+        value = value.replace(";","").replace("'","")
+    elif kind in ("float", "int"):
+        try:
+            value = float(UNCERTAINTY.sub("", value))  # 5.431(2) -> 5.431
+        except ValueError:
+            value = np.nan
+    return value
+
+
+def cif_chunks(df, container, chunk_size):
+    """ chunks of the cifs to scan: lists of cif strings from the `cif`
+    column of `df`, or, if `container` is given, (container, start, stop)
+    to be read by the workers themselves so no cif string is pickled """
+    if container is None:
+        cifs = df['cif'].tolist()
+        return [cifs[i:i+chunk_size] for i in range(0, len(cifs), chunk_size)]
+    with Dict_blob_reader(container) as reader:
+        n_cifs = len(reader)
+    return [
+        (container, start, min(start+chunk_size, n_cifs))
+        for start in range(0, n_cifs, chunk_size)
+    ]
+
+
+def read_cif_chunk(chunk):
+    if isinstance(chunk, tuple):
+        container, start, stop = chunk
+        with Dict_blob_reader(container) as reader:
+            return reader.get_range(start, stop)
+    return chunk
+
+
+def scan_cif_chunk(chunk, fields=CIF_FIELDS):
+    """ scan a chunk of cifs and return their fields column by column """
+    columns = {field: [] for field in fields}
+    for cif_str in read_cif_chunk(chunk):
+        values = scan_cif_fields(cif_str, fields)
+        for field, kind in fields.items():
+            columns[field].append(convert_cif_value(values.get(field), kind))
+    return columns
+
+
+def extract_cif_columns(df, fields=CIF_FIELDS, n_workers=None, chunk_size=2000, container=None):
+    """ add one typed column per cif data-name in `fields` to `df`, scanning
+    each cif once, with chunks of cifs spread over `n_workers` processes.
+    The cifs are the `cif` column of `df`, or those of the `container` (see
+    `save_cif_container` in download.py), in the order of the rows of `df` """
+    chunks = cif_chunks(df, container, chunk_size)
+    columns = {field: [] for field in fields}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for chunk_columns in executor.map(scan_cif_chunk, chunks, [fields]*len(chunks)):
+            for field in fields:
+                columns[field].extend(chunk_columns[field])
+
+    for field, kind in fields.items():
+        if kind == "int":
+            df[field] = pd.array(columns[field], dtype="float64").astype("Int64")
+        elif kind == "float":
+            df[field] = np.array(columns[field], dtype=np.float64)
+        else:
+            df[field] = columns[field]
+    return df
+
+
+def scan_cif_loops(cif_str):
+    """ single pass over the lines of a cif, returning each `loop_` as a
+    dictionary of {data-name: list of value strings} """
+    loops = []
+    names = None
+    tokens = []
+
+    def close_loop():
+        if names:
+            n_rows = len(tokens)//len(names)
+            loops.append({
+                name: tokens[k:n_rows*len(names):len(names)]
+                for k, name in enumerate(names)
+            })
+
+    for line in cif_str.split("\n"):
+        stripped = line.strip()
+        if stripped == "loop_":
+            close_loop()
+            names, tokens = [], []
+        elif names is None or not stripped or stripped.startswith("#"):
+            continue
+        elif stripped.startswith("_"):
+            if tokens:  # a data-name after the values ends the loop
+                close_loop()
+                names, tokens = None, []
+            else:
+                names.append(stripped.split()[0])
+        elif stripped.startswith("data_"):
+            close_loop()
+            names, tokens = None, []
+        else:
+            tokens.extend(robust_str_split(stripped))
+    close_loop()
+    return loops
+
+
+def cif_number(value, default=np.nan):
+    if value in (".", "?"):
+        return default
+    try:
+        return float(UNCERTAINTY.sub("", value))
+    except ValueError:
+        return default
+
+
+def scan_atom_sites(cif_str):
+    """ the atom sites of a cif as a structured array of SITE_DTYPE """
+    loops = scan_cif_loops(cif_str)
+    sites = next((l for l in loops if "_atom_site_fract_x" in l), None)
+    if sites is None:
+        return np.zeros(0, dtype=SITE_DTYPE)
+    types = next((l for l in loops if "_atom_type_oxidation_number" in l), {})
+    oxidation_of = dict(zip(
+        types.get("_atom_type_symbol", []),
+        types.get("_atom_type_oxidation_number", []),
+    ))
+
+    n_sites = len(sites["_atom_site_fract_x"])
+    array = np.zeros(n_sites, dtype=SITE_DTYPE)
+    symbols = sites.get("_atom_site_type_symbol", sites.get("_atom_site_label"))
+    for i, symbol in enumerate(symbols or [""]*n_sites):
+        match = TYPE_SYMBOL.match(symbol)
+        if match is None:
+            array["oxidation"][i] = np.nan
+            continue
+        element, charge, sign = match.groups()
+        array["Z"][i] = ATOMIC_NUMBERS.get(element, 0)
+        if symbol in oxidation_of:
+            array["oxidation"][i] = cif_number(oxidation_of[symbol])
+        elif charge is not None:
+            array["oxidation"][i] = float(charge) * (1 if sign == "+" else -1)
+        else:
+            array["oxidation"][i] = np.nan
+
+    for axis in "xyz":
+        array[axis] = [cif_number(v) for v in sites[f"_atom_site_fract_{axis}"]]
+    array["occupancy"] = [
+        cif_number(v, 1.) for v in sites.get("_atom_site_occupancy", ["1"]*n_sites)
     ]
-    formula_list = [
-        "_chemical_formula_structural",
-        "_chemical_formula_sum",
+    array["multiplicity"] = [
+        cif_number(v, 0) for v in sites.get("_atom_site_symmetry_multiplicity", ["0"]*n_sites)
     ]
-    float_list = [
-        "_cell_length_a",
-        "_cell_length_b",
-        "_cell_length_c",
-        "_cell_angle_alpha",
-        "_cell_angle_beta",
-        "_cell_angle_gamma",
-        "_cell_volume"
+    array["wyckoff"] = [
+        v[:1].encode() if v not in (".", "?") else b""
+        for v in sites.get("_atom_site_Wyckoff_symbol", ["."]*n_sites)
     ]
-    for field in field_list:
-        tmp_function = lambda s: get_cif_field(field, s)
-        df[field] = df['cif'].apply(tmp_function)
-    
-    for field in formula_list:
-        tmp_function = lambda s: get_cif_formula_field(field, s)
-        df[field] = df['cif'].apply(tmp_function)
+    return array
 
-    for field in float_list:
-        tmp_function = lambda s: get_cif_float_field(field, s)
-        df[field] = df['cif'].apply(tmp_function)
-    return df
+
+def scan_atom_sites_chunk(chunk):
+    """ the sites of a chunk of cifs, concatenated, and the number of sites
+    of each cif """
+    arrays = [scan_atom_sites(cif_str) for cif_str in read_cif_chunk(chunk)]
+    counts = np.array([len(a) for a in arrays], dtype=np.int64)
+    return np.concatenate(arrays) if arrays else np.zeros(0, SITE_DTYPE), counts
+
+
+def extract_atom_sites(df, n_workers=None, chunk_size=2000, container=None):
+    """ the atom sites of all the cifs in `df` (or in `container`) in one flat
+    structured array, and the offsets such that the sites of row i are
+    sites[offsets[i]:offsets[i+1]] """
+    chunks = cif_chunks(df, container, chunk_size)
+    site_chunks = []
+    count_chunks = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for sites, counts in executor.map(scan_atom_sites_chunk, chunks):
+            site_chunks.append(sites)
+            count_chunks.append(counts)
+    counts = np.concatenate(count_chunks) if count_chunks else np.zeros(0, np.int64)
+    offsets = np.zeros(len(counts)+1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    sites = np.concatenate(site_chunks) if site_chunks else np.zeros(0, SITE_DTYPE)
+    return sites, offsets
+
+
+def save_atom_sites(filename, ids, sites, offsets):
+    np.savez(filename, ids=np.asarray(ids), sites=sites, offsets=offsets)
+
+
+def load_atom_sites(filename=ATOM_SITES_NPZ):
+    """ returns (ids, sites, offsets), see `extract_atom_sites` """
+    with np.load(filename) as npz:
+        return npz["ids"], npz["sites"], npz["offsets"]
 
 
 def fraction_composition(s):
+    """ quick string test, see `is_stoichiometric` for the exact test """
     return not (("." in s) or ("(" in s))
 
 
 if __name__=="__main__":
-    orig_df = pd.read_pickle(ORIG_PKL)
+    parser = argparse.ArgumentParser(description="extract the fields of the ICSD cifs")
+    parser.add_argument(
+        "--without-cif", action="store_true",
+        help="leave the cif strings out of the augmented pkl and parquet dataset,"
+        " to keep them only in the container icsd/icsd_cifs, read with"
+        " common.blobs.Dict_blob_reader",
+    )
+    args = parser.parse_args()
+
+    if os.path.exists(ICSD_CIFS_BLOBS + ".idx.npz"):
+        # scan the compressed container instead of unpickling every cif
+        container = ICSD_CIFS_BLOBS
+        with Dict_blob_reader(container) as reader:
+            orig_df = pd.DataFrame({'id': reader.keys.astype(object)})
+    else:
+        container = None
+        orig_df = pd.read_pickle(ORIG_PKL)
     
-    icsd_df = extract_cif_columns(orig_df)
+    icsd_df = extract_cif_columns(orig_df, container=container)
+
+    sites, offsets = extract_atom_sites(icsd_df, container=container)
+    save_atom_sites(ATOM_SITES_NPZ, icsd_df['_database_code_ICSD'].fillna(0).astype(int), sites, offsets)
+
+    sum_composition = composition_matrix(icsd_df['_chemical_formula_sum'])
+    struct_composition = composition_matrix(icsd_df['_chemical_formula_structural'])
+    sparse.save_npz(COMPOSITION_NPZ, sum_composition)
+    icsd_df['nelements'] = n_elements(sum_composition)
+    add_mask_columns(icsd_df, sum_composition)
+    if container is not None and not args.without_cif:
+        with Dict_blob_reader(container) as reader:
+            icsd_df.insert(1, 'cif', list(reader))
     icsd_df.to_pickle(AUGMENTED_PKL)
+    storage.save("icsd", icsd_df, partition_on="nelements")
+
+    # pymatgen structures, only the new or changed cifs are parsed again
+    if 'cif' in icsd_df.columns:
+        convert_structures(icsd_df['id'], icsd_df['cif'], STRUCTURES_NPZ)
+    else:
+        with Dict_blob_reader(container) as reader:  # one cif at a time
+            convert_structures(icsd_df['id'], reader, STRUCTURES_NPZ)
     
-    icsd_df_no_cif = icsd_df.drop(columns=['cif'])
+    icsd_df_no_cif = icsd_df.drop(columns=['cif'], errors='ignore')
     icsd_df_no_cif.to_csv(FORMULA_CSV)    
     
-    icsd_df_formulas_sum_int = icsd_df_no_cif.loc[icsd_df['_chemical_formula_sum'].apply(fraction_composition)]
+    icsd_df_formulas_sum_int = icsd_df_no_cif.loc[is_stoichiometric(sum_composition)]
     icsd_df_formulas_sum_int.to_csv(INT_FORMULA_SUM_CSV)    
     
-    icsd_df_formulas_struct_int = icsd_df_no_cif.loc[icsd_df['_chemical_formula_structural'].apply(fraction_composition)]
+    icsd_df_formulas_struct_int = icsd_df_no_cif.loc[is_stoichiometric(struct_composition)]
     icsd_df_formulas_struct_int.to_csv(INT_FORMULA_STRUCT_CSV)    
     
\ No newline at end of file
@@ -1,29 +1,106 @@
 #!/usr/bin/env python3
 
+import sys
 import json
+import argparse
+import time
+import codecs
+import sqlite3
+import hashlib
+import threading
+from queue import Queue
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
 import pandas as pd
 import urllib.parse
 import xml.etree.ElementTree as ET
-import datetime
-
-today = datetime.date.today()
-YEAR = today.year
+import re
 
 HERE = Path(__file__).parent
+PARENT = Path(__file__).parent.parent
 ICSD_PKL = str(HERE/"icsd_cifs.pkl")
 ICSD_CREDENTIALS_JSON = str(HERE/"icsd_credentials.json")
+ICSD_STORE_DB = str(HERE/"icsd_cifs.sqlite")
+ICSD_ADDRESS = "https://icsd.fiz-karlsruhe.de/ws"  # or a local stand-in, see bench/fake_servers.py
+ICSD_METRICS_LOG = str(HERE/"metrics.jsonl")
+ICSD_METRICS_PROM = str(HERE/"metrics.prom")
+ICSD_CACHE_DB = str(HERE/"http_cache.sqlite")
+ICSD_CIFS_BLOBS = str(HERE/"icsd_cifs")  # .bin and .idx.npz, see save_cif_container
+ICSD_QUEUE_DB = str(HERE/"queue.sqlite")
+ICSD_WORKERS_DIR = str(HERE/"workers")
+SHARD_SIZE = 20000  # ids per shard of the queue, 20 batches of a session pool
+# cifs fetched with one token before logging in again. ICSD does not publish
+# its limit; a token refused earlier fails its batch, which is retried with a
+# new token (see `ICSD_session_pool.store_batch`)
+TOKEN_CIF_LIMIT = 10000
+CHUNK_SIZE = 2**16
+
+sys.path.append(str(PARENT))
+from common.instrument import METRICS
+from common.http_cache import HTTP_cache
+from common.blobs import train_dictionary, Dict_blob_writer
+from common.workqueue import Shard_queue, run_worker, default_worker_id
+
+# each cif of a /cif/multiple response is preceded by a line like
+# "#(C) 2020 by FIZ Karlsruhe - Leibniz Institute for ...", whatever the year
+CIF_SEPARATOR = re.compile(r"#\(C\) \d{4} by FIZ Karlsruhe")
+CIF_ICSD_CODE = re.compile(r"^_database_code_ICSD\s+(\d+)", flags=re.M)
+
+
+def cif_icsd_id(cif_str):
+    match = CIF_ICSD_CODE.search(cif_str)
+    if match is None:
+        raise ValueError(f"no _database_code_ICSD in cif: {cif_str[:80]}")
+    return int(match.group(1))
+
+
+class CIF_splitter():
+    """ Incremental splitter of a /cif/multiple response into cif strings.
+
+    Text is given to `feed` as it arrives, and each cif is yielded as soon as
+    the separator line of the next one (or the end of the response) is seen,
+    so at most one cif is held in memory.
+    """
+    def __init__(self):
+        self.partial_line = ""
+        self.lines = None  # None until the first separator
+
+    def add_line(self, line):
+        if CIF_SEPARATOR.match(line):
+            if self.lines is not None:
+                yield "\n".join(self.lines)
+            self.lines = []
+        elif self.lines is not None:
+            self.lines.append(line)
+
+    def feed(self, text):
+        lines = (self.partial_line + text).split("\n")
+        self.partial_line = lines.pop()
+        for line in lines:
+            yield from self.add_line(line)
+
+    def close(self):
+        if self.partial_line:
+            yield from self.add_line(self.partial_line)
+            self.partial_line = ""
+        if self.lines is not None:
+            yield "\n".join(self.lines)
+            self.lines = None
 
 
 class ICSD_Session():
-    def __init__(self, loginid, password):
-        self.address = "https://icsd.fiz-karlsruhe.de/ws"
+    def __init__(self, loginid, password, address=ICSD_ADDRESS, cache=None,
+                 token_cif_limit=TOKEN_CIF_LIMIT):
+        self.address = address
+        self.cache = cache  # an HTTP_cache for the cifs, or None
         self.loginid = loginid
         self.password = password
         self.session = requests.Session()
+        self.CIF_LIMIT = 1000  # per query
+        self.TOKEN_CIF_LIMIT = token_cif_limit  # per token before renewing it
+        self.TOKEN_MAX_AGE = 3000  # seconds, renew before the token expires
         self.login_token = self.login()  # sets self.login_token
-        self.CIF_LIMIT = 1000
 
     def __enter__(self):
         return self
@@ -32,35 +109,44 @@ class ICSD_Session():
         self.close()
 
     def close(self):
-        self.logout()
-        self.session.close()
+        try:
+            self.logout()
+        finally:
+            self.session.close()
 
     def login(self, verbose=True):
-        login_response = self.session.post(
-            url=self.address+"/auth/login",
-            data={
-                'loginid': self.loginid,
-                'password': self.password,
-            },
-            headers={
-                'accept': 'text/plain',
-                'Content-Type': 'application/x-www-form-urlencoded',
-            },
-        )
+        with METRICS.timed("icsd/auth/login") as info:
+            login_response = self.session.post(
+                url=self.address+"/auth/login",
+                data={
+                    'loginid': self.loginid,
+                    'password': self.password,
+                },
+                headers={
+                    'accept': 'text/plain',
+                    'Content-Type': 'application/x-www-form-urlencoded',
+                },
+            )
+            info["status"] = login_response.status_code
+            info["bytes"] = len(login_response.content)
 
         if login_response.text != "Authentication successful":
             raise ConnectionError(login_response.headers)
 
         self.login_token = login_response.headers['ICSD-Auth-Token']
+        self.token_cifs = 0
+        self.token_time = time.time()
         if verbose:
             print(f"logged in ICSD  (token={self.login_token})")
         return self.login_token
 
     def logout(self, verbose=True):
-        logout_response = self.session.get(
-            url=self.address+"/auth/logout",
-            headers={'ICSD-Auth-Token': self.login_token}
-        )
+        with METRICS.timed("icsd/auth/logout") as info:
+            logout_response = self.session.get(
+                url=self.address+"/auth/logout",
+                headers={'ICSD-Auth-Token': self.login_token}
+            )
+            info["status"] = logout_response.status_code
 
         if logout_response.text != "Logout successful":
             raise ConnectionError(logout_response.text)
@@ -68,18 +154,46 @@ class ICSD_Session():
             print(f"logged out ICSD (token={self.login_token})")
 
     def reconnect(self):
-        self.logout(verbose=False)
+        """ log out and in again with a new connection. The logout may fail
+        (revoked token, broken connection), the token is dropped anyway. """
+        METRICS.relogin("icsd")
+        try:
+            self.logout(verbose=False)
+        except Exception:  # requests errors are not all ConnectionError
+            pass
         self.session.close()
         self.session = requests.Session()
         self.login(verbose=False)
 
-    def raw_query(self, query_string, query_headers, **kwargs):
+    def renew_token_if_needed(self, n_cifs):
+        """ reconnect only if querying `n_cifs` more cifs would exceed the
+        limits of the current token """
+        too_many = self.token_cifs + n_cifs > self.TOKEN_CIF_LIMIT
+        too_old = time.time() - self.token_time > self.TOKEN_MAX_AGE
+        if too_many or too_old:
+            self.reconnect()
+
+    def raw_query(self, query_string, query_headers, cached=False, **kwargs):
+        """ GET `query_string`, through the cache if `cached`. Recorded in
+        METRICS as "icsd" + the path of the query, except streamed or cached
+        responses, recorded by the caller once read. """
         query_headers['ICSD-Auth-Token'] = self.login_token
+        if cached and self.cache is not None:
+            # the token is a header, so it is not part of the cache key
+            return self.cache.get(self.session, self.address+query_string, headers=query_headers)
+        timer_start = time.time()
         query_response = self.session.get(
             url=self.address+query_string,
             headers=query_headers,
             **kwargs
         )
+        if not kwargs.get("stream"):
+            METRICS.request(
+                "icsd" + query_string.split("?")[0],
+                time.time()-timer_start,
+                query_response.status_code,
+                len(query_response.content),
+            )
         return query_response
 
     def query_ids(self, search_string):
@@ -95,7 +209,10 @@ class ICSD_Session():
             list_of_ids = []
         return list_of_ids
 
-    def query_cifs(self, list_of_ids):
+    def iter_cifs(self, list_of_ids, cached=True):
+        """ generator of the cif strings of `list_of_ids`, split from the
+        response while it streams in. The response comes from the cache (if
+        any) when `cached`. """
         query_string = "/cif/multiple?"
         for icsd_id in list_of_ids:
             query_string += f"idnum={icsd_id}&"
@@ -103,10 +220,37 @@ class ICSD_Session():
         query_string += "celltype=standardized&windowsclient=false&filetype=cif"
         query_headers = {'accept': 'application/cif'}
 
-        query_results = self.raw_query(query_string, query_headers)
-        separator = f"\n#(C) {YEAR} by FIZ Karlsruhe - Leibniz Institute for Information Infrastructure.  All rights reserved.\n"
-        list_of_cifs = query_results.text.split(separator)[1:]  # the first entry is blank
-        return list_of_cifs
+        with METRICS.timed("icsd/cif/multiple") as info:
+            query_results = self.raw_query(query_string, query_headers, cached, stream=True)
+            from_cache = getattr(query_results, "from_cache", False)
+            info["status"] = "cache" if from_cache else query_results.status_code
+            if not from_cache:
+                self.token_cifs += len(list_of_ids)
+            decoder = codecs.getincrementaldecoder(query_results.encoding or "utf-8")("replace")
+            splitter = CIF_splitter()
+            n_cifs = 0
+            received = set()  # ids, to check the batch is complete
+            with query_results:
+                for chunk in query_results.iter_content(CHUNK_SIZE):
+                    info["bytes"] += 0 if from_cache else len(chunk)
+                    for cif in splitter.feed(decoder.decode(chunk)):
+                        n_cifs += 1
+                        received.update(CIF_ICSD_CODE.findall(cif)[:1])
+                        yield cif
+                for cif in splitter.feed(decoder.decode(b"", final=True)):
+                    n_cifs += 1
+                    received.update(CIF_ICSD_CODE.findall(cif)[:1])
+                    yield cif
+                for cif in splitter.close():
+                    n_cifs += 1
+                    received.update(CIF_ICSD_CODE.findall(cif)[:1])
+                    yield cif
+                if cached and self.cache is not None and received >= {str(int(i)) for i in list_of_ids}:
+                    query_results.commit()  # a short batch is never cached
+        METRICS.rows("icsd/cif/multiple", n_cifs)
+
+    def query_cifs(self, list_of_ids, cached=True):
+        return list(self.iter_cifs(list_of_ids, cached))
 
     def safe_query_cifs(self, list_of_ids):
         queue = list_of_ids
@@ -119,36 +263,387 @@ class ICSD_Session():
             while queue:
                 to_query = queue[:self.CIF_LIMIT]
                 queue = queue[self.CIF_LIMIT:]
+                self.renew_token_if_needed(len(to_query))
                 list_of_cifs.extend(self.query_cifs(to_query))
-                self.reconnect()
-                print(f"  reconnect {i}/{n_connect}  token:{self.login_token}")
+                print(f"  query {i}/{n_connect}  token:{self.login_token}")
                 i += 1
 
         return list_of_cifs
 
 
-def download_all(loginid, password, saved_file, min_N=1, max_N=22):
-    with ICSD_Session(loginid, password) as icsd:
-        id_list = []
-        cif_list = []
-        for N in range(min_N, max_N+1):
-            print(f"materials with {N} elements")
-            id_list.extend(icsd.query_ids(f"NUMBEROFELEMENTS: {N}"))
-            print(f"received {len(id_list)} ids")
-            print("querying cifs")
-            cif_list.extend(icsd.safe_query_cifs(id_list))
-            print(f"received {len(cif_list)}/{len(id_list)} cif strings")
-
-    icsd_dataframe = pd.DataFrame()
-    icsd_dataframe['id'] = id_list
-    icsd_dataframe['cif'] = cif_list
+class ICSD_session_pool():
+    """ Pool of authenticated `ICSD_Session`s fetching cif batches concurrently.
+
+    Each session keeps its own token and renews it only when the next batch
+    would exceed the token limits (or when a batch fails), instead of logging
+    out and in after every batch. Batches are dispatched to whichever session
+    is idle, and their cifs stored as they arrive (see `store_cifs`).
+    """
+    def __init__(self, loginid, password, n_sessions=4, address=ICSD_ADDRESS, cache=None,
+                 token_cif_limit=TOKEN_CIF_LIMIT):
+        self.sessions = []
+        try:
+            for _ in range(n_sessions):
+                self.sessions.append(ICSD_Session(loginid, password, address, cache, token_cif_limit))
+        except Exception:
+            try:  # ICSD limits the tokens of an account, none must be left open
+                self.close()
+            except Exception:
+                pass
+            raise
+        self.idle = Queue()
+        for session in self.sessions:
+            self.idle.put(session)
+        self.CIF_LIMIT = self.sessions[0].CIF_LIMIT
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """ log out every session, even if some of the logouts fail """
+        errors = []
+        for session in self.sessions:
+            try:
+                session.close()
+            except Exception as exc:
+                errors.append(exc)
+        if errors:
+            raise errors[0]
+
+    def query_ids(self, search_string):
+        return self.sessions[0].query_ids(search_string)
+
+    def store_batch(self, batch, store, max_attempts=3, cached=True):
+        """ stream the cifs of `batch` into `store` one by one as they arrive,
+        retrying the ids that did not arrive, and return the number of new or
+        changed entries """
+        icsd = self.idle.get()
+        n_written = 0
+        remaining = batch
+        try:
+            for attempt in range(max_attempts):
+                try:
+                    icsd.renew_token_if_needed(len(remaining))
+                    received = set()
+                    for cif in icsd.iter_cifs(remaining, cached):
+                        icsd_id = cif_icsd_id(cif)
+                        n_written += store.put(icsd_id, cif)
+                        received.add(icsd_id)
+                    store.commit()
+                    remaining = [i for i in remaining if int(i) not in received]
+                    if remaining:
+                        raise ConnectionError(f"{len(remaining)} cifs missing from batch")
+                    return n_written
+                except Exception as exc:
+                    store.commit()  # keep the cifs received before the failure
+                    if attempt+1 == max_attempts:
+                        raise exc
+                    METRICS.retry("icsd/cif/multiple")
+                    icsd.reconnect()  # the token may have been revoked, and is not leaked
+        finally:
+            self.idle.put(icsd)
+
+    def store_cifs(self, list_of_ids, store, cached=True):
+        """ fetch the cifs of `list_of_ids` into `store`, batches in parallel,
+        and return the number of new or changed entries. With `cached`
+        False, the cifs are downloaded again even if in the http cache. """
+        batches = [
+            list_of_ids[i:i+self.CIF_LIMIT]
+            for i in range(0, len(list_of_ids), self.CIF_LIMIT)
+        ]
+        n_written = 0
+        with ThreadPoolExecutor(max_workers=len(self.sessions)) as executor:
+            futures = [
+                executor.submit(self.store_batch, batch, store, 3, cached)
+                for batch in batches
+            ]
+            for i, future in enumerate(as_completed(futures)):
+                n_written += future.result()
+                print(f"  batch {i+1}/{len(batches)}", end="\r")
+        return n_written
+
+
+class ICSD_cif_store():
+    """ Local sqlite store of cif strings keyed by ICSD id.
+
+    Each cif is stored with the sha256 of its content, so a sync can tell
+    new, changed and unchanged entries apart, and writes only the first two.
+    """
+    def __init__(self, path=ICSD_STORE_DB):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS cifs ("
+                " id INTEGER PRIMARY KEY,"
+                " sha256 TEXT NOT NULL,"
+                " cif TEXT NOT NULL,"
+                " updated REAL NOT NULL)"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM cifs").fetchone()[0]
+
+    def ids(self):
+        with self.lock:
+            return {row[0] for row in self.connection.execute("SELECT id FROM cifs")}
+
+    def hashes(self, list_of_ids=None):
+        with self.lock:
+            rows = self.connection.execute("SELECT id, sha256 FROM cifs").fetchall()
+        hashes = dict(rows)
+        if list_of_ids is not None:
+            hashes = {int(i): hashes.get(int(i)) for i in list_of_ids}
+        return hashes
+
+    def get(self, icsd_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT cif FROM cifs WHERE id = ?", (int(icsd_id),)
+            ).fetchone()
+        if row is None:
+            raise KeyError(icsd_id)
+        return row[0]
+
+    def put(self, icsd_id, cif):
+        """ stage one cif if it is new or changed (see `commit`), and return
+        whether it was """
+        sha256 = hashlib.sha256(cif.encode()).hexdigest()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT sha256 FROM cifs WHERE id = ?", (int(icsd_id),)
+            ).fetchone()
+            if row is not None and row[0] == sha256:
+                return False
+            self.connection.execute(
+                "INSERT OR REPLACE INTO cifs (id, sha256, cif, updated) VALUES (?, ?, ?, ?)",
+                (int(icsd_id), sha256, cif, time.time()),
+            )
+        return True
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def put_many(self, list_of_ids, list_of_cifs):
+        """ store the cifs, and return the number of new or changed entries """
+        known = self.hashes(list_of_ids)
+        rows = []
+        now = time.time()
+        for icsd_id, cif in zip(list_of_ids, list_of_cifs):
+            sha256 = hashlib.sha256(cif.encode()).hexdigest()
+            if known[int(icsd_id)] != sha256:
+                rows.append((int(icsd_id), sha256, cif, now))
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO cifs (id, sha256, cif, updated) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+        return len(rows)
+
+    def delete(self, list_of_ids):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "DELETE FROM cifs WHERE id = ?", [(int(i),) for i in list_of_ids]
+            )
+
+    def to_dataframe(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT id, cif FROM cifs ORDER BY id").fetchall()
+        icsd_dataframe = pd.DataFrame(rows, columns=['id', 'cif'])
+        icsd_dataframe['id'] = icsd_dataframe['id'].astype(str)
+        return icsd_dataframe
+
+
+def query_all_ids(icsd, min_N=1, max_N=22):
+    all_ids = set()
+    for N in range(min_N, max_N+1):
+        id_list = icsd.query_ids(f"NUMBEROFELEMENTS: {N}")
+        print(f"received {len(id_list)} ids of materials with {N} elements")
+        all_ids.update(int(i) for i in id_list)
+    return all_ids
+
+
+def sync(icsd, store, min_N=1, max_N=22, recheck_query=None):
+    """ bring the store up to date with the server: fetch the cifs of the ids
+    missing from the store, drop the ids no longer on the server, and re-fetch
+    the ids returned by the expert search `recheck_query` (if any) to pick up
+    entries changed since the last sync. Only new or changed cifs are written.
+    """
+    server_ids = query_all_ids(icsd, min_N, max_N)
+    stored_ids = store.ids()
+    missing = sorted(server_ids - stored_ids)
+    removed = sorted(stored_ids - server_ids)
+    recheck = []
+    if recheck_query is not None:
+        recheck = sorted((set(int(i) for i in icsd.query_ids(recheck_query)) & stored_ids) - set(missing))
+    print(f"{len(stored_ids)} stored, {len(missing)} missing, {len(removed)} removed, {len(recheck)} to recheck")
+
+    n_written = icsd.store_cifs(missing, store)
+    n_written += icsd.store_cifs(recheck, store, cached=False)  # must see the changes
+    store.delete(removed)
+    print(f"\n{n_written} new or changed cif strings written, {len(store)} in store")
+    return n_written
+
+
+def save_cif_container(ids, cifs, path=ICSD_CIFS_BLOBS, n_samples=5000):
+    """ save the cifs in a compact container (see `common.blobs.Dict_blob_writer`)
+    compressed with a dictionary trained on `n_samples` of them: copyright
+    header, loop headers and symmetry operations common to many cifs are
+    stored once. Read them back with `Dict_blob_reader(path)`, by id (as
+    str) or by position. """
+    cifs = list(cifs)
+    step = max(len(cifs)//n_samples, 1)
+    dictionary = train_dictionary(cifs[::step])
+    with Dict_blob_writer(path, dictionary) as writer:
+        for icsd_id, cif in zip(ids, cifs):
+            writer.add(str(icsd_id), cif)
+
+
+def download_all(loginid, password, saved_file, min_N=1, max_N=22, n_sessions=4, recheck_query=None,
+                 address=ICSD_ADDRESS):
+    METRICS.open(ICSD_METRICS_LOG, ICSD_METRICS_PROM)
+    try:
+        with ICSD_cif_store() as store, HTTP_cache(ICSD_CACHE_DB) as cache:
+            with ICSD_session_pool(loginid, password, n_sessions, address, cache) as icsd:
+                sync(icsd, store, min_N, max_N, recheck_query)
+            icsd_dataframe = store.to_dataframe()
+    finally:
+        print("\n" + METRICS.summary())
+        METRICS.close()
     icsd_dataframe.to_pickle(saved_file)
+    save_cif_container(icsd_dataframe['id'], icsd_dataframe['cif'])
 
 
-if __name__ == "__main__":
+def queue_shards(loginid, password, queue_path=ICSD_QUEUE_DB, min_N=1, max_N=22,
+                 address=ICSD_ADDRESS, shard_size=SHARD_SIZE, reset=False):
+    """ query the ids on the server, drop the ids no longer there from the
+    local store, and add the missing ones to the shared queue in shards of
+    `shard_size` ids. A queue made with other parameters is refused, or
+    emptied first with `reset`. """
+    with ICSD_cif_store() as store:
+        with ICSD_Session(loginid, password, address) as icsd:
+            server_ids = query_all_ids(icsd, min_N, max_N)
+        stored_ids = store.ids()
+        missing = sorted(server_ids - stored_ids)
+        removed = sorted(stored_ids - server_ids)
+        store.delete(removed)
+    print(f"{len(stored_ids)} stored, {len(missing)} missing, {len(removed)} removed")
+    shards = [
+        (f"ids_{missing[i]:07d}_{missing[min(i+shard_size, len(missing))-1]:07d}",
+         {"ids": missing[i:i+shard_size]})
+        for i in range(0, len(missing), shard_size)
+    ]
+    with Shard_queue(queue_path) as queue:
+        queue.add(shards, [address, min_N, max_N, shard_size], reset)
+        print(f"{len(shards)} shards queued in {queue_path}: {queue.counts()}")
+
+
+def work_on_shards(loginid, password, queue_path, worker, n_sessions=4,
+                   address=ICSD_ADDRESS, cache_path=None):
+    """ fetch the cifs of the queued shards into a store of this worker,
+    `workers/<worker>.sqlite`, until the queue is empty. The http cache is
+    the worker's own too, `workers/<worker>.http_cache.sqlite` by default,
+    as workers on several machines cannot share a sqlite file. """
+    directory = Path(ICSD_WORKERS_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    store_path = str(directory / f"{worker}.sqlite")
+    METRICS.open(str(directory / f"{worker}.metrics.jsonl"), str(directory / f"{worker}.metrics.prom"))
+    try:
+        cache_path = cache_path or str(directory / f"{worker}.http_cache.sqlite")
+        with ICSD_cif_store(store_path) as store, HTTP_cache(cache_path, wal=False) as cache:
+            with ICSD_session_pool(loginid, password, n_sessions, address, cache) as icsd:
+
+                def process(name, payload):
+                    stored = store.ids()
+                    ids = [i for i in payload["ids"] if i not in stored]  # resumed shard
+                    icsd.store_cifs(ids, store)
+                    return {"store": store_path}
+
+                with Shard_queue(queue_path) as queue:
+                    n_done = run_worker(queue, process, worker)
+    finally:
+        print("\n" + METRICS.summary())
+        METRICS.close()
+    print(f"{worker} fetched {n_done} shards")
+
+
+def merge_shards(saved_file, queue_path=ICSD_QUEUE_DB):
+    """ copy the cifs fetched by the workers into the local store, and save
+    it as `download_all` does """
+    with ICSD_cif_store() as store:
+        with Shard_queue(queue_path) as queue:
+            if not queue.is_finished() or queue.failures():
+                print(f"WARNING: the queue is not complete: {queue.counts()}")
+            results = queue.results()
+        n_written = 0
+        for store_path in sorted({result["store"] for _, _, result in results}):
+            with ICSD_cif_store(store_path) as worker_store:
+                worker_df = worker_store.to_dataframe()
+            n_written += store.put_many(worker_df['id'].astype(int), worker_df['cif'])
+        print(f"{n_written} new or changed cif strings merged, {len(store)} in store")
+        icsd_dataframe = store.to_dataframe()
+    icsd_dataframe.to_pickle(saved_file)
+    save_cif_container(icsd_dataframe['id'], icsd_dataframe['cif'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="download all the cifs of ICSD")
+    parser.add_argument(
+        "mode", nargs="?", default="local", choices=["local", "coordinator", "worker", "merge"],
+        help="local: download everything in this process (default);"
+        " coordinator: queue the missing ids for workers; worker: fetch queued ids"
+        " (run any number, on any machine sharing this directory);"
+        " merge: gather the cifs of the workers into the local store",
+    )
+    parser.add_argument("--queue", default=ICSD_QUEUE_DB, help="sqlite file of the shared queue")
+    parser.add_argument("--worker-id", default=None, help="default hostname-pid")
+    parser.add_argument("--sessions", type=int, default=4, help="concurrent sessions per worker")
+    parser.add_argument("--address", default=ICSD_ADDRESS)
+    parser.add_argument(
+        "--recheck-query", default=None,
+        help="local: ICSD expert search of stored entries to fetch again, bypassing the"
+        " http cache, like the entries changed since the last download",
+    )
+    parser.add_argument(
+        "--reset-queue", action="store_true",
+        help="coordinator: drop the shards of a queue made with other parameters",
+    )
+    args = parser.parse_args()
+
+    if args.mode == "merge":
+        merge_shards(ICSD_PKL, args.queue)
+        return
     with open(ICSD_CREDENTIALS_JSON, "r") as f:
         credentials = json.load(f)
     usrname = credentials["loginid"]
     passwrd = credentials["password"]
-    download_all(usrname, passwrd, ICSD_PKL)
+    if args.mode == "coordinator":
+        queue_shards(usrname, passwrd, args.queue, address=args.address, reset=args.reset_queue)
+    elif args.mode == "worker":
+        work_on_shards(
+            usrname, passwrd, args.queue, args.worker_id or default_worker_id(),
+            args.sessions, args.address,
+        )
+    else:
+        download_all(
+            usrname, passwrd, ICSD_PKL, n_sessions=args.sessions,
+            recheck_query=args.recheck_query, address=args.address,
+        )
 
+
+if __name__ == "__main__":
+    main()
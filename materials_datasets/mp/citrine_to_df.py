@@ -1,41 +1,66 @@
 #!/usr/bin/env python3
 
-import pandas as pd
+import sys
 from pathlib import Path  ## for os-agnostic paths
 
 HERE = Path(__file__).parent
+PARENT = Path(__file__).parent.parent
 CITRINE_MP_JSON = str(HERE/"citrine_MP_ICSD_compounds_PIFs.json")
-CITRINE_MP_PKL = str(HERE/"citrine_mp.pkl")
 
-def unfold_ids(ids_list):
-    return pd.Series({id_dict['name']:id_dict['value'] for id_dict in ids_list})
+sys.path.append(str(PARENT))
+from common.jsonstream import JSON_array_decoder
+from common.columns import Column_buffers
 
-def unfold_properties(prop_list):
-    return pd.Series({prop['name']:prop['scalars'] for prop in prop_list})
+DROPPED_KEYS = ["ids", "properties", "tags", "references"]
+READ_SIZE = 2**20
+
+
+def unfold_record(pif):
+    """ one row of the table: the top-level values of a PIF record, its `ids`
+    by name, and the `scalars` of its `properties` by name """
+    row = {key: value for key, value in pif.items() if key not in DROPPED_KEYS}
+    for id_dict in pif.get("ids") or []:
+        row[id_dict['name']] = id_dict['value']
+    for prop in pif.get("properties") or []:
+        row[prop['name']] = prop.get('scalars')
+    return row
+
+def iter_pif_chunks(filename, chunk_size=20000):
+    """ generator of DataFrames of `chunk_size` rows, built while walking the
+    json array of PIF records one record at a time """
+    decoder = JSON_array_decoder(key=None)
+    buffers = Column_buffers(chunk_size)
+
+    def records():
+        with open(filename, "rb") as f:
+            for data in iter(lambda: f.read(READ_SIZE), b""):
+                yield from decoder.feed(data)
+        yield from decoder.close()
+
+    for pif in records():
+        buffers.append(unfold_record(pif))
+        if len(buffers) == chunk_size:
+            yield buffers.to_dataframe()
+            buffers = Column_buffers(chunk_size)
+    if len(buffers):
+        yield buffers.to_dataframe()
 
 def main():
-    print("reading PIF file")
-    citrine_mp_df = pd.read_json(CITRINE_MP_JSON)
-    print("unfolding ids")
-    citrine_mp_df = citrine_mp_df.merge(
-        citrine_mp_df["ids"].apply(unfold_ids),
-        left_index=True,
-        right_index=True
-    )
-
-    print("unfolding properties")
-    citrine_mp_df = citrine_mp_df.merge(
-        citrine_mp_df["properties"].apply(unfold_properties),
-        left_index=True,
-        right_index=True
-    )
-    print("saving")
-    citrine_mp_df.pop("ids")
-    citrine_mp_df.pop("properties")
-    citrine_mp_df.pop("tags")
-    citrine_mp_df.pop("references")
-    citrine_mp_df.to_pickle(CITRINE_MP_PKL)
-    print("done")
+    """ save the PIF records as the parquet dataset `datasets/citrine_mp`, one
+    part per chunk, so that memory does not grow with the file. Read it back
+    with `common.storage.load("citrine_mp")`. """
+    from common import storage
+
+    def chunks():
+        n_records = 0
+        for chunk in iter_pif_chunks(CITRINE_MP_JSON):
+            n_records += len(chunk)
+            print(f"  {n_records} records", end="\r")
+            yield chunk
+
+    print("reading and unfolding PIF file")
+    storage.save_parts("citrine_mp", chunks())
+    print("\ndone")
 
 if __name__ == "__main__":
     main()
@@ -3,14 +3,31 @@
 from pymatgen.ext.matproj import MPRester  ## to access MP database
 import pandas as pd  ## provides a fast spreadsheet object (DataFrame)
 from pathlib import Path  ## for os-agnostic paths
-from copy import deepcopy
 import numpy as np
+import sys
 import json
+import warnings
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 HERE = Path(__file__).parent
+PARENT = Path(__file__).parent.parent
 MATERIALS_PROJECT_PKL = str(HERE/"materials_project.pkl")
 API_KEY_JSON = str(HERE/"api_key.json")
+MP_BLOBS_DIR = HERE/"blobs"
+MP_STRUCTURES_NPZ = str(HERE/"structures.npz")
+MP_METRICS_LOG = str(HERE/"metrics.jsonl")
+MP_METRICS_PROM = str(HERE/"metrics.prom")
+
+sys.path.append(str(PARENT))
+from common.columns import Column_buffers
+from common.blobs import Blob_writer, Blob_reader
+from common.instrument import METRICS
+from common.structures import convert_structures
+from common.formula import composition_matrix
+from common.bitmask import add_mask_columns
+from common import storage
 
 
 # available properties and description are hard to find, see:
@@ -92,80 +109,323 @@ ALL_KNOWN_PROPERTIES = [
 ]
 
 
+def shard_criteria(shard):
+    """ query criteria of a shard (nelements, nsites_min, nsites_max), where
+    nelements may be a tuple (n, None) for "n or more", and nsites_max may be
+    None for "nsites_min or more" """
+    nelements, nsites_min, nsites_max = shard
+    if isinstance(nelements, tuple):
+        nelements = {"$gte": nelements[0]}
+    nsites = {"$gte": nsites_min}
+    if nsites_max is not None:
+        nsites["$lte"] = nsites_max
+    return {"nelements": nelements, "nsites": nsites}
+
+
+def can_count(rester):
+    """ whether `rester` is the legacy `MPRester` (pymatgen before 2023),
+    whose requests to the /query endpoint can count documents """
+    return callable(getattr(rester, "_make_request", None))
+
+
+def count_documents(rester, shard):
+    """ number of materials in a shard, from a count_only query (as the one
+    `MPRester.query` makes before downloading by chunks), without downloading
+    their ids; None if `rester` cannot count """
+    if not can_count(rester):
+        return None
+    # MPRester hides the responses, so no status code or size is recorded
+    with METRICS.timed("mp/query/count"):
+        return rester._make_request(
+            "/query",
+            payload={
+                "criteria": json.dumps(shard_criteria(shard)),
+                "properties": json.dumps(["material_id"]),
+                "options": json.dumps({"count_only": True}),
+            },
+            method="POST",
+        )
+
+
+def plan_shards(
+    rester,
+    min_nelements=1,
+    max_nelements=10,
+    max_nsites=500,
+    max_shard_size=5000,
+):
+    """ split the materials into shards of at most `max_shard_size` documents
+    (when possible) which together cover every material exactly once.
+
+    Shards start as one nsites range [1, max_nsites] per nelements value, plus
+    open-ended shards for nelements >= max_nelements and nsites > max_nsites.
+    Each shard is counted, and those too large are split in two along nsites
+    until they fit (or cover a single nsites value). Empty shards are dropped.
+    Returns a list of (shard, count). If `rester` cannot count documents (see
+    `can_count`), the shards are neither split nor dropped, and their count
+    is None.
+    """
+    if not can_count(rester):
+        warnings.warn(
+            "this MPRester cannot count documents (the legacy MPRester of pymatgen"
+            " before 2023 can), the shards are not split by size"
+        )
+    to_count = []
+    for nelements in range(min_nelements, max_nelements):
+        to_count.append((nelements, 1, max_nsites))
+        to_count.append((nelements, max_nsites+1, None))
+    to_count.append(((max_nelements, None), 1, None))
+
+    shards = []
+    while to_count:
+        shard = to_count.pop()
+        count = count_documents(rester, shard)
+        nelements, nsites_min, nsites_max = shard
+        if count is None:
+            shards.append((shard, count))
+        elif count > max_shard_size and nsites_max is not None and nsites_max > nsites_min:
+            middle = (nsites_min + nsites_max)//2
+            to_count.append((nelements, nsites_min, middle))
+            to_count.append((nelements, middle+1, nsites_max))
+        elif count > 0:
+            shards.append((shard, count))
+    return shards
+
+
+def iter_materials_project(
+    apikey,
+    min_nelements=1,
+    max_nelements=10,
+    max_nsites=500,
+    chunk_size=5000,
+    properties=ALL_KNOWN_PROPERTIES,
+    n_workers=4,
+    endpoint=None,
+):
+    """ generator of the materials (dictionaries) of the materials project,
+    downloaded by shards (see `plan_shards`) on a pool of `n_workers` threads,
+    each with its own `MPRester` (on `endpoint` if given, for example a local
+    stand-in from bench/fake_servers.py). Materials are yielded as their shard
+    completes. """
+    local = threading.local()
+
+    def get_rester():
+        if not hasattr(local, "rester"):
+            if endpoint is None:
+                local.rester = MPRester(apikey)
+            else:
+                local.rester = MPRester(apikey, endpoint=endpoint)
+        return local.rester
+
+    print("planning queries")
+    shards = plan_shards(
+        get_rester(), min_nelements, max_nelements, max_nsites, chunk_size
+    )
+    if all(count is not None for _, count in shards):
+        print(f"downloading {sum(count for _, count in shards)} items in {len(shards)} queries")
+    else:
+        print(f"downloading {len(shards)} queries")
+
+    def query_shard(shard):
+        with METRICS.timed("mp/query"):
+            materials = get_rester().query(
+                criteria=shard_criteria(shard),
+                properties=properties,
+                chunk_size=chunk_size,
+            )
+        METRICS.rows("mp/query", len(materials))
+        return materials
+
+    seen_ids = set()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(query_shard, shard) for shard, _ in shards]
+        for i, future in enumerate(as_completed(futures)):
+            for material in future.result():
+                material_id = material.get("material_id")
+                if material_id in seen_ids:
+                    continue
+                seen_ids.add(material_id)
+                yield material
+            print(f"completed query {i+1}/{len(shards)}", end="\r")
+    print()
+
+
 def download_all_materials_project(
     apikey, 
     min_nelements=1, 
     max_nelements=10, 
     max_nsites=500, 
-    nsites_step=500,
     chunk_size=5000,
     properties=ALL_KNOWN_PROPERTIES,
+    n_workers=4,
+    endpoint=None,
 ):
     """ Download all data from the materials project and returns a list of
     dictionnary.
     
-    Only 124 331 out of 124 515 materials claimed on the website are obtainable.
-    the database is downloaded by a sequence of queries, each one is for a given
-    number of elements in the materials and then number of sites. Queries are
-    broken into chunks to prevent exceeding the limit size allowed.
+    The database is downloaded by a set of queries (shards) over nelements and
+    nsites planned by `plan_shards`: each shard is counted first and split
+    until it holds at most `chunk_size` materials, and together they cover
+    every material exactly once (the previous fixed windows skipped, for
+    example, all structures with exactly 1 site). The shards are queried
+    concurrently on `n_workers` threads.
 
     Parameters:
-    - max_nelements: the maximum value of nelements used in query loop
-    - max_nsites: the maximum value of nsites used for each nvalues
-    - nsites_step: number of different value taken by nsites in each queries
-    - chunk_size: size to break queries
+    - min_nelements, max_nelements: nelements values queried one by one,
+    materials with more than max_nelements are queried together
+    - max_nsites: nsites range initially split, larger materials are queried
+    together
+    - chunk_size: maximum size of a shard, and size to break queries
     - properties: the properties to be downloaded (affect the size of queries)
     some properties are dictionnary themselves and may require to be unrolled
     (magnetism as an example in the source file of this function)
+    - n_workers: number of concurrent queries
+    - endpoint: url of the REST API, None for MPRester's default
 
     """
-    rester = MPRester(apikey)
-    list_of_dict = []
-    print("downloading items (multiple queries required)")
-    for nelements in range(min_nelements, max_nelements+1):
-        for nsites in range(1, max_nsites, nsites_step+1):
-            query = rester.query(
-                criteria= {
-                    "nelements": nelements, 
-                    "nsites": {
-                        "$gt": nsites,
-                        "$lt": nsites+nsites_step+1, 
-                    }
-                },
-                properties=properties,
-                chunk_size=chunk_size,
-            )
-            list_of_dict.extend(query)
-    return list_of_dict
-
-
-def unfold_magnetism(mp_list):
-    mp_list = deepcopy(mp_list)
-    new_list = []
-    print("unfolding magnetism")
-    for mat in mp_list:
-        try:
-            magnetism = mat.pop('magnetism')
-            magnetism['num_magnetic_sites'] = int(magnetism.pop('num_magnetic_sites'))  # str to int
-            magnetism['true_total_magnetization'] = magnetism.pop('total_magnetization')  # different from mp's "total magnetisation" which is the total magnetisation per formula
-            mat.update(magnetism)
-            new_list.append(mat)
-        except KeyError:
-            pass
-    return mp_list
+    return list(iter_materials_project(
+        apikey,
+        min_nelements,
+        max_nelements,
+        max_nsites,
+        chunk_size,
+        properties,
+        n_workers,
+        endpoint,
+    ))
+
+
+# How nested properties are flattened into columns: the sub-keys of each
+# property become columns named `prefix + sub-key`, or `rename[sub-key]`, and
+# are converted with `types[sub-key]` if given. Deeper values (tensors,
+# nested dicts) are kept as they are in their column.
+FLATTEN_SCHEMA = {
+    "magnetism": {
+        "prefix": "",
+        "rename": {
+            # different from mp's "total magnetisation" which is the total magnetisation per formula
+            "total_magnetization": "true_total_magnetization",
+        },
+        "types": {"num_magnetic_sites": int},  # str to int
+    },
+    "spacegroup": {"prefix": "spacegroup_"},
+    "elasticity": {"prefix": "elasticity_"},
+    "diel": {"prefix": "diel_"},
+    "reduced_cell_formula": {"prefix": "reduced_cell_formula_"},
+}
+
+# values replaced in the same pass
+FIXED_VALUES = {
+    "efermi": {"None": np.nan},  # bug: string "None" instead of NoneType None
+}
+
+
+def normalize_material(material, schema=FLATTEN_SCHEMA, fixed_values=FIXED_VALUES):
+    """ flatten the nested properties of one material in place (see
+    FLATTEN_SCHEMA), replace known bad values, and return it """
+    for prop, rules in schema.items():
+        nested = material.pop(prop, None)
+        if not isinstance(nested, dict):
+            continue
+        rename = rules.get("rename", {})
+        types = rules.get("types", {})
+        for key, value in nested.items():
+            if key in types and value is not None:
+                value = types[key](value)
+            material[rename.get(key, rules["prefix"] + key)] = value
+    for prop, replacements in fixed_values.items():
+        value = material.get(prop)
+        if isinstance(value, str) and value in replacements:
+            material[prop] = replacements[value]
+    return material
+
+
+# heavy properties kept out of the main table, in the blob store
+BLOB_PROPERTIES = [
+    "band_structure",
+    "bandstructure_uniform",
+    "dos",
+    "cif",
+    "entry",
+    "doi_bibtex",
+]
+
+
+def blob_json(value):
+    """ json of a property, pymatgen objects (like the ComputedEntry of
+    `entry`) are saved with their `as_dict` representation """
+    return json.dumps(value, default=lambda obj: obj.as_dict())
+
+
+class MP_blob_store:
+    """ Lazy, read-only access to the heavy properties of the materials, kept
+    in one compressed, memory-mapped blob file per property, keyed by
+    material_id. The values are decoded from json, so pymatgen objects come
+    back as their dictionary representation.
+
+        blobs = MP_blob_store()
+        cif = blobs.get("mp-149", "cif")
+    """
+    def __init__(self, directory=MP_BLOBS_DIR):
+        self.directory = Path(directory)
+        self.readers = {}
+
+    def reader(self, prop):
+        if prop not in self.readers:
+            self.readers[prop] = Blob_reader(self.directory/prop)
+        return self.readers[prop]
+
+    def get(self, material_id, prop):
+        return json.loads(self.reader(prop).get(material_id))
+
+    def has(self, material_id, prop):
+        return material_id in self.reader(prop)
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+
+
+def convert_mp_structures(directory=MP_BLOBS_DIR, saved_file=MP_STRUCTURES_NPZ):
+    """ convert the cifs of the blob store to `common.structures.Structure_arrays`,
+    reusing the structures of `saved_file` whose cif did not change """
+    with Blob_reader(Path(directory)/"cif") as reader:
+        material_ids = reader.keys.tolist()
+        cifs = [json.loads(reader.get_at(i)) for i in range(len(reader))]
+    return convert_structures(material_ids, cifs, saved_file)
+
+
+def write_blobs(material, writers):
+    """ move the heavy properties of a material to their blob writers """
+    for prop, writer in writers.items():
+        value = material.pop(prop, None)
+        if value is not None:
+            writer.add(material["material_id"], blob_json(value))
+    return material
 
 
 def main():
     with open(API_KEY_JSON, "r") as f:
         api_key = json.load(f)["api_key"]
-    mp_list = download_all_materials_project(api_key)
-    mp_list_w_mag = unfold_magnetism(mp_list)
-    df = pd.DataFrame(mp_list_w_mag)
-    try: df['efermi'] = df['efermi'].replace('None', np.nan )  # bug: string "None" instead of NoneType None
-    except KeyError: pass
+    MP_BLOBS_DIR.mkdir(exist_ok=True)
+    writers = {prop: Blob_writer(MP_BLOBS_DIR/prop) for prop in BLOB_PROPERTIES}
+    buffers = Column_buffers()
+    METRICS.open(MP_METRICS_LOG, MP_METRICS_PROM)
+    try:
+        for material in iter_materials_project(api_key):
+            buffers.append(normalize_material(write_blobs(material, writers)))
+    finally:
+        print(METRICS.summary())
+        METRICS.close()
+    for writer in writers.values():
+        writer.close()
+    df = buffers.to_dataframe()
+    add_mask_columns(df, composition_matrix(df["pretty_formula"]))
     print("saving")
     df.to_pickle(MATERIALS_PROJECT_PKL)
+    storage.save("mp", df, partition_on="nelements")
     print(f"{len(df)} materials saved")
+    convert_mp_structures()
 
 
 if __name__ == "__main__":
@@ -1,16 +1,48 @@
 #!/usr/bin/env python3
 
+import os
+import sys
 import time
 import json
+import random
+import zlib
+import argparse
+import threading
 from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import asyncio
 
 import requests
+import aiohttp
 import pandas as pd
 
 HERE = Path(__file__).parent
+PARENT = Path(__file__).parent.parent
+sys.path.append(str(PARENT))
+from common.jsonstream import JSON_array_decoder
+from common.columns import Column_buffers
+from common.instrument import METRICS
+from common.http_cache import HTTP_cache
+from common.structures import optimade_structures
+from common.formula import composition_matrix
+from common.bitmask import add_mask_columns
+from common.workqueue import Shard_queue, run_worker, default_worker_id
+from common import storage
+
 OQMD_PKL = str(HERE / "oqmd.pkl")
+OQMD_PARTS_DIR = str(HERE / "parts")
+OQMD_METRICS_LOG = str(HERE / "metrics.jsonl")
+OQMD_METRICS_PROM = str(HERE / "metrics.prom")
+OQMD_CACHE_DB = str(HERE / "http_cache.sqlite")
+OQMD_QUEUE_DB = str(HERE / "queue.sqlite")
+OQMD_STRUCTURES_NPZ = str(HERE / "structures.npz")
+ENDPOINT = "oqmd/structures"
+OQMD_HOST = "http://oqmd.org"  # or a local stand-in, see bench/fake_servers.py
+CHUNK_SIZE = 2**16
+START = 0
+STOP = 637644
+PER_PARTS = 400  # the 8 queries required by a 800 per_parts often failed
+PARTS_WINDOW = 32  # parts downloaded at once by the async engine, 128 pages
 
 
 class OQMD_multi_session:
@@ -21,11 +53,13 @@ class OQMD_multi_session:
         stop_at=637644,
         start_at=0,
         max_connections=8,
+        host=OQMD_HOST,
+        cache=None,
     ):
         if use_optimade:
-            self.address = "http://oqmd.org/optimade/structures?"  # for optimade API
+            self.address = host + "/optimade/structures?"  # for optimade API
         else:
-            self.address = "http://oqmd.org/oqmdapi/entry?"  # for official oqmd API (slower, max 100 items, and column names are different)
+            self.address = host + "/oqmdapi/entry?"  # for official oqmd API (slower, max 100 items, and column names are different)
             if limit_per_page > 100:
                 limit_per_page = 100
 
@@ -39,138 +73,734 @@ class OQMD_multi_session:
             self.n_urls += 1
 
         self.max_connections = min(max_connections, self.n_urls)  # tested above 8 without speed gain
+        self.cache = cache  # an HTTP_cache, or None
     
-    def get_urls(self):
-        url = self.address + f"&natom=<100&limit={self.limit_per_page}"
-        urls = [
-            url + f"&offset={self.limit_per_page*i + self.start_at}"
-            for i in range(self.n_urls)
-        ]
+    def page_offsets(self):
+        return [self.limit_per_page*i + self.start_at for i in range(self.n_urls)]
 
-        print(f"materials {self.start_at} to {self.stop_at} in {len(urls)} queries")
-        print(f"  {urls[0]}\n  {urls[1]}\n  ...and so on")
-        return urls
+    def page_url(self, offset):
+        return self.address + f"&natom=<100&limit={self.limit_per_page}&offset={offset}"
 
     def single_query(self, url):
-        return requests.get(url, params=None, verify=True)
+        if self.cache is not None:
+            return self.cache.get(requests, url, verify=True)
+        return requests.get(url, params=None, verify=True, stream=True)
+
+    def fetch_page(self, offset):
+        """ download and decode one page into `Column_buffers` """
+        with METRICS.timed(ENDPOINT) as info:
+            response = self.single_query(self.page_url(offset))
+            with response:  # releases the connection on errors too
+                info["status"] = response.status_code
+                if response.status_code != 200:
+                    raise ConnectionError(f"offset {offset} response: {response.status_code}")
+                chunks = response.iter_content(CHUNK_SIZE)
+                if getattr(response, "from_cache", False):
+                    info["status"] = "cache"
+                else:
+                    chunks = counted(chunks, info)
+                page = decode_page(chunks, self.limit_per_page)
+                if self.cache is not None:
+                    response.commit()  # only a page which could be decoded is cached
+        return page
 
-    def parrallel_queries(self, urls):
-        print(f"using {self.max_connections} workers")
+    def download_pages(self, offsets):
+        """ download the pages at `offsets` and return two dictionaries keyed
+        by offset: the `Column_buffers` of each successful page, and the
+        exception raised by each failed page.
+        """
+        results = {}
+        errors = {}
         with ThreadPoolExecutor(max_workers=self.max_connections) as executor:
-            future_to_url = {
-                executor.submit(self.single_query, url): url for url in urls
+            future_to_offset = {
+                executor.submit(self.fetch_page, offset): offset for offset in offsets
             }
-            for future in as_completed(future_to_url):
-                url = future_to_url[future]
+            for future in as_completed(future_to_offset):
+                offset = future_to_offset[future]
                 try:
-                    yield future.result()  # response
+                    results[offset] = future.result()
                 except Exception as exc:
-                    print(f"{url} caused exception: {exc}")
-
-    def download_all(self):
-        urls = self.get_urls()
-        start = time.time()
-
-        response_list = []
-        for i, response in enumerate(self.parrallel_queries(urls)):
-            response_list.extend(json.loads(response.text)["data"])
-            print(
-                f"completed request {i+1}/{len(urls)} in {time.time()-start:.2f} s",
-                end="\r",
-            )
-        print("done.")
+                    errors[offset] = exc
+        return results, errors
+
 
-        return response_list
+class OQMD_part_store:
+    """ Append-only store of downloaded parts, one parquet file per part.
 
+    Each completed part is written once to its own file and recorded in a small
+    json manifest, so saving a part costs the same at the end of the download
+    as at the beginning. The full DataFrame is assembled lazily with
+    `iter_parts`/`load`, or once at the end with `compact`.
+    """
+    def __init__(self, directory=OQMD_PARTS_DIR):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.directory / "manifest.json"
+        self.manifest = self.read_manifest()
+        self.lock = threading.Lock()  # parts are written from several threads
 
-def fetch(session, url):
-    with session.get(url, params=None, verify=True, timeout=1000) as response:
-        if response.status_code != 200:
-            # print(f"url {url} response: {response.status_code}")
-            raise ConnectionError(f"url {url} response: {response.status_code}")
-        fetch.counter += 1
-        print(f"completed {fetch.counter} in {time.time()-fetch.start:.2f} s", end="\r")
-        return response
+    def read_manifest(self):
+        if self.manifest_path.exists():
+            with open(self.manifest_path, "r") as f:
+                return json.load(f)
+        return {"parts": []}
 
+    def write_manifest(self):
+        tmp_path = self.manifest_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)  # atomic, never half-written
 
-fetch.counter = 0
-fetch.start = time.time()
+    @staticmethod
+    def part_filename(start_at, stop_at):
+        return f"part_{start_at:07d}_{stop_at:07d}.parquet"
 
+    def write_part(self, start_at, stop_at, part_df):
+        filename = self.part_filename(start_at, stop_at)
+        tmp_path = self.directory / (filename + ".tmp")
+        pd.DataFrame(part_df).to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, self.directory / filename)
 
-async def get_data_asynchronous(urls, max_connections=8):
-    print(f"using {max_connections} workers")
-    fetch.counter = 0
-    with ThreadPoolExecutor(max_workers=max_connections) as executor:
-        with requests.Session() as session:
-            loop = asyncio.get_event_loop()
-            tasks = [
-                loop.run_in_executor(
-                    executor, fetch, *(session, url)
-                )  # Allows us to pass in multiple arguments to `fetch`
-                for url in urls
+        with self.lock:
+            self.manifest["parts"] = [
+                p for p in self.manifest["parts"] if p["file"] != filename
             ]
+            self.manifest["parts"].append({
+                "file": filename,
+                "start_at": start_at,
+                "stop_at": stop_at,
+                "rows": len(part_df),
+            })
+            self.write_manifest()
+
+    def has_part(self, start_at, stop_at):
+        return any(
+            p["start_at"] == start_at and p["stop_at"] == stop_at
+            for p in self.manifest["parts"]
+        )
+
+    def part_files(self):
+        parts = sorted(self.manifest["parts"], key=lambda p: p["start_at"])
+        return [self.directory / p["file"] for p in parts]
+
+    def n_rows(self):
+        return sum(p["rows"] for p in self.manifest["parts"])
+
+    def iter_parts(self, columns=None):
+        for filename in self.part_files():
+            yield storage.read_parquet(filename, columns=columns)
+
+    def load(self, columns=None):
+        return pd.concat(list(self.iter_parts(columns)), ignore_index=True)
+
+    def compact(self, saved_file=OQMD_PKL):
+        oqmd_df = self.load()
+        add_mask_columns(oqmd_df, composition_matrix(oqmd_df["chemical_formula_reduced"]))
+        oqmd_df.to_pickle(saved_file)
+        return oqmd_df
+
 
-            response_list = []
-            for response in await asyncio.gather(*tasks):
-                response_list.extend(json.loads(response.text)["data"])
+class OQMD_page_ledger:
+    """ Persistent record of the state of every page offset of the download.
 
-            return response_list
+    The ledger is an append-only json-lines file, one line per state change
+    (`in_flight`, `failed`, `fetched`, `done`, or `pending` again), replayed
+    at start-up so a restarted process knows exactly which pages remain. A
+    `fetched` page is spooled to its own parquet file in `pages/` until the
+    part containing it is complete, so it is not downloaded again after a
+    restart; it is `done` once the part has been written to the
+    `OQMD_part_store`, and its file is then deleted. Pages left `in_flight`
+    by a crash are simply downloaded again. Failed attempts are counted
+    across restarts.
+    """
+    def __init__(self, directory=OQMD_PARTS_DIR):
+        self.path = Path(directory) / "ledger.jsonl"
+        self.pages_dir = Path(directory) / "pages"
+        self.pages_dir.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()  # marks come from several threads
+        self.pages = {}
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.pages[entry["offset"]] = entry
+
+    def mark(self, offsets, status, errors=None):
+        errors = errors or {}
+        with self.lock, open(self.path, "a") as f:
+            for offset in offsets:
+                entry = self.pages.get(offset, {"offset": offset, "attempts": 0})
+                entry = dict(entry, status=status)
+                if status == "failed":
+                    entry["attempts"] += 1
+                    entry["error"] = str(errors.get(offset, ""))
+                elif status == "pending":  # retry from scratch
+                    entry["attempts"] = 0
+                elif status in ("fetched", "done"):
+                    entry.pop("error", None)
+                self.pages[offset] = entry
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def status(self, offset):
+        return self.pages.get(offset, {}).get("status", "pending")
+
+    def attempts(self, offset):
+        return self.pages.get(offset, {}).get("attempts", 0)
+
+    def error(self, offset):
+        return self.pages.get(offset, {}).get("error", "")
+
+    def is_done(self, offsets):
+        return all(self.status(offset) == "done" for offset in offsets)
+
+    def count(self, status):
+        return sum(entry["status"] == status for entry in self.pages.values())
+
+    def page_path(self, offset):
+        return self.pages_dir / f"page_{offset:07d}.parquet"
+
+    def save_pages(self, pages):
+        """ spool the `Column_buffers` of the pages {offset: buffers}, and
+        mark them `fetched` """
+        for offset, buffers in pages.items():
+            tmp_path = self.pages_dir / f"page_{offset:07d}.tmp"
+            buffers.to_dataframe().to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, self.page_path(offset))
+        self.mark(sorted(pages), "fetched")
+
+    def load_pages(self, offsets):
+        return pd.concat(
+            [storage.read_parquet(self.page_path(offset)) for offset in offsets], ignore_index=True
+        )
+
+    def drop_pages(self, offsets):
+        for offset in offsets:
+            self.page_path(offset).unlink(missing_ok=True)
+
+    def pending(self, offsets):
+        """ the offsets still to download: neither done nor fetched (with
+        their spooled file) """
+        return [
+            offset for offset in offsets
+            if not (
+                self.status(offset) == "done"
+                or (self.status(offset) == "fetched" and self.page_path(offset).exists())
+            )
+        ]
+
+    def reset_failed(self):
+        """ give the failed pages their full number of attempts again """
+        failed = [offset for offset, entry in self.pages.items() if entry["status"] == "failed"]
+        self.mark(failed, "pending")
+        return failed
+
+
+def flatten_entry(entry):
+    """ OPTIMADE entries hold their fields in `attributes`; bring them up to
+    the top level next to `id` and `type` """
+    record = entry.pop("attributes", None) or {}
+    record.update(entry)
+    return record
+
+
+def counted(chunks, info):
+    """ pass the chunks through, adding their size to info["bytes"] """
+    for chunk in chunks:
+        info["bytes"] += len(chunk)
+        yield chunk
+
+
+def decode_page(chunks, capacity):
+    """ stream the `data` array of one page into typed column buffers, one
+    entry at a time, as the chunks of the body arrive """
+    buffers = Column_buffers(capacity)
+    decoder = JSON_array_decoder("data")
+    for chunk in chunks:
+        for entry in decoder.feed(chunk):
+            buffers.append(flatten_entry(entry))
+    for entry in decoder.close():
+        buffers.append(flatten_entry(entry))
+    return buffers
+
+
+def retry_delay(attempt, base=2., cap=300.):
+    """ exponential backoff with full jitter (in seconds) """
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class AIMD_controller:
+    """ Additive-increase/multiplicative-decrease limit on concurrent requests.
+
+    The limit grows by about one request per round trip while the window is
+    full (there is no evidence the server could take more otherwise),
+    responses are successful and their latency stays within
+    `latency_tolerance` times the best latency seen so far. It is multiplied by `decrease` on a server
+    error (5xx, 429) or a timeout, at most once per round trip, so a burst of
+    failures from one congested window only counts once.
+    """
+    def __init__(
+        self,
+        initial=4,
+        minimum=1,
+        maximum=64,
+        decrease=0.5,
+        latency_tolerance=2.,
+        smoothing=0.2,
+    ):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.in_flight = 0
+        self.latency = None  # exponential moving average
+        self.best_latency = None
+        self.last_decrease = 0.
+        self.condition = None  # created inside the running event loop
+
+    async def acquire(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, latency, healthy):
+        now = time.time()
+        saturated = self.in_flight >= int(self.limit)
+        if healthy:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.smoothing * (latency - self.latency)
+            if self.best_latency is None or self.latency < self.best_latency:
+                self.best_latency = self.latency
+
+        if not healthy or self.latency > self.latency_tolerance * self.best_latency:
+            if now - self.last_decrease > (self.latency or latency):
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self.last_decrease = now
+        elif saturated:
+            self.limit = min(self.maximum, self.limit + 1./self.limit)
+
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+
+class OQMD_async_engine:
+    """ Native asyncio client for the OQMD pages.
+
+    A single `aiohttp.ClientSession` (and its connection pool) is kept for the
+    whole download, on an event loop owned by the engine, and the number of
+    requests in flight is driven by an `AIMD_controller` instead of a fixed
+    number of threads. Use as a context manager to close the session.
+    """
+    def __init__(self, controller=None, timeout=1000, cache=None):
+        self.controller = controller or AIMD_controller()
+        self.timeout = timeout
+        self.cache = cache  # an HTTP_cache, or None
+        self.loop = asyncio.new_event_loop()
+        self.session = None
+        self.completed = 0
+        self.start = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.session is not None:
+            self.loop.run_until_complete(self.session.close())
+        self.loop.close()
+
+    async def open_session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.controller.maximum),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.session
+
+    async def fetch(self, url, capacity):
+        cached, fresh = (None, False) if self.cache is None else self.cache.lookup(url)
+        content = self.cache.body(url) if fresh else None
+        if content is not None:
+            with METRICS.timed(ENDPOINT) as info:
+                info["status"] = "cache"
+                buffers = decode_page([content], capacity)
+            return self.completed_page(buffers)
+
+        await self.controller.acquire()
+        healthy = False
+        timer_start = time.time()
+        headers = {} if self.cache is None else self.cache.conditional_headers(cached)
+        try:
+            with METRICS.timed(ENDPOINT) as info:
+                async with self.session.get(url, headers=headers) as response:
+                    info["status"] = response.status
+                    if response.status >= 500 or response.status == 429:
+                        raise ConnectionError(f"url {url} response: {response.status}")
+                    healthy = True
+                    content = None
+                    if response.status == 304 and cached is not None:
+                        info["status"] = "cache"
+                        content = self.cache.body(url, revalidated=True)
+                    if content is not None:
+                        buffers = decode_page([content], capacity)
+                    elif response.status != 200:
+                        raise ConnectionError(f"url {url} response: {response.status}")
+                    else:
+                        buffers = Column_buffers(capacity)
+                        decoder = JSON_array_decoder("data")
+                        # only the compressed body is kept for the cache
+                        compressor = None if self.cache is None else zlib.compressobj(self.cache.level)
+                        compressed = []
+                        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                            info["bytes"] += len(chunk)
+                            if compressor is not None:
+                                compressed.append(compressor.compress(chunk))
+                            for entry in decoder.feed(chunk):
+                                buffers.append(flatten_entry(entry))
+                        for entry in decoder.close():
+                            buffers.append(flatten_entry(entry))
+                        if compressor is not None:  # stored once decoded
+                            compressed.append(compressor.flush())
+                            self.cache.store_compressed(url, response.headers, b"".join(compressed))
+        finally:
+            await self.controller.release(time.time()-timer_start, healthy)
+        return self.completed_page(buffers)
+
+    def completed_page(self, buffers):
+        self.completed += 1
+        print(
+            f"completed {self.completed} in {time.time()-self.start:.2f} s"
+            f" (concurrency {self.controller.limit:.1f})",
+            end="\r",
+        )
+        return buffers
+
+    async def fetch_pages(self, oqmd, offsets):
+        await self.open_session()
+        tasks = [
+            self.fetch(oqmd.page_url(offset), oqmd.limit_per_page)
+            for offset in offsets
+        ]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    def run(self, coroutine):
+        """ run `coroutine` on the loop of the engine, with its session open """
+        self.loop.run_until_complete(self.open_session())
+        return self.loop.run_until_complete(coroutine)
+
+    def get_pages(self, oqmd, offsets):
+        return self.run(self.page_results(oqmd, offsets))
+
+    async def page_results(self, oqmd, offsets):
+        """ download the pages at `offsets` and return two dictionaries keyed
+        by offset: the `Column_buffers` of each successful page, and the
+        exception raised by each failed page. A failed page does not cancel
+        the others.
+        """
+        pages = await self.fetch_pages(oqmd, offsets)
+        results = {}
+        errors = {}
+        for offset, page in zip(offsets, pages):
+            if isinstance(page, Exception):
+                errors[offset] = page
+            else:
+                results[offset] = page
+        return results, errors
+
+
+async def in_thread(function, *args):
+    """ run the blocking `function` (disk writes and their fsync) in a
+    thread, so the requests in flight on the event loop are not held up """
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+async def fetch_part(oqmd, ledger, engine=None, max_attempts=6):
+    """ download the pages of `oqmd` which the ledger does not have yet,
+    retrying only the failed pages with exponential backoff, and return the
+    entries as a DataFrame in offset order. Pages are downloaded by the
+    asynchronous `engine` if given, else by threads. The attempts are those
+    recorded in the ledger, so a page failing `max_attempts` times in total,
+    over any number of restarts, stops the download (see `--retry-failed`).
+    """
+    offsets = oqmd.page_offsets()
+    pending = ledger.pending(offsets)
+    while pending:
+        exhausted = [offset for offset in pending if ledger.attempts(offset) >= max_attempts]
+        if exhausted:
+            raise ConnectionError(
+                f"page {exhausted[0]} failed {ledger.attempts(exhausted[0])} times,"
+                f" last error: {ledger.error(exhausted[0])}"
+            )
+        await in_thread(ledger.mark, pending, "in_flight")
+        if engine is not None:
+            page_results, errors = await engine.page_results(oqmd, pending)
+        else:
+            page_results, errors = await in_thread(oqmd.download_pages, pending)
+        await in_thread(ledger.save_pages, page_results)
+
+        pending = sorted(errors)
+        if pending:
+            await in_thread(ledger.mark, pending, "failed", errors)
+            METRICS.retry(ENDPOINT, len(pending))
+            attempt = max(ledger.attempts(offset) for offset in pending)
+            if attempt < max_attempts:
+                delay = retry_delay(attempt)
+                print(f"\nERROR : {len(pending)} page(s) failed, retry {attempt} in {delay:.1f} s")
+                await asyncio.sleep(delay)
+
+    part_df = await in_thread(ledger.load_pages, offsets)
+    METRICS.rows(ENDPOINT, len(part_df))
+    return part_df
+
+
+def download_part(oqmd, ledger, engine=None, max_attempts=6):
+    """ `fetch_part`, from synchronous code """
+    if engine is not None:
+        return engine.run(fetch_part(oqmd, ledger, engine, max_attempts))
+    return asyncio.run(fetch_part(oqmd, ledger, None, max_attempts))
+
+
+async def fetch_parts(store, ledger, engine, parts, window=PARTS_WINDOW, max_attempts=6):
+    """ download and write the `parts` (`OQMD_multi_session`s), with up to
+    `window` of them in progress at once, so the engine always has more
+    pages to request than its controller allows in flight and concurrency
+    follows what the server can take. A failed part does not stop the
+    others; the first error is raised once they are all over. """
+    semaphore = asyncio.Semaphore(window)
+
+    async def download(oqmd):
+        async with semaphore:
+            part_df = await fetch_part(oqmd, ledger, engine, max_attempts)
+            await in_thread(write_part, store, ledger, oqmd, part_df)
+
+    outcomes = await asyncio.gather(*[download(oqmd) for oqmd in parts], return_exceptions=True)
+    errors = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+    if errors:
+        print(f"\n{len(errors)} of {len(parts)} parts failed")
+        raise errors[0]
+
+
+def write_part(store, ledger, oqmd, part_df):
+    """ write a complete part, then mark its pages done in the ledger """
+    offsets = oqmd.page_offsets()
+    store.write_part(oqmd.start_at, oqmd.stop_at, part_df)
+    ledger.mark(offsets, "done")
+    ledger.drop_pages(offsets)
 
 
 def main():
-    asynchronous = True
-    
-    start = 0
-    stop = 637644
-    per_parts = 400  # the 8 queries required by a 800 per_parts often failed
+    parser = argparse.ArgumentParser(description="download all of OQMD")
+    parser.add_argument(
+        "mode", nargs="?", default="local", choices=["local", "coordinator", "worker", "merge"],
+        help="local: download everything in this process (default);"
+        " coordinator: queue the parts for workers; worker: download queued parts"
+        " (run any number, on any machine sharing this directory);"
+        " merge: gather and compact the parts of the workers",
+    )
+    parser.add_argument("--queue", default=OQMD_QUEUE_DB, help="sqlite file of the shared queue")
+    parser.add_argument("--worker-id", default=None, help="default hostname-pid")
+    parser.add_argument(
+        "--cache", default=None,
+        help=f"http cache sqlite file, default {OQMD_CACHE_DB}, or for a worker its own"
+        " http_cache.sqlite in parts/workers/<worker-id>/",
+    )
+    parser.add_argument(
+        "--reset-queue", action="store_true",
+        help="coordinator: drop the shards of a queue made with other parameters",
+    )
+    parser.add_argument("--host", default=OQMD_HOST)
+    parser.add_argument(
+        "--retry-failed", action="store_true",
+        help="try again the pages which failed too many times in previous runs",
+    )
+    args = parser.parse_args()
+
+    if args.mode == "coordinator":
+        queue_parts(args.queue, reset=args.reset_queue)
+    elif args.mode == "worker":
+        work_on_parts(
+            args.queue, args.worker_id or default_worker_id(), args.cache, args.host,
+            args.retry_failed,
+        )
+    elif args.mode == "merge":
+        merge_parts(args.queue)
+    else:
+        download_locally(args.cache or OQMD_CACHE_DB, args.host, retry_failed=args.retry_failed)
+
+
+def download_locally(cache_path=OQMD_CACHE_DB, host=OQMD_HOST, asynchronous=True, retry_failed=False):
+    start = START
+    stop = STOP
+    per_parts = PER_PARTS
     num_parts = (stop-start)//per_parts
-    if per_parts%num_parts != 0:
+    if (stop-start)%per_parts != 0:
         num_parts += 1
 
-    if start != 0:
-        oqmd_df = pd.read_pickle(OQMD_PKL)
-        assert len(oqmd_df) == start
-    else:
-        oqmd_df = pd.DataFrame()
+    store = OQMD_part_store()
+    ledger = OQMD_page_ledger()
+    if retry_failed:
+        print(f"{len(ledger.reset_failed())} failed pages reset")
+    print(
+        f"resuming with {store.n_rows()} materials already downloaded"
+        f" ({ledger.count('done')} pages done, {ledger.count('fetched')} fetched,"
+        f" {ledger.count('failed')} failed)"
+    )
+
+    METRICS.open(OQMD_METRICS_LOG, OQMD_METRICS_PROM)
+    cache = HTTP_cache(cache_path)  # a rerun downloads only the pages not cached
+    engine = OQMD_async_engine(cache=cache) if asynchronous else None
+    try:
+        download_parts(store, ledger, engine, start, stop, per_parts, num_parts, cache, host)
+    finally:
+        if engine is not None:
+            engine.close()
+        cache.close()
+        print("\n" + METRICS.summary())
+        METRICS.close()
+
+    print(f"\ncompacting {store.n_rows()} materials into {OQMD_PKL}")
+    oqmd_df = store.compact(OQMD_PKL)
+    storage.save("oqmd", oqmd_df, partition_on="nelements")
+    save_structures(oqmd_df)
 
+
+def save_structures(oqmd_df, saved_file=OQMD_STRUCTURES_NPZ):
+    """ the structures as `common.structures.Structure_arrays`, for matching """
+    structures = optimade_structures(
+        oqmd_df["id"], oqmd_df["lattice_vectors"],
+        oqmd_df["cartesian_site_positions"], oqmd_df["species_at_sites"],
+    )
+    structures.save(saved_file)
+    return structures
+
+
+def queue_parts(
+    queue_path=OQMD_QUEUE_DB, start=START, stop=STOP, per_parts=PER_PARTS,
+    parts_per_shard=PARTS_WINDOW, reset=False,
+):
+    """ add the parts (offset ranges) of the download to the shared queue,
+    except those already in the local part store, by shards of
+    `parts_per_shard` parts downloaded together by a worker. A queue made
+    with other parameters is refused, or emptied first with `reset`. """
+    store = OQMD_part_store()
+    parts = [
+        (start_at, min(start_at+per_parts, stop))
+        for start_at in range(start, stop, per_parts)
+        if not store.has_part(start_at, min(start_at+per_parts, stop))
+    ]
+    shards = []
+    for i in range(0, len(parts), parts_per_shard):
+        shard_parts = parts[i:i+parts_per_shard]
+        name = f"parts_{shard_parts[0][0]:07d}_{shard_parts[-1][1]:07d}"
+        shards.append((name, {"parts": shard_parts}))
+    with Shard_queue(queue_path) as queue:
+        queue.add(shards, [start, stop, per_parts, parts_per_shard], reset)
+        print(f"{len(parts)} parts queued in {len(shards)} shards in {queue_path}: {queue.counts()}")
+
+
+def work_on_parts(queue_path, worker, cache_path=None, host=OQMD_HOST, retry_failed=False):
+    """ download the parts of the queue into a part store of this worker,
+    `parts/workers/<worker>/`, until the queue is empty. The http cache is
+    the worker's own, `parts/workers/<worker>/http_cache.sqlite` by default:
+    workers may run on machines which share the directory over the network,
+    where a shared sqlite file is not safe. """
+    directory = Path(OQMD_PARTS_DIR) / "workers" / worker
+    store = OQMD_part_store(directory)
+    ledger = OQMD_page_ledger(directory)
+    if retry_failed:
+        ledger.reset_failed()
+    METRICS.open(str(directory / "metrics.jsonl"), str(directory / "metrics.prom"))
+    cache = HTTP_cache(cache_path or directory/"http_cache.sqlite", wal=False)
+    engine = OQMD_async_engine(cache=cache)
+
+    def process(name, payload):
+        parts = [
+            OQMD_multi_session(start_at=start_at, stop_at=stop_at, host=host, cache=cache)
+            for start_at, stop_at in payload["parts"]
+        ]
+        todo = [
+            oqmd for oqmd in parts
+            if not (ledger.is_done(oqmd.page_offsets()) and store.has_part(oqmd.start_at, oqmd.stop_at))
+        ]
+        engine.run(fetch_parts(store, ledger, engine, todo))
+        return {"directory": str(directory), "parts": payload["parts"]}
+
+    try:
+        with Shard_queue(queue_path) as queue:
+            n_done = run_worker(queue, process, worker)
+    finally:
+        engine.close()
+        cache.close()
+        print("\n" + METRICS.summary())
+        METRICS.close()
+    print(f"{worker} downloaded {n_done} shards")
+
+
+def merge_parts(queue_path=OQMD_QUEUE_DB):
+    """ copy the parts done by the workers into the main part store, and
+    compact it as `download_locally` does """
+    store = OQMD_part_store()
+    with Shard_queue(queue_path) as queue:
+        if not queue.is_finished() or queue.failures():
+            print(f"WARNING: the queue is not complete: {queue.counts()}")
+        for name, payload, result in queue.results():
+            for start_at, stop_at in result["parts"]:
+                if not store.has_part(start_at, stop_at):
+                    filename = Path(result["directory"]) / store.part_filename(start_at, stop_at)
+                    store.write_part(start_at, stop_at, storage.read_parquet(filename))
+
+    print(f"compacting {store.n_rows()} materials into {OQMD_PKL}")
+    oqmd_df = store.compact(OQMD_PKL)
+    storage.save("oqmd", oqmd_df, partition_on="nelements")
+    save_structures(oqmd_df)
+
+
+def download_parts(
+    store, ledger, engine, start, stop, per_parts, num_parts, cache=None, host=OQMD_HOST
+):
+    """ download the parts not in the store yet, all through the `engine`
+    (see `fetch_parts`) if given, else one after the other with threads """
+    todo = []
     for part in range(num_parts):
-        print(f"\ndownloading part {part} of {num_parts}")
-        
+        start_at = start+part*per_parts
+        stop_at = min(start+(part+1)*per_parts, stop)
         oqmd = OQMD_multi_session(
-            start_at=start+part*per_parts,
-            stop_at=start+(part+1)*per_parts
+            start_at=start_at,
+            stop_at=stop_at,
+            host=host,
+            cache=cache,
         )
-        
-        max_retries = 6
-        num_retries = 0
-        success = False
-        while not success:
-            try:
-                timer_start = time.time()
-                if asynchronous:
-                    urls = oqmd.get_urls()
-                    maxc = oqmd.max_connections
-                    loop = asyncio.get_event_loop()
-                    future = asyncio.ensure_future(get_data_asynchronous(urls, maxc))
-                    loop.run_until_complete(future)
-                    list_of_dict = future.result()
-                else:
-                    list_of_dict = oqmd.download_all()
-                
-                timer_end = time.time()
-                print(f"in {timer_end-timer_start}")
-                oqmd_df_tmp = oqmd_df.append(list_of_dict, ignore_index=True)
-                success = True
-                break
-            except Exception as exc:
-                num_retries += 1
-                if num_retries < max_retries:
-                    print(f"\nERROR : RETRY {num_retries} for part {part} of {num_parts}")
-                else:
-                    raise exc
-        
-        oqmd_df = oqmd_df_tmp
-        oqmd_df.to_pickle(OQMD_PKL)
+        offsets = oqmd.page_offsets()
+        if ledger.is_done(offsets) and store.has_part(start_at, stop_at):
+            continue
+        if store.has_part(start_at, stop_at):  # crashed between the two writes
+            ledger.mark(offsets, "done")
+            ledger.drop_pages(offsets)
+            continue
+
+        todo.append((part, oqmd))
+
+    print(f"\n{len(todo)} parts of {num_parts} to download")
+    if engine is not None:
+        engine.run(fetch_parts(store, ledger, engine, [oqmd for _, oqmd in todo]))
+        return
+    for part, oqmd in todo:
+        print(f"\ndownloading part {part} of {num_parts}")
+        timer_start = time.time()
+        part_df = download_part(oqmd, ledger)
+        print(f"in {time.time()-timer_start}")
+        write_part(store, ledger, oqmd, part_df)
 
 
 if __name__ == "__main__":
@@ -1,23 +1,61 @@
 #!/usr/bin/env python3
 
+import sys
 import warnings
 import glob
+import hashlib
+from importlib import metadata
 from pathlib import Path  ## for os-agnostic paths
 
 import pandas as pd
-from mendeleev import get_table
-from ase import data as ase_data
-from pymatgen import Element
 
 
 HERE = Path(__file__).parent
+PARENT = Path(__file__).parent.parent
+PTABLE_CSV = str(HERE/"ptable.csv")
+PTABLE_PKL = str(HERE/"ptable.pkl")
+PTABLE_HASH = str(HERE/"ptable.hash")
+SOURCE_DIRS = ["imat", "magp", "wiki"]
+SOURCE_LIBRARIES = ["mendeleev", "ase", "pymatgen", "pandas"]
+
+sys.path.append(str(PARENT))  # for common.storage, imported by save_ptable
+
+_loaded_ptables = {}  # by source hash, for repeated calls in one process
+
+
+def source_hash():
+    """ hash of the csv sources and of the versions of the libraries used to
+    build the periodic table (pandas included, for the pickle format). The
+    libraries are not imported. """
+    sha256 = hashlib.sha256()
+    for source in SOURCE_DIRS:
+        for filename in sorted(glob.glob(str(HERE/source/"*.csv"))):
+            sha256.update(f"{source}/{Path(filename).name}".encode())
+            with open(filename, "rb") as f:
+                sha256.update(f.read())
+    for library in SOURCE_LIBRARIES:
+        try:
+            version = metadata.version(library)
+        except metadata.PackageNotFoundError:
+            version = None
+        sha256.update(f"{library}={version}".encode())
+    return sha256.hexdigest()
 
 
 def gather_ptable_dataframe():
+    ## imported here because they are slow, and only needed for a rebuild
+    from mendeleev import get_table
+    from ase import data as ase_data
+    from pymatgen import Element
+
     df_list = []
 
     ## get properties in csv (retrieved from magpie project, imat project, and wikipedia) 
-    all_files = glob.glob(str(HERE/"*"/"*.csv"))
+    all_files = [
+        filename
+        for source in SOURCE_DIRS
+        for filename in glob.glob(str(HERE/source/"*.csv"))
+    ]
     for filename in all_files:
         prop = str(Path(filename).stem)
         source = str(Path(filename).parent.stem)
@@ -84,9 +122,36 @@ def gather_ptable_dataframe():
     return ptable
 
 def save_ptable():
+    ## imported here as it needs pyarrow, only for a rebuild
+    from common import storage
+
     ptable = gather_ptable_dataframe()
-    ptable.to_csv("ptable.csv")
-    ptable.to_pickle("ptable.pkl")
+    ptable.to_csv(PTABLE_CSV)
+    ptable.to_pickle(PTABLE_PKL)
+    storage.save("ptable", ptable.reset_index(), partition_on=None)
+    with open(PTABLE_HASH, "w") as f:
+        f.write(source_hash())
+    return ptable
+
+
+def load_ptable(rebuild=False):
+    """ the periodic table, from `ptable.pkl` if it was built from the current
+    sources (see `source_hash`), otherwise rebuilt and saved first. Each call
+    returns its own copy, which the caller may modify. """
+    key = source_hash()
+    if not rebuild and key in _loaded_ptables:
+        return _loaded_ptables[key].copy()
+
+    saved_key = None
+    if Path(PTABLE_HASH).exists() and Path(PTABLE_PKL).exists():
+        with open(PTABLE_HASH, "r") as f:
+            saved_key = f.read().strip()
+    if rebuild or saved_key != key:
+        ptable = save_ptable()
+    else:
+        ptable = pd.read_pickle(PTABLE_PKL)
+    _loaded_ptables[key] = ptable
+    return ptable.copy()
 
 if __name__ == "__main__":
     save_ptable()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import sys
+from pathlib import Path  ## for os-agnostic paths
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+HERE = Path(__file__).parent
+PARENT = Path(__file__).parent.parent
+
+sys.path.append(str(PARENT))
+from common.elements import ELEMENTS
+from common.formula import composition_matrix, normalize
+from ptable.build import load_ptable
+
+STATISTICS = ["mean", "min", "max", "range", "var"]
+
+
+def property_array(ptable, properties=None):
+    """ freeze the numeric columns of the periodic table (indexed by symbol,
+    as built by `build.py`) into a dense float array of elements x properties,
+    where row Z-1 is the element Z, as the columns of `composition_matrix`.
+    Unknown values are NaN. """
+    if properties is None:
+        properties = ptable.select_dtypes("number").columns.tolist()
+    array = ptable.reindex(list(ELEMENTS))[properties].to_numpy(dtype=np.float64)
+    return array, properties
+
+
+def featurize_chunk(fractions, prop_array):
+    """ statistics of the properties of the elements of each row of the
+    atomic fractions matrix `fractions` (CSR), weighted by the fractions for
+    `mean` and `var`, over the elements present for `min` and `max` """
+    n_rows = fractions.shape[0]
+    mean = fractions @ prop_array
+    var = np.maximum(fractions @ prop_array**2 - mean**2, 0.)
+
+    # min and max by gathering the j-th element of every row with more than
+    # j elements, for j up to the largest number of elements
+    minimum = np.full((n_rows, prop_array.shape[1]), np.inf)
+    maximum = np.full((n_rows, prop_array.shape[1]), -np.inf)
+    starts = fractions.indptr[:-1]
+    counts = np.diff(fractions.indptr)
+    for j in range(counts.max(initial=0)):
+        rows = np.flatnonzero(counts > j)
+        values = prop_array[fractions.indices[starts[rows]+j]]
+        minimum[rows] = np.minimum(minimum[rows], values)
+        maximum[rows] = np.maximum(maximum[rows], values)
+    present = counts > 0
+    minimum[~present] = np.nan
+    maximum[~present] = np.nan
+    mean[~present] = np.nan
+    var[~present] = np.nan
+    return np.hstack([mean, minimum, maximum, maximum-minimum, var])
+
+
+def featurize(compositions, ptable=None, properties=None, chunk_size=50000):
+    """ Magpie-style descriptors (weighted mean, min, max, range and variance
+    of element properties) of many compositions at once.
+
+    `compositions` is a sparse composition matrix or a sequence of formulas
+    (see `common.formula.composition_matrix`). Rows are processed by chunks
+    of `chunk_size` so memory stays bounded. Returns a DataFrame with columns
+    named like "max_magp_atomic_masses".
+    """
+    if ptable is None:
+        ptable = load_ptable()
+    index = compositions.index if isinstance(compositions, pd.Series) else None
+    if not sparse.issparse(compositions):
+        compositions = composition_matrix(compositions)
+    compositions = sparse.csr_matrix(compositions)
+    compositions.sort_indices()
+    prop_array, properties = property_array(ptable, properties)
+
+    n_rows = compositions.shape[0]
+    features = np.empty((n_rows, len(STATISTICS)*len(properties)))
+    for start in range(0, n_rows, chunk_size):
+        stop = min(start+chunk_size, n_rows)
+        fractions = normalize(compositions[start:stop]).tocsr()
+        features[start:stop] = featurize_chunk(fractions, prop_array)
+
+    columns = [f"{stat}_{prop}" for stat in STATISTICS for prop in properties]
+    return pd.DataFrame(features, columns=columns, index=index)
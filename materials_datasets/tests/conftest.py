@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+HERE = Path(__file__).parent
+PARENT = Path(__file__).parent.parent
+
+sys.path.append(str(PARENT))
+sys.path.append(str(PARENT/"bench"))
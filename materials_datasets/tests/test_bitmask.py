@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from common.formula import composition_matrix
+from common.bitmask import add_mask_columns, set_mask, select
+
+FORMULAS = ["LiFePO4", "FePO4", "Li2O", "NaCl", "LiFeO2", "UO2", "invalid"]
+
+
+@pytest.fixture
+def df():
+    df = pd.DataFrame({"formula": FORMULAS})
+    return add_mask_columns(df, composition_matrix(df["formula"]))
+
+
+def selected(df, **conditions):
+    return df["formula"][select(df, **conditions)].tolist()
+
+
+def test_set_mask():
+    assert set_mask("Li-Fe-P-O") == set_mask("LiFePO") == set_mask(["O", "P", "Fe", "Li"])
+    assert set_mask("H") == (np.uint64(1), np.uint64(0))
+    assert set_mask("U") == (np.uint64(0), np.uint64(1 << (92-1-64)))
+    with pytest.raises(ValueError):
+        set_mask("Xx")
+
+
+def test_modes(df):
+    assert selected(df, exact="Li-Fe-P-O") == ["LiFePO4"]
+    assert selected(df, subset="Li-Fe-P-O") == ["LiFePO4", "FePO4", "Li2O", "LiFeO2"]
+    assert selected(df, superset="Li-O") == ["LiFePO4", "Li2O", "LiFeO2"]
+    assert selected(df, include="Na U") == ["NaCl", "UO2"]
+    assert selected(df, exclude="O") == ["NaCl"]
+    assert selected(df, subset="U-O-Li") == ["Li2O", "UO2"]
+
+
+def test_combined(df):
+    assert selected(df, subset="Li-Fe-P-O", include="Li", exclude="P") == ["Li2O", "LiFeO2"]
+
+
+def test_invalid_never_selected(df):
+    assert "invalid" not in selected(df, exclude="O")
+    assert len(selected(df)) == len(FORMULAS) - 1
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+from common.columns import Column_buffers
+
+
+def buffers_of(records, capacity=2):
+    buffers = Column_buffers(capacity)  # small, so the columns grow
+    for record in records:
+        buffers.append(record)
+    return buffers
+
+
+def test_dtypes():
+    df = buffers_of([
+        {"i": 1, "f": 1.5, "b": True, "s": "a", "o": [1, 2]},
+        {"i": 2, "f": 2.5, "b": False, "s": "b", "o": {"x": 1}},
+        {"i": 3, "f": 3.5, "b": True, "s": "a", "o": None},
+    ]).to_dataframe()
+    assert df["i"].dtype == np.int64
+    assert df["f"].dtype == np.float64
+    assert df["b"].dtype == bool
+    assert df["s"].dtype == object
+    assert df["o"].dtype == object
+    assert df["s"].tolist() == ["a", "b", "a"]
+    assert df["o"].tolist() == [[1, 2], {"x": 1}, None]
+
+
+def test_nulls():
+    df = buffers_of([
+        {"i": 1, "f": 1.5, "b": True, "s": "a"},
+        {"other": 0},  # every column missing
+        {"i": None, "f": None, "b": None, "s": None},
+    ]).to_dataframe()
+    assert df["i"].dtype == pd.Int64Dtype()
+    assert df["i"].isna().tolist() == [False, True, True]
+    assert df["f"].dtype == np.float64
+    assert np.isnan(df["f"][1])
+    assert df["b"].dtype == pd.BooleanDtype()
+    assert df["s"].dtype == object
+    assert df["s"].tolist() == ["a", None, None]
+    assert df["other"].isna().tolist() == [True, False, True]
+
+
+def test_promotions():
+    df = buffers_of([
+        {"n": 1, "mixed": 1, "late": None},
+        {"n": 2.5, "mixed": "one", "late": None},
+        {"n": 3, "mixed": 2.0, "late": "x"},
+    ]).to_dataframe()
+    assert df["n"].dtype == np.float64
+    assert df["n"].tolist() == [1., 2.5, 3.]
+    assert df["mixed"].dtype == object
+    assert df["mixed"].tolist() == [1, "one", 2.0]
+    assert df["late"].tolist() == [None, None, "x"]
+
+
+def test_extend():
+    first = buffers_of([{"i": 1, "s": "a"}, {"i": 2, "s": "b"}])
+    second = buffers_of([{"i": 3, "s": "b", "f": 0.5}, {"i": None, "s": "c", "x": True}])
+    first.extend(second)
+    df = first.to_dataframe()
+    assert len(first) == 4
+    assert df["i"].tolist() == [1, 2, 3, pd.NA]
+    assert df["s"].tolist() == ["a", "b", "b", "c"]
+    assert df["f"].isna().tolist() == [True, True, False, True]
+    assert df["x"].tolist() == [pd.NA, pd.NA, pd.NA, True]
+
+
+def test_extend_different_kinds():
+    first = buffers_of([{"v": 1}])
+    first.extend(buffers_of([{"v": "a"}]))
+    assert first.to_dataframe()["v"].tolist() == [1, "a"]
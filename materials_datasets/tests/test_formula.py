@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from common.formula import (
+    parse_formula, composition_matrix, n_elements, is_valid, is_stoichiometric, normalize
+)
+from common.elements import ATOMIC_NUMBERS, N_ELEMENTS
+
+
+@pytest.mark.parametrize("formula, expected", [
+    ("NaCl", {"Na": 1., "Cl": 1.}),
+    ("Cl1Na1", {"Na": 1., "Cl": 1.}),
+    ("Ca(CO3)", {"Ca": 1., "C": 1., "O": 3.}),
+    ("Fe2O3", {"Fe": 2., "O": 3.}),
+    ("(Mg0.5Fe0.5)2SiO4", {"Mg": 1., "Fe": 1., "Si": 1., "O": 4.}),
+    ("K4[Fe(CN)6]", {"K": 4., "Fe": 1., "C": 6., "N": 6.}),
+    ("H2O H2O", {"H": 4., "O": 2.}),
+])
+def test_parse_formula(formula, expected):
+    assert parse_formula(formula) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("formula", ["Xx2", "Na(Cl", "NaCl)", "2NaCl", "na", "Na-Cl"])
+def test_invalid_formula(formula):
+    with pytest.raises(ValueError):
+        parse_formula(formula)
+
+
+def test_composition_matrix():
+    formulas = ["NaCl", {"Fe": 2, "O": 3}, "Xx", None, "NaCl", "Li0.5CoO2"]
+    matrix = composition_matrix(formulas)
+    assert matrix.shape == (6, N_ELEMENTS)
+    dense = matrix.toarray()
+    assert dense[0, ATOMIC_NUMBERS["Na"]-1] == 1.
+    assert dense[1, ATOMIC_NUMBERS["Fe"]-1] == 2.
+    assert dense[1, ATOMIC_NUMBERS["O"]-1] == 3.
+    assert (dense[0] == dense[4]).all()
+    assert n_elements(matrix).tolist() == [2, 2, 0, 0, 2, 3]
+    assert is_valid(matrix).tolist() == [True, True, False, False, True, True]
+    assert is_stoichiometric(matrix).tolist() == [True, True, False, False, True, False]
+    sums = np.asarray(normalize(matrix).sum(axis=1)).ravel()
+    assert sums == pytest.approx([1., 1., 0., 0., 1., 1.])
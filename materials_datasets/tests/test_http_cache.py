@@ -0,0 +1,79 @@
+import time
+
+import pytest
+import requests
+
+from common.http_cache import HTTP_cache, normalize_url
+from fake_servers import Fake_OQMD
+
+
+def get(cache, url):
+    with cache.get(requests, url) as response:
+        content = response.content
+        response.commit()
+    return content
+
+
+@pytest.fixture
+def server():
+    with Fake_OQMD(n_materials=50, etags=True) as server:
+        yield server
+
+
+def page_url(server, offset, token="secret"):
+    return f"{server.url}/optimade/structures?limit=10&offset={offset}&token={token}"
+
+
+def test_normalize_url():
+    assert (
+        normalize_url("HTTP://Host/p?b=2&a=1&token=x")
+        == normalize_url("http://host/p?a=1&b=2&token=y")
+        == "http://host/p?a=1&b=2"
+    )
+
+
+def test_fresh(server, tmp_path):
+    with HTTP_cache(tmp_path/"cache.sqlite") as cache:
+        content = get(cache, page_url(server, 0))
+        assert get(cache, page_url(server, 0, token="other")) == content
+        assert server.n_requests == 1
+        assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_revalidation(server, tmp_path):
+    with HTTP_cache(tmp_path/"cache.sqlite", fresh_for=0.) as cache:
+        content = get(cache, page_url(server, 0))
+        stored = cache.lookup(page_url(server, 0))[0]["stored"]
+        assert get(cache, page_url(server, 0)) == content
+        assert server.n_requests == 2  # a conditional request answered by a 304
+        assert (cache.revalidated, cache.misses) == (1, 1)
+        assert cache.lookup(page_url(server, 0))[0]["stored"] > stored
+
+
+def test_not_committed(server, tmp_path):
+    with HTTP_cache(tmp_path/"cache.sqlite") as cache:
+        with cache.get(requests, page_url(server, 0)) as response:
+            response.content  # read but not committed, as an invalid body
+        assert len(cache) == 0
+        with cache.get(requests, f"{server.url}/missing") as response:
+            assert response.status_code == 404
+            response.content
+            response.commit()
+        assert len(cache) == 0
+
+
+def test_eviction(server, tmp_path):
+    with HTTP_cache(tmp_path/"cache.sqlite") as cache:
+        get(cache, page_url(server, 0))
+        size = cache.total_bytes
+    with HTTP_cache(tmp_path/"cache.sqlite", max_bytes=int(2.5*size)) as cache:
+        assert cache.total_bytes == size  # recounted when opened
+        get(cache, page_url(server, 10))
+        time.sleep(0.01)
+        get(cache, page_url(server, 0))  # most recently used
+        time.sleep(0.01)
+        get(cache, page_url(server, 20))
+        assert len(cache) == 2
+        assert cache.total_bytes <= cache.max_bytes
+        assert cache.lookup(page_url(server, 10))[0] is None
+        assert cache.lookup(page_url(server, 0))[0] is not None
@@ -0,0 +1,112 @@
+import pytest
+
+from icsd.download import (
+    CIF_splitter, ICSD_session_pool, ICSD_cif_store, cif_icsd_id, sync
+)
+from common.http_cache import HTTP_cache
+from fake_servers import Fake_ICSD
+
+
+class Refusing_ICSD(Fake_ICSD):
+    """ refuses the logins after the first `n_accepted`, and counts logouts """
+    def __init__(self, n_accepted, **kwargs):
+        self.n_accepted = n_accepted
+        self.n_logouts = 0
+        super().__init__(**kwargs)
+
+    def respond(self, method, path, params, headers, body):
+        if path == "/ws/auth/login" and self.n_logins >= self.n_accepted:
+            return 401, {}, "Authentication failed"
+        if path == "/ws/auth/logout":
+            self.n_logouts += 1
+        return super().respond(method, path, params, headers, body)
+
+
+def response_body(server, ids):
+    return "".join(
+        f"#(C) 2024 by FIZ Karlsruhe - Leibniz Institute for Information Infrastructure\n"
+        f"{server.cif(i)}\n"
+        for i in ids
+    )
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 97, 10**6])
+def test_cif_splitter(chunk_size):
+    server = Fake_ICSD.__new__(Fake_ICSD)  # only for its cifs, not served
+    server.cif_size = 300
+    body = response_body(server, [1, 2, 3])
+    splitter = CIF_splitter()
+    cifs = []
+    for start in range(0, len(body), chunk_size):
+        cifs.extend(splitter.feed(body[start:start+chunk_size]))
+    cifs.extend(splitter.close())
+    assert cifs == [server.cif(i) for i in [1, 2, 3]]
+    assert [cif_icsd_id(cif) for cif in cifs] == [1, 2, 3]
+
+
+def test_cif_splitter_without_final_newline():
+    splitter = CIF_splitter()
+    cifs = list(splitter.feed("preamble\n#(C) 2020 by FIZ Karlsruhe\ndata_1\n_database_code_ICSD 1"))
+    cifs.extend(splitter.close())
+    assert cifs == ["data_1\n_database_code_ICSD 1"]
+
+
+def test_store_cifs(tmp_path):
+    ids = list(range(1, 2501))
+    with Fake_ICSD(n_cifs=2500, cif_size=500, token_cif_limit=1500) as server, \
+            ICSD_session_pool("id", "pw", n_sessions=2, address=server.url+"/ws",
+                              token_cif_limit=1500) as icsd, \
+            ICSD_cif_store(str(tmp_path/"cifs.sqlite")) as store:
+        assert icsd.store_cifs(ids, store) == 2500
+        assert len(store) == 2500
+        assert store.get(1234) == server.cif(1234)
+        # nothing changed, nothing written
+        assert icsd.store_cifs(ids[:1000], store) == 0
+
+
+def test_token_refused_early(tmp_path):
+    # the server allows fewer cifs per token than the pool expects: the
+    # refused batch is retried with a new token
+    with Fake_ICSD(n_cifs=3000, cif_size=300, token_cif_limit=1000) as server, \
+            ICSD_session_pool("id", "pw", n_sessions=1, address=server.url+"/ws") as icsd, \
+            ICSD_cif_store(str(tmp_path/"cifs.sqlite")) as store:
+        assert icsd.store_cifs(list(range(1, 3001)), store) == 3000
+        assert server.n_logins == 3
+
+
+def test_cached(tmp_path):
+    with Fake_ICSD(n_cifs=1500, cif_size=300) as server, \
+            HTTP_cache(tmp_path/"cache.sqlite") as cache, \
+            ICSD_session_pool("id", "pw", n_sessions=2, address=server.url+"/ws",
+                              cache=cache) as icsd:
+        with ICSD_cif_store(str(tmp_path/"a.sqlite")) as store:
+            icsd.store_cifs(list(range(1, 1501)), store)
+        assert len(cache) == 2
+        n_requests = server.n_requests
+        with ICSD_cif_store(str(tmp_path/"b.sqlite")) as store:
+            assert icsd.store_cifs(list(range(1, 1501)), store) == 1500
+            assert icsd.store_cifs(list(range(1, 1001)), store, cached=False) == 0
+        assert server.n_requests == n_requests + 1
+
+
+def test_sync(tmp_path):
+    with Fake_ICSD(n_cifs=1200, cif_size=300) as server, \
+            ICSD_session_pool("id", "pw", n_sessions=2, address=server.url+"/ws") as icsd, \
+            ICSD_cif_store(str(tmp_path/"cifs.sqlite")) as store:
+        assert sync(icsd, store, max_N=8) == 1200
+        store.put(5000, server.cif(5000))  # no longer on the server
+        store.put(7, "changed")
+        store.commit()
+        store.delete([8])
+        recheck_query = f"NUMBEROFELEMENTS: {server.nelements(7)}"
+        assert sync(icsd, store, max_N=8, recheck_query=recheck_query) == 2  # 8 and 7
+        assert store.ids() == set(range(1, 1201))
+        assert store.get(7) == server.cif(7)
+        assert store.get(8) == server.cif(8)
+
+
+def test_pool_login_failure():
+    with Refusing_ICSD(n_accepted=2, n_cifs=10) as server:
+        with pytest.raises(ConnectionError):
+            ICSD_session_pool("id", "pw", n_sessions=3, address=server.url+"/ws")
+        assert server.n_logouts == 2
@@ -0,0 +1,50 @@
+import json
+
+import pytest
+
+from common.jsonstream import JSON_array_decoder
+
+DOCUMENT = {
+    "data": [{"id": "1", "name": "NaCl"}, {"id": "2", "name": "Fe₂O₃", "x": [1.5, None]}, 3, "s"],
+    "meta": {"more_data_available": False},
+}
+
+
+def decode(decoder, body, chunk_size):
+    items = []
+    for start in range(0, len(body), chunk_size):
+        items.extend(decoder.feed(body[start:start+chunk_size]))
+    items.extend(decoder.close())
+    return items
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, 10**6])
+def test_split_chunks(chunk_size):
+    # chunk_size 1 splits the multi-byte characters of "₂" and "₃" too
+    body = json.dumps(DOCUMENT, ensure_ascii=False).encode()
+    decoder = JSON_array_decoder("data")
+    assert decode(decoder, body, chunk_size) == DOCUMENT["data"]
+    assert decoder.other == {"meta": DOCUMENT["meta"]}
+
+
+def test_key_after_other_values():
+    document = {"meta": {"n": 2}, "data": [1, 2], "links": None}
+    decoder = JSON_array_decoder("data")
+    assert decode(decoder, json.dumps(document).encode(), 5) == [1, 2]
+    assert decoder.other == {"meta": {"n": 2}, "links": None}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4])
+def test_top_level_array(chunk_size):
+    body = json.dumps(DOCUMENT["data"]).encode()
+    assert decode(JSON_array_decoder(None), body, chunk_size) == DOCUMENT["data"]
+
+
+def test_empty_array():
+    assert decode(JSON_array_decoder("data"), b'{"data": []}', 1) == []
+
+
+def test_incomplete_document():
+    body = json.dumps(DOCUMENT).encode()[:-10]
+    with pytest.raises(ValueError):
+        decode(JSON_array_decoder("data"), body, 16)
@@ -0,0 +1,77 @@
+import json
+
+import pytest
+import requests
+
+import mp.download as download
+from mp.download import plan_shards, count_documents, iter_materials_project, normalize_material
+from fake_servers import Fake_MP
+
+
+class Legacy_rester:
+    """ the part of the legacy `MPRester` (pymatgen before 2023) used by the
+    downloader, posting to the /query endpoint as it does """
+    def __init__(self, api_key=None, endpoint=None):
+        self.endpoint = endpoint
+
+    def _make_request(self, sub_url, payload=None, method="GET"):
+        response = requests.request(method, self.endpoint + sub_url, data=payload)
+        response.raise_for_status()
+        return response.json()["response"]
+
+    def query(self, criteria, properties, chunk_size=500):
+        return self._make_request("/query", {
+            "criteria": json.dumps(criteria),
+            "properties": json.dumps(properties),
+        }, method="POST")
+
+
+class New_rester:
+    """ the `MPRester` of the new API cannot count """
+
+
+@pytest.fixture(scope="module")
+def server():
+    with Fake_MP(n_materials=3000, max_nsites=40) as server:
+        yield server
+
+
+def test_plan_shards(server):
+    rester = Legacy_rester(endpoint=server.url + "/rest/v2")
+    shards = plan_shards(rester, max_nelements=4, max_nsites=30, max_shard_size=200)
+    assert sum(count for _, count in shards) == 3000
+    for shard, count in shards:
+        assert 0 < count == count_documents(rester, shard)
+        nelements, nsites_min, nsites_max = shard
+        assert count <= 200 or nsites_max is None or nsites_max == nsites_min
+
+
+def test_plan_shards_without_count():
+    with pytest.warns(UserWarning):
+        shards = plan_shards(New_rester(), max_nelements=4)
+    assert len(shards) == 7
+    assert all(count is None for _, count in shards)
+
+
+def test_iter_materials_project(server, monkeypatch):
+    monkeypatch.setattr(download, "MPRester", Legacy_rester)
+    materials = list(iter_materials_project(
+        "key", max_nelements=4, max_nsites=30, chunk_size=500,
+        properties=["material_id", "nsites", "magnetism"],
+        n_workers=3, endpoint=server.url + "/rest/v2",
+    ))
+    assert sorted(m["material_id"] for m in materials) == sorted(f"mp-{i+1}" for i in range(3000))
+
+
+def test_normalize_material():
+    material = normalize_material({
+        "material_id": "mp-1",
+        "magnetism": {"total_magnetization": 1.5, "num_magnetic_sites": "2"},
+        "spacegroup": {"number": 225},
+        "efermi": "None",
+    })
+    assert material["true_total_magnetization"] == 1.5
+    assert material["num_magnetic_sites"] == 2
+    assert material["spacegroup_number"] == 225
+    assert material["efermi"] != material["efermi"]  # nan
+    assert "magnetism" not in material
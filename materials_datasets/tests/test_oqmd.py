@@ -0,0 +1,99 @@
+import pytest
+
+import oqmd.download as download
+from oqmd.download import (
+    OQMD_multi_session, OQMD_page_ledger, OQMD_part_store, OQMD_async_engine,
+    download_part, fetch_parts, write_part,
+)
+from fake_servers import Fake_OQMD
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(download, "retry_delay", lambda attempt: 0.)
+
+
+def part(server, start_at=0, stop_at=250):
+    return OQMD_multi_session(start_at=start_at, stop_at=stop_at, host=server.url)
+
+
+def test_download_part(tmp_path):
+    with Fake_OQMD(n_materials=250) as server:
+        part_df = download_part(part(server), OQMD_page_ledger(tmp_path))
+    assert server.n_requests == 3
+    assert part_df["id"].tolist() == [str(i+1) for i in range(250)]
+    assert part_df["nsites"].dtype == "int64"
+    assert part_df["chemical_formula_reduced"].dtype == object
+
+
+def test_ledger_resume(tmp_path):
+    with Fake_OQMD(n_materials=250) as server:
+        oqmd = part(server)
+        first = download_part(oqmd, OQMD_page_ledger(tmp_path))
+        ledger = OQMD_page_ledger(tmp_path)  # as after a restart
+        assert [ledger.status(offset) for offset in oqmd.page_offsets()] == ["fetched"]*3
+        second = download_part(oqmd, ledger)
+        assert server.n_requests == 3  # the spooled pages are not downloaded again
+        assert second.equals(first)
+
+        store = OQMD_part_store(tmp_path)
+        write_part(store, ledger, oqmd, second)
+        ledger = OQMD_page_ledger(tmp_path)
+        assert ledger.is_done(oqmd.page_offsets())
+        assert ledger.pending(oqmd.page_offsets()) == []
+        assert not list(ledger.pages_dir.iterdir())
+        assert OQMD_part_store(tmp_path).n_rows() == 250
+
+
+def test_retry_cap(tmp_path):
+    with Fake_OQMD(n_materials=250, error_rate=1.) as server:
+        oqmd = part(server)
+        with pytest.raises(ConnectionError):
+            download_part(oqmd, OQMD_page_ledger(tmp_path), max_attempts=2)
+        assert server.n_requests == 6
+
+        # the attempts are counted across restarts
+        ledger = OQMD_page_ledger(tmp_path)
+        assert [ledger.attempts(offset) for offset in oqmd.page_offsets()] == [2]*3
+        assert "503" in ledger.error(0)
+        with pytest.raises(ConnectionError):
+            download_part(oqmd, ledger, max_attempts=2)
+        assert server.n_requests == 6
+
+        assert ledger.reset_failed() == oqmd.page_offsets()
+        server.error_rate = 0.
+        assert len(download_part(oqmd, OQMD_page_ledger(tmp_path), max_attempts=2)) == 250
+
+
+def test_transient_errors(tmp_path):
+    with Fake_OQMD(n_materials=1000, error_rate=0.3, seed=1) as server:
+        part_df = download_part(part(server, 0, 1000), OQMD_page_ledger(tmp_path), max_attempts=20)
+    assert server.n_errors > 0
+    assert part_df["id"].tolist() == [str(i+1) for i in range(1000)]
+
+
+def test_fetch_parts(tmp_path):
+    with Fake_OQMD(n_materials=1000, error_rate=0.2, seed=2) as server, \
+            OQMD_async_engine() as engine:
+        parts = [part(server, start, start+400) for start in (0, 400, 800)]
+        parts[-1] = part(server, 800, 1000)
+        store = OQMD_part_store(tmp_path)
+        ledger = OQMD_page_ledger(tmp_path)
+        engine.run(fetch_parts(store, ledger, engine, parts, window=2, max_attempts=20))
+    assert store.n_rows() == 1000
+    assert all(store.has_part(oqmd.start_at, oqmd.stop_at) for oqmd in parts)
+    assert store.load()["id"].tolist() == [str(i+1) for i in range(1000)]
+    assert ledger.count("done") == 10
+
+
+def test_fetch_parts_failure(tmp_path):
+    # a part which cannot be downloaded does not stop the others
+    with Fake_OQMD(n_materials=500) as server, Fake_OQMD(error_rate=1.) as failing, \
+            OQMD_async_engine() as engine:
+        good = part(server, 0, 200)
+        bad = part(failing, 200, 400)
+        store = OQMD_part_store(tmp_path)
+        with pytest.raises(ConnectionError):
+            engine.run(fetch_parts(store, OQMD_page_ledger(tmp_path), engine, [bad, good], max_attempts=2))
+    assert store.has_part(0, 200)
+    assert not store.has_part(200, 400)
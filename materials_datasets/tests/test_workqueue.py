@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+from common.workqueue import Shard_queue
+
+SHARDS = [("a", {"n": 1}), ("b", {"n": 2})]
+
+
+@pytest.fixture
+def queue(tmp_path):
+    with Shard_queue(tmp_path/"queue.sqlite", lease_seconds=0.05, max_attempts=2) as queue:
+        queue.add(SHARDS, parameters={"max_N": 22})
+        yield queue
+
+
+def test_claim_done(queue):
+    assert queue.claim("w1") == ("a", {"n": 1})
+    assert queue.claim("w2") == ("b", {"n": 2})
+    assert queue.claim("w3") is None
+    queue.done("a", "w1", {"rows": 10})
+    queue.done("b", "w2")
+    assert queue.is_finished()
+    assert queue.results() == [("a", {"n": 1}, {"rows": 10}), ("b", {"n": 2}, None)]
+
+
+def test_lease_expiry(queue):
+    assert queue.claim("w1")[0] == "a"
+    assert queue.renew("a", "w1")
+    time.sleep(0.1)
+    assert queue.claim("w2")[0] == "a"  # released, and leased again
+    assert not queue.renew("a", "w1")
+    time.sleep(0.1)
+    # claimed max_attempts times and never given back: its workers may die of it
+    assert queue.claim("w3")[0] == "b"
+    assert queue.failures() == [("a", 2, "lease expired")]
+    queue.done("b", "w3")
+    assert queue.is_finished()
+    assert queue.counts() == {"done": 1, "failed": 1}
+
+
+def test_fail(queue):
+    queue.claim("w1")
+    queue.fail("a", "w1", "boom")
+    assert queue.claim("w1")[0] == "a"  # pending again
+    queue.fail("a", "w1", "boom")
+    assert queue.failures() == [("a", 2, "boom")]
+
+
+def test_add_again(queue):
+    queue.claim("w1")
+    queue.add(SHARDS + [("c", {"n": 3})], parameters={"max_N": 22})
+    assert queue.counts() == {"leased": 1, "pending": 2}
+
+
+def test_add_other_parameters(queue):
+    with pytest.raises(ValueError):
+        queue.add(SHARDS, parameters={"max_N": 10})
+    queue.add([("z", {})], parameters={"max_N": 10}, reset=True)
+    assert queue.counts() == {"pending": 1}
+    assert queue.claim("w1") == ("z", {})